@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Run a JSONL file of completion requests through the CPU app's model code as an
+offline Ray Data job, instead of sending them to the Serve endpoint one at a time.
+
+The input uses the OpenAI batch format, one request per line:
+  {"custom_id": "req-1", "method": "POST", "url": "/v1/completions", "body": {"prompt": "...", "max_tokens": 64}}
+A line holding just the request body is also accepted; its custom_id is the line number.
+
+Each Ray Data actor builds the same TextGenerator as a cpu-app.py replica (MODEL_ID,
+MULTIPLEXED_MODELS, QUANTIZATION and the other variables are read from --env), and
+answers --batch-size requests per call with TextGenerator.complete(). Results are
+appended to --output in the OpenAI batch output format as they finish:
+  {"id": "batch_req_...", "custom_id": "req-1", "response": {"status_code": 200, "request_id": "...", "body": {...}}, "error": null}
+
+Rerunning the same command resumes the job: requests whose custom_id is already in
+--output are skipped, and a line cut off by an interrupted run is dropped first.
+
+Usage:
+  python batch_completions.py --input prompts.jsonl --output results.jsonl --env MODEL_ID=/mnt/models/models/tinyllama
+  python batch_completions.py --input /mnt/models/jobs/nightly.jsonl --output nightly-results.jsonl \\
+      --concurrency 4 --num-cpus 4 --env MODEL_ID=/mnt/models/models/tinyllama --env QUANTIZATION=int8
+"""
+
+import json
+import os
+import sys
+import time
+import uuid
+
+SUPPORTED_URLS = ("/v1/completions",)
+
+
+def read_requests(path):
+    """Returns (custom_id, url, body) for every request line of a batch input file."""
+    requests = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            if "body" in request:
+                requests.append((str(request.get("custom_id", line_number)), request.get("url", SUPPORTED_URLS[0]),
+                                 request["body"]))
+            else:
+                requests.append((str(line_number), SUPPORTED_URLS[0], request))
+    return requests
+
+
+def completed_ids(path):
+    """Returns the custom_ids already written to path, dropping a partially written last line."""
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            data = data[:data.rfind(b"\n") + 1]
+    return {json.loads(line)["custom_id"] for line in data.decode().splitlines() if line.strip()}
+
+
+def _output_line(custom_id, body=None, error=None):
+    response = None
+    if body is not None:
+        response = {"status_code": 200, "request_id": uuid.uuid4().hex, "body": body}
+    return json.dumps({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": custom_id, "response": response,
+                       "error": error})
+
+
+class CompletionWorker:
+    """Ray Data actor holding one TextGenerator built from the app source."""
+
+    def __init__(self, app_source, env_vars):
+        import types
+
+        os.environ.update(env_vars)
+        # The app is shipped as app.py inside the serve zip, so build it from its source
+        module = types.ModuleType("app")
+        exec(compile(app_source, "app.py", "exec"), module.__dict__)
+        self.generator = module.TextGenerator.func_or_class()
+
+    def __call__(self, batch):
+        lines = [None] * len(batch["custom_id"])
+        bodies, indices = [], []
+        for i, (custom_id, url, body) in enumerate(zip(batch["custom_id"], batch["url"], batch["body"])):
+            if url not in SUPPORTED_URLS:
+                lines[i] = _output_line(custom_id, error={"code": "invalid_url", "message": f"Unsupported url: {url}"})
+            else:
+                bodies.append(json.loads(body))
+                indices.append(i)
+        for i, response in zip(indices, self.generator.complete(bodies)):
+            custom_id = batch["custom_id"][i]
+            if "error" in response:
+                lines[i] = _output_line(custom_id, error={"code": response["error"]["type"],
+                                                          "message": response["error"]["message"]})
+            else:
+                lines[i] = _output_line(custom_id, body=response)
+        return {"line": lines}
+
+
+def main(args):
+    import ray
+
+    requests = read_requests(args.input)
+    done = completed_ids(args.output)
+    pending = [r for r in requests if r[0] not in done]
+    print(f"{len(done)} of {len(requests)} requests already in {args.output}, {len(pending)} to run", file=sys.stderr)
+    if not pending:
+        return
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "cpu-app.py")) as f:
+        app_source = f.read()
+    env_vars = dict(kv.split("=", 1) for kv in args.env)
+
+    ray.init(include_dashboard=False)
+    dataset = ray.data.from_items([
+        {"custom_id": custom_id, "url": url, "body": json.dumps(body)} for custom_id, url, body in pending
+    ]).map_batches(
+        CompletionWorker,
+        fn_constructor_kwargs={"app_source": app_source, "env_vars": env_vars},
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        num_cpus=args.num_cpus,
+        num_gpus=args.num_gpus
+    )
+
+    # Append as results arrive so an interrupted job keeps what it finished
+    start_time = time.time()
+    written = 0
+    with open(args.output, "a") as f:
+        for batch in dataset.iter_batches(batch_size=None):
+            for line in batch["line"]:
+                f.write(line + "\n")
+            f.flush()
+            written += len(batch["line"])
+            elapsed = time.time() - start_time
+            print(f"{written}/{len(pending)} requests, {written / elapsed:.2f} requests/s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a JSONL file of completion requests as an offline Ray Data job")
+    parser.add_argument("--input", required=True, help="OpenAI batch input JSONL, e.g. on the /mnt/models mount")
+    parser.add_argument("--output", required=True, help="Output JSONL; rerunning resumes after its completed requests")
+    parser.add_argument("--batch-size", type=int, default=16, help="Requests per TextGenerator.complete() call")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of model actors")
+    parser.add_argument("--num-cpus", type=float, default=1, help="CPUs reserved per model actor")
+    parser.add_argument("--num-gpus", type=float, default=0, help="GPUs reserved per model actor")
+    parser.add_argument("--env", nargs="*", action="extend", default=[], help="KEY=VALUE environment variables for the app")
+    main(parser.parse_args())
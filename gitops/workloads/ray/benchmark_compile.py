@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Benchmark the compiled CPU execution mode of the TextGenerator (cpu-app.py) against eager.
+
+Each mode builds the TextGenerator in its own process, since compilation caches and
+thread settings are process-wide:
+  - eager / eager-bf16: TORCH_COMPILE=false with CPU_DTYPE float32 / bfloat16
+  - compile / compile-bf16: TORCH_COMPILE=true with CPU_DTYPE float32 / bfloat16
+
+For every mode the report has the startup time (including compilation and warm-up),
+the latency of the first request after startup, greedy latency for one prompt at a
+time, generated tokens/sec for --batch-size prompts in one batch, and greedy token
+agreement with eager fp32. The prefix cache is disabled in every mode, since compiled
+replicas do not use it.
+
+Without --model a tiny random-weight Llama is generated, so the benchmark runs offline;
+its per-token overhead is mostly Python, so expect larger gains than on a real model.
+
+Usage:
+  python benchmark_compile.py
+  python benchmark_compile.py --model /mnt/models/models/tinyllama --threads 4 --output compile.json
+"""
+
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark_quantization import _read_prompts
+
+MODES = {
+    "eager": {"TORCH_COMPILE": "false", "CPU_DTYPE": "float32"},
+    "eager-bf16": {"TORCH_COMPILE": "false", "CPU_DTYPE": "bfloat16"},
+    "compile": {"TORCH_COMPILE": "true", "CPU_DTYPE": "float32"},
+    "compile-bf16": {"TORCH_COMPILE": "true", "CPU_DTYPE": "bfloat16"},
+}
+
+
+def _load_cpu_app():
+    # cpu-app.py is shipped as app.py inside the serve zip, so import it by path
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cpu-app.py")
+    spec = importlib.util.spec_from_file_location("cpu_app", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def agreement(baseline, candidate):
+    """Greedy exact-match rate and mean fraction of tokens matching until the first divergence."""
+    exact, prefix = 0, []
+    for expected, actual in zip(baseline, candidate):
+        exact += expected == actual
+        matched = next((i for i, (a, b) in enumerate(zip(expected, actual)) if a != b), min(len(expected), len(actual)))
+        prefix.append(matched / max(len(expected), 1))
+    return {"exact_match_rate": round(exact / len(baseline), 4), "prefix_agreement": round(statistics.mean(prefix), 4)}
+
+
+def run_mode(mode, prompts, max_tokens, batch_size, output_path):
+    import torch
+
+    start = time.time()
+    generator = _load_cpu_app().TextGenerator.func_or_class()
+    startup = time.time() - start
+    model = generator.models.entries[generator.default_model]
+
+    def generate(batch):
+        return generator._generate_batch(
+            [model] * len(batch), batch, [max_tokens] * len(batch), [0.0] * len(batch), [1.0] * len(batch),
+            [None] * len(batch), [time.time()] * len(batch)
+        )
+
+    start = time.time()
+    generate(prompts[:1])
+    first_request = time.time() - start
+
+    tokens, latencies = [], []
+    for prompt in prompts:
+        start = time.time()
+        tokens.append(generator._generate(model, [model.tokenizer(prompt)["input_ids"]], max_tokens, temperature=0)[0])
+        latencies.append(time.time() - start)
+
+    # Ignore EOS in the batch run so every mode generates the same number of tokens
+    batch = (prompts * batch_size)[:batch_size]
+    model.model.generation_config.min_new_tokens = max_tokens
+    start = time.time()
+    generate(batch)
+    batch_time = time.time() - start
+
+    with open(output_path, "w") as f:
+        json.dump({
+            "metrics": {
+                "mode": mode,
+                "dtype": str(generator.torch_dtype).replace("torch.", ""),
+                "num_threads": torch.get_num_threads(),
+                "startup_seconds": round(startup, 2),
+                "startup_timings": model.startup_timings,
+                "first_request_seconds": round(first_request, 4),
+                "latency_p50_seconds": round(statistics.median(latencies), 4),
+                "latency_mean_seconds": round(statistics.mean(latencies), 4),
+                "throughput_tokens_per_second": round(max_tokens * len(batch) / batch_time, 2),
+            },
+            "tokens": tokens,
+        }, f)
+
+
+def main(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        model_id = args.model
+        if not model_id:
+            from benchmark_serve import create_tiny_model
+
+            model_id = os.path.join(tmp, "tiny")
+            create_tiny_model(model_id)
+        for mode in ["eager"] + [m for m in args.modes if m != "eager"]:
+            print(f"Benchmarking {mode}...", file=sys.stderr)
+            path = os.path.join(tmp, f"{mode}.json")
+            env = dict(os.environ, MODEL_ID=model_id, PREFIX_CACHE_MAX_MB="0", MAX_BATCH_SIZE=str(args.batch_size),
+                       COMPILE_WARMUP_MAX_LENGTH=str(args.warmup_max_length), **MODES[mode])
+            if args.threads:
+                env["TORCH_NUM_THREADS"] = str(args.threads)
+            subprocess.run([
+                sys.executable, __file__, "--worker", mode, "--worker-output", path,
+                "--max-tokens", str(args.max_tokens), "--batch-size", str(args.batch_size)
+            ] + (["--prompts-file", args.prompts_file] if args.prompts_file else []), env=env, check=True)
+            with open(path) as f:
+                results[mode] = json.load(f)
+
+    eager = results["eager"]["metrics"]
+    report = {"model": args.model or "tiny-random", "max_tokens": args.max_tokens, "batch_size": args.batch_size, "modes": {}}
+    for mode, result in results.items():
+        metrics = result["metrics"]
+        report["modes"][mode] = dict(
+            metrics,
+            latency_speedup=round(eager["latency_p50_seconds"] / metrics["latency_p50_seconds"], 2),
+            throughput_speedup=round(metrics["throughput_tokens_per_second"] / eager["throughput_tokens_per_second"], 2),
+            parity=agreement(results["eager"]["tokens"], result["tokens"])
+        )
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark compiled CPU execution against eager")
+    parser.add_argument("--model", help="Model directory (default: a generated tiny random model)")
+    parser.add_argument("--modes", nargs="+", default=["compile", "eager-bf16", "compile-bf16"], choices=sorted(MODES))
+    parser.add_argument("--max-tokens", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--threads", type=int, help="TORCH_NUM_THREADS for every mode (default: torch's default)")
+    parser.add_argument("--warmup-max-length", type=int, default=512, help="COMPILE_WARMUP_MAX_LENGTH for compiled modes")
+    parser.add_argument("--prompts-file", help="Text file with one prompt per line")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--worker-output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_mode(args.worker, _read_prompts(args.prompts_file), args.max_tokens, args.batch_size, args.worker_output)
+    else:
+        main(args)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Benchmark CPU weight quantization modes of the TextGenerator (cpu-app.py) against fp32.
+
+Each mode runs in its own process so resident memory is measured cleanly:
+  - latency: greedy generation of --max-tokens for one prompt at a time
+  - throughput: generated tokens/sec for --batch-size prompts in one padded generate call
+  - rss: resident memory added by loading (and quantizing) the model
+  - parity: greedy token agreement and next-token logit differences versus fp32
+
+Usage:
+  python benchmark_quantization.py --model /mnt/models/models/tinyllama
+  python benchmark_quantization.py --model /mnt/models/models/tinyllama --modes int8 --output results.json
+"""
+
+import gc
+import importlib.util
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+DEFAULT_PROMPTS = [
+    "Hello, how are you?",
+    "What is Kubernetes?",
+    "Explain the difference between a process and a thread.",
+    "Write a haiku about autumn leaves.",
+    "List three benefits of infrastructure as code.",
+    "Summarize the plot of Romeo and Juliet in one sentence.",
+    "How do I reverse a list in Python?",
+    "What causes the seasons on Earth?",
+]
+
+
+def _load_cpu_app():
+    # cpu-app.py is shipped as app.py inside the serve zip, so import it by path
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cpu-app.py")
+    spec = importlib.util.spec_from_file_location("cpu_app", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _read_prompts(path):
+    if not path:
+        return DEFAULT_PROMPTS
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def _rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def run_mode(mode, model_id, prompts, max_tokens, batch_size, group_size, output_path):
+    torch.manual_seed(0)
+    tokenizer = AutoTokenizer.from_pretrained(model_id, local_files_only=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+
+    gc.collect()
+    rss_before = _rss_bytes()
+    model = AutoModelForCausalLM.from_pretrained(
+        model_id, torch_dtype=torch.float32, low_cpu_mem_usage=True, local_files_only=True
+    )
+    if mode != "none":
+        model = _load_cpu_app().quantize_model(model, mode, group_size=group_size)
+    model.eval()
+    gc.collect()
+    model_rss = _rss_bytes() - rss_before
+
+    tokens, logits, latencies = [], [], []
+    with torch.no_grad():
+        for prompt in prompts:
+            inputs = tokenizer(prompt, return_tensors="pt")
+            logits.append(model(**inputs).logits[0, -1].float())
+            start = time.time()
+            output = model.generate(
+                **inputs, max_new_tokens=max_tokens, do_sample=False, pad_token_id=tokenizer.eos_token_id
+            )
+            latencies.append(time.time() - start)
+            tokens.append(output[0, inputs["input_ids"].shape[1]:].tolist())
+
+        batch = (prompts * batch_size)[:batch_size]
+        inputs = tokenizer(batch, return_tensors="pt", padding=True)
+        start = time.time()
+        output = model.generate(
+            **inputs, max_new_tokens=max_tokens, min_new_tokens=max_tokens,
+            do_sample=False, pad_token_id=tokenizer.eos_token_id
+        )
+        batch_time = time.time() - start
+        generated = (output.shape[1] - inputs["input_ids"].shape[1]) * len(batch)
+
+    torch.save({
+        "metrics": {
+            "mode": mode,
+            "latency_p50_seconds": round(statistics.median(latencies), 4),
+            "latency_mean_seconds": round(statistics.mean(latencies), 4),
+            "throughput_tokens_per_second": round(generated / batch_time, 2),
+            "model_rss_mb": round(model_rss / 2 ** 20, 1),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        },
+        "tokens": tokens,
+        "logits": torch.stack(logits),
+    }, output_path)
+
+
+def parity(baseline, candidate):
+    exact, agreement = 0, []
+    for expected, actual in zip(baseline["tokens"], candidate["tokens"]):
+        exact += expected == actual
+        # Fraction of positions matching until the first divergence
+        matched = next((i for i, (a, b) in enumerate(zip(expected, actual)) if a != b), min(len(expected), len(actual)))
+        agreement.append(matched / max(len(expected), 1))
+    base_logits, logits = baseline["logits"], candidate["logits"]
+    return {
+        "exact_match_rate": round(exact / len(baseline["tokens"]), 4),
+        "prefix_agreement": round(statistics.mean(agreement), 4),
+        "next_token_top1_agreement": round((base_logits.argmax(-1) == logits.argmax(-1)).float().mean().item(), 4),
+        "max_abs_logit_diff": round((base_logits - logits).abs().max().item(), 4),
+        "kl_divergence": round(torch.nn.functional.kl_div(
+            logits.log_softmax(-1), base_logits.log_softmax(-1), log_target=True, reduction="batchmean"
+        ).item(), 6),
+    }
+
+
+def main(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ["none"] + [m for m in args.modes if m != "none"]:
+            print(f"Benchmarking QUANTIZATION={mode}...", file=sys.stderr)
+            path = os.path.join(tmp, f"{mode}.pt")
+            subprocess.run([
+                sys.executable, __file__, "--worker", mode, "--model", args.model, "--worker-output", path,
+                "--max-tokens", str(args.max_tokens), "--batch-size", str(args.batch_size),
+                "--group-size", str(args.group_size)
+            ] + (["--prompts-file", args.prompts_file] if args.prompts_file else []), check=True)
+            results[mode] = torch.load(path)
+
+    report = {"model": args.model, "max_tokens": args.max_tokens, "batch_size": args.batch_size, "modes": {}}
+    for mode, result in results.items():
+        report["modes"][mode] = dict(result["metrics"], parity=parity(results["none"], result))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark CPU quantization modes against fp32")
+    parser.add_argument("--model", default=os.environ.get("MODEL_ID", "/mnt/models/models/tinyllama"))
+    parser.add_argument("--modes", nargs="+", default=["int8", "int4"], choices=["none", "int8", "int4"])
+    parser.add_argument("--max-tokens", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--group-size", type=int, default=128, help="Input features per int4 scale")
+    parser.add_argument("--prompts-file", help="Text file with one prompt per line")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--worker-output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_mode(args.worker, args.model, _read_prompts(args.prompts_file), args.max_tokens, args.batch_size, args.group_size, args.worker_output)
+    else:
+        main(args)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Load-test the Ray Serve text-generation endpoints (cpu-app.py / gpu-app.py).
+
+By default the app is started on a local Serve instance with a tiny random-weight
+Llama model generated on the fly, so the benchmark runs offline. Pass --url to drive
+an existing endpoint instead.
+
+For every --concurrency level a closed loop of clients sends --requests requests with
+prompt and output lengths drawn from --prompt-tokens / --output-tokens, where each
+distribution is one of:
+  fixed:N            always N tokens
+  uniform:LOW:HIGH   uniformly between LOW and HIGH
+  normal:MEAN:STD    normally distributed, at least 1
+
+The JSON report has p50/p95/p99 latency and time-to-first-token, request and token
+throughput, and per-replica utilization read from GET /generate/stats.
+
+Usage:
+  python benchmark_serve.py --app cpu --concurrency 1 4 16 --output cpu.json
+  python benchmark_serve.py --app gpu --model /mnt/models/models/mistral-7b --num-replicas 2
+  python benchmark_serve.py --url http://localhost:8000/generate --tokenizer /mnt/models/models/tinyllama
+"""
+
+import asyncio
+import importlib
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+APPS = {"cpu": "cpu-app.py", "gpu": "gpu-app.py"}
+
+WORDS = (
+    "the quick brown fox jumps over lazy dog cluster node pod service deploy model token "
+    "request replica batch cache memory latency stream answer question explain write list "
+    "summary python kubernetes ray serve gpu cpu network storage bucket queue scale"
+).split()
+
+
+def create_tiny_model(path):
+    """Saves a randomly initialized two-layer Llama and a small BPE tokenizer to path."""
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator([" ".join(WORDS)] * 20, trainers.BpeTrainer(
+        vocab_size=512,
+        special_tokens=["<s>", "</s>", "<unk>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    ))
+    tokenizer.post_processor = processors.TemplateProcessing(single="<s> $A", special_tokens=[("<s>", 0)])
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", unk_token="<unk>",
+        model_input_names=["input_ids", "attention_mask"]
+    )
+    tokenizer.save_pretrained(path)
+
+    torch.manual_seed(0)
+    LlamaForCausalLM(LlamaConfig(
+        vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=4096,
+        bos_token_id=0, eos_token_id=1
+    )).save_pretrained(path)
+
+
+def parse_distribution(spec):
+    kind, *params = spec.split(":")
+    params = [float(p) for p in params]
+    if kind == "fixed" and len(params) == 1:
+        return lambda rng: int(params[0])
+    if kind == "uniform" and len(params) == 2:
+        return lambda rng: rng.randint(int(params[0]), int(params[1]))
+    if kind == "normal" and len(params) == 2:
+        return lambda rng: max(1, round(rng.gauss(params[0], params[1])))
+    raise ValueError(f"Invalid length distribution: {spec}")
+
+
+class Workload:
+    """Builds prompts of a given token length, counting tokens with the model tokenizer when available."""
+
+    def __init__(self, tokenizer_path=None):
+        self.tokenizer = None
+        if tokenizer_path:
+            from transformers import AutoTokenizer
+            self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, local_files_only=True)
+
+    def count_tokens(self, text):
+        if self.tokenizer is None:
+            return len(text.split())
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def prompt(self, rng, num_tokens):
+        words = [rng.choice(WORDS) for _ in range(num_tokens)]
+        if self.tokenizer is None:
+            return " ".join(words)
+        ids = self.tokenizer(" ".join(words), add_special_tokens=False)["input_ids"][:num_tokens]
+        return self.tokenizer.decode(ids)
+
+    def requests(self, count, prompt_tokens, output_tokens, seed):
+        rng = random.Random(seed)
+        return [{"prompt": self.prompt(rng, prompt_tokens(rng)), "max_tokens": output_tokens(rng)} for _ in range(count)]
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))], 4)
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "mean": round(statistics.mean(values), 4)}
+
+
+async def send(session, url, payload, stream):
+    """Returns (latency, time to first token, generated text, error) for one request."""
+    start = time.monotonic()
+    first_token, chunks = None, []
+    try:
+        async with session.post(url, json=dict(payload, stream=stream)) as response:
+            if response.status != 200:
+                return time.monotonic() - start, None, "", f"HTTP {response.status}"
+            if not stream:
+                body = await response.json()
+                return time.monotonic() - start, None, body.get("generated_text", ""), body.get("error")
+            async for line in response.content:
+                line = line.decode().strip()
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                event = json.loads(line[len("data: "):])
+                if "error" in event:
+                    return time.monotonic() - start, first_token, "".join(chunks), event["error"]
+                if "text" in event:
+                    if first_token is None:
+                        first_token = time.monotonic() - start
+                    chunks.append(event["text"])
+        return time.monotonic() - start, first_token, "".join(chunks), None
+    except Exception as e:
+        return time.monotonic() - start, first_token, "".join(chunks), str(e)
+
+
+async def replica_stats(session, url, probes, num_replicas=None):
+    """Polls the stats route until every replica has answered or probes run out, keyed by replica."""
+    replicas = {}
+    for _ in range(probes):
+        try:
+            async with session.get(url.rstrip("/") + "/stats") as response:
+                utilization = (await response.json()).get("utilization")
+        except Exception:
+            continue
+        if utilization and utilization.get("replica"):
+            replicas[utilization["replica"]] = utilization
+        if num_replicas and len(replicas) >= num_replicas:
+            break
+    return replicas
+
+
+async def run_level(session, url, workload, payloads, concurrency, stream, probes, num_replicas):
+    before = await replica_stats(session, url, probes, num_replicas)
+    pending = list(payloads)
+    results = []
+
+    async def client():
+        while pending:
+            payload = pending.pop()
+            results.append(await send(session, url, payload, stream) + (payload,))
+
+    start = time.monotonic()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    duration = time.monotonic() - start
+    after = await replica_stats(session, url, probes, num_replicas)
+
+    succeeded = [r for r in results if r[3] is None]
+    output_tokens = [workload.count_tokens(text) for _, _, text, _, _ in succeeded]
+    # Time per output token after the first one, streamed requests only
+    per_token = [
+        (latency - ttft) / (tokens - 1)
+        for (latency, ttft, _, _, _), tokens in zip(succeeded, output_tokens) if ttft is not None and tokens > 1
+    ]
+    utilization = {
+        replica: round((stats["busy_seconds"] - before[replica]["busy_seconds"]) / duration, 4)
+        for replica, stats in after.items() if replica in before
+    }
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": len(results) - len(succeeded),
+        "rejected": sum(r[3] == "HTTP 429" for r in results),
+        "error_samples": sorted({r[3] for r in results if r[3] is not None})[:5],
+        "duration_seconds": round(duration, 3),
+        "requests_per_second": round(len(succeeded) / duration, 3),
+        "prompt_tokens": sum(workload.count_tokens(r[4]["prompt"]) for r in succeeded),
+        "output_tokens": sum(output_tokens),
+        "output_tokens_per_second": round(sum(output_tokens) / duration, 2),
+        "latency_seconds": percentiles([r[0] for r in succeeded]),
+        "time_to_first_token_seconds": percentiles([r[1] for r in succeeded if r[1] is not None]),
+        "time_per_output_token_seconds": percentiles(per_token),
+        "replica_utilization": {
+            "replicas": utilization,
+            "mean": round(statistics.mean(utilization.values()), 4) if utilization else None
+        }
+    }
+
+
+async def benchmark(args, url, workload, num_replicas):
+    levels = []
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=0)) as session:
+        if args.warmup:
+            warmup = workload.requests(args.warmup, parse_distribution("fixed:8"), parse_distribution("fixed:4"), args.seed)
+            await asyncio.gather(*[send(session, url, payload, args.stream) for payload in warmup])
+        for i, concurrency in enumerate(args.concurrency):
+            print(f"Running {args.requests} requests at concurrency {concurrency}...", file=sys.stderr)
+            payloads = workload.requests(
+                args.requests, parse_distribution(args.prompt_tokens), parse_distribution(args.output_tokens), args.seed + i
+            )
+            levels.append(await run_level(
+                session, url, workload, payloads, concurrency, args.stream, args.stats_probes, num_replicas
+            ))
+    return levels
+
+
+def start_local_app(args, model_path, workdir):
+    """Deploys the app the way the serve config zip does (app.py with MODEL_ID from the environment)."""
+    import ray
+    from ray import serve
+
+    os.makedirs(workdir, exist_ok=True)
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), APPS[args.app]), os.path.join(workdir, "app.py"))
+    env_vars = dict(kv.split("=", 1) for kv in args.env)
+    env_vars["MODEL_ID"] = model_path
+    if args.num_cpus:
+        # The CPU app only caps its threads to num_cpus when the budget is set explicitly
+        env_vars.setdefault("REPLICA_NUM_CPUS", str(args.num_cpus))
+    ray.init(include_dashboard=False, runtime_env={"working_dir": workdir, "env_vars": env_vars})
+
+    sys.path.insert(0, workdir)
+    app = importlib.import_module("app")
+    deployment = next(v for v in vars(app).values() if isinstance(v, serve.Deployment))
+    options = {"num_replicas": args.num_replicas}
+    actor_options = {"num_cpus": args.num_cpus} if args.num_cpus else {}
+    if not ray.cluster_resources().get("GPU"):
+        # Let the GPU app run on CPU-only machines
+        actor_options["num_gpus"] = 0
+    if actor_options:
+        options["ray_actor_options"] = actor_options
+    serve.run(deployment.options(**options).bind(), route_prefix="/generate")
+    return "http://127.0.0.1:8000/generate"
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix="benchmark-serve-")
+    try:
+        model_path = args.model
+        if not args.url and not model_path:
+            model_path = os.path.join(workdir, "tiny-model")
+            create_tiny_model(model_path)
+        url = args.url or start_local_app(args, model_path, os.path.join(workdir, "app"))
+        workload = Workload(args.tokenizer or (model_path if os.path.isdir(model_path or "") else None))
+
+        levels = asyncio.run(benchmark(args, url, workload, None if args.url else args.num_replicas))
+    finally:
+        if not args.url:
+            from ray import serve
+            serve.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "target": args.url or args.app,
+        "model": model_path or "tiny-random",
+        "stream": args.stream,
+        "prompt_tokens": args.prompt_tokens,
+        "output_tokens": args.output_tokens,
+        "tokens_counted_with": "tokenizer" if workload.tokenizer is not None else "whitespace",
+        "levels": levels
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Load-test the Ray Serve text-generation endpoints")
+    parser.add_argument("--app", choices=sorted(APPS), default="cpu", help="App to start on a local Serve instance")
+    parser.add_argument("--url", help="Benchmark an existing endpoint instead of starting one")
+    parser.add_argument("--model", help="Model path for the local app; a tiny random model is generated if unset")
+    parser.add_argument("--tokenizer", help="Tokenizer used to size prompts and count tokens (defaults to --model)")
+    parser.add_argument("--num-replicas", type=int, default=1)
+    parser.add_argument("--num-cpus", type=float, help="CPUs reserved per replica of the local app")
+    parser.add_argument("--env", nargs="*", action="extend", default=[], help="KEY=VALUE environment variables for the local app")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=64, help="Requests per concurrency level")
+    parser.add_argument("--prompt-tokens", default="uniform:16:128")
+    parser.add_argument("--output-tokens", default="uniform:16:64")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True,
+                        help="Stream responses to measure time to first token")
+    parser.add_argument("--warmup", type=int, default=4)
+    parser.add_argument("--stats-probes", type=int, default=20, help="Stats requests used to reach every replica")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    main(parser.parse_args())
@@ -1,64 +1,1728 @@
 import os
 import ray
 from ray import serve
+from ray.serve import metrics
+from ray.serve.autoscaling_policy import replica_queue_length_autoscaling_policy
+from ray.serve.config import AutoscalingConfig
 import torch
+import torch.nn.functional as F
+from filelock import FileLock, Timeout
+from starlette.responses import JSONResponse, StreamingResponse
 from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers.generation.streamers import BaseStreamer
+import asyncio
+import gc
+import glob
+import hashlib
+import itertools
+import json
 import time
 import logging
+import math
+import uuid
+import weakref
+import shutil
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    from transformers import DynamicCache
+except ImportError:  # transformers < 4.36 only understands tuple caches
+    DynamicCache = None
+
+try:
+    from transformers import StaticCache
+except ImportError:  # transformers < 4.38 has no fixed-size cache to compile against
+    StaticCache = None
 
 logger = logging.getLogger(__name__)
 
-@serve.deployment
+
+def _model_files(model_dir: str) -> List[str]:
+    files = sorted(f for f in os.listdir(model_dir) if os.path.isfile(os.path.join(model_dir, f)))
+    # Skip duplicate weights in other formats when safetensors shards are present
+    if any(f.endswith(".safetensors") for f in files):
+        files = [f for f in files if not f.endswith((".bin", ".pth", ".pt", ".h5", ".msgpack", ".onnx"))]
+    return [os.path.join(model_dir, f) for f in files]
+
+
+def _transfer(paths: List[str], threads: int, target_dir: str = None, chunk_size: int = 64 << 20) -> int:
+    """Reads files as parallel byte ranges, also writing them to target_dir when given."""
+    jobs = []
+    for path in paths:
+        size = os.path.getsize(path)
+        if target_dir:
+            with open(os.path.join(target_dir, os.path.basename(path)), "wb") as f:
+                f.truncate(size)
+        jobs.extend((path, offset, min(chunk_size, size - offset)) for offset in range(0, size, chunk_size))
+
+    def _run(job):
+        path, offset, length = job
+        src = os.open(path, os.O_RDONLY)
+        dst = os.open(os.path.join(target_dir, os.path.basename(path)), os.O_WRONLY) if target_dir else None
+        try:
+            done = 0
+            while done < length:
+                data = os.pread(src, min(16 << 20, length - done), offset + done)
+                if not data:
+                    break
+                if dst is not None:
+                    os.pwrite(dst, data, offset + done)
+                done += len(data)
+            return done
+        finally:
+            os.close(src)
+            if dst is not None:
+                os.close(dst)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return sum(pool.map(_run, jobs))
+
+
+def stage_model(model_dir: str, stage_root: str, threads: int) -> str:
+    """Copies model files to node-local disk once; later replicas on the node reuse the copy."""
+    target = os.path.join(stage_root, model_dir.strip("/").replace("/", "--"))
+    os.makedirs(stage_root, exist_ok=True)
+    with FileLock(target + ".lock"):
+        if not os.path.exists(os.path.join(target, ".staged")):
+            partial = target + ".partial"
+            shutil.rmtree(partial, ignore_errors=True)
+            shutil.rmtree(target, ignore_errors=True)
+            os.makedirs(partial)
+            _transfer(_model_files(model_dir), threads, target_dir=partial)
+            open(os.path.join(partial, ".staged"), "w").close()
+            os.rename(partial, target)
+    return target
+
+
+def load_model(model_id: str, torch_dtype, device: torch.device, device_map=None):
+    """Loads tokenizer and model from the S3 mount and returns them with per-phase timings.
+
+    from_pretrained memory-maps the safetensors shards and reads the weights it needs.
+    With MODEL_STAGE_DIR set, files are first copied to node-local disk in parallel
+    ranges, so replicas on the same node share one copy and its page cache, and the
+    staged shards are read into the page cache before loading. The S3 mount itself is
+    not prefetched: Mountpoint reads bypass the page cache, so they would be read twice.
+    """
+    threads = int(os.environ.get('MODEL_LOAD_THREADS', '8'))
+    timings = {}
+    model_dir = model_id
+
+    start = time.time()
+    stage_root = os.environ.get('MODEL_STAGE_DIR', '')
+    if stage_root:
+        model_dir = stage_model(model_id, stage_root, threads)
+        timings["stage"] = round(time.time() - start, 3)
+
+    start = time.time()
+    if stage_root and os.environ.get('MODEL_PREFETCH', 'true').lower() == 'true':
+        shards = [path for path in _model_files(model_dir) if path.endswith(".safetensors")]
+        _transfer(shards, threads)
+        timings["prefetch"] = round(time.time() - start, 3)
+
+    start = time.time()
+    tokenizer = AutoTokenizer.from_pretrained(model_dir, local_files_only=True)
+    timings["tokenizer"] = round(time.time() - start, 3)
+
+    # Weights are memory-mapped and assigned directly instead of initialising random weights first
+    start = time.time()
+    model = AutoModelForCausalLM.from_pretrained(
+        model_dir,
+        torch_dtype=torch_dtype,
+        device_map=device_map,
+        low_cpu_mem_usage=True,
+        local_files_only=True  # Only use local files, no HuggingFace download
+    )
+    timings["weights"] = round(time.time() - start, 3)
+
+    # With a device_map, accelerate already placed the weights while loading
+    start = time.time()
+    if device_map is None:
+        model = model.to(device)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    timings["placement"] = round(time.time() - start, 3)
+
+    return tokenizer, model, timings
+
+
+class Int4WeightOnlyLinear(torch.nn.Module):
+    """Linear layer holding weights as packed 4-bit integers with one scale per group of inputs.
+
+    Weights are dequantized per forward call, trading some compute for one eighth of the
+    fp32 weight memory.
+    """
+
+    def __init__(self, linear: torch.nn.Linear, group_size: int = 128):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.group_size = group_size
+        # Symmetric quantization to [-8, 7], stored offset by 8 as two nibbles per byte
+        weight = F.pad(linear.weight.detach().float(), (0, -self.in_features % group_size))
+        groups = weight.view(self.out_features, -1, group_size)
+        scale = groups.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / 7
+        q = ((groups / scale).round().clamp(-8, 7) + 8).to(torch.uint8).view(self.out_features, -1)
+        self.register_buffer("packed", q[:, 0::2] | (q[:, 1::2] << 4))
+        self.register_buffer("scale", scale)
+        self.bias = linear.bias
+
+    def forward(self, x):
+        q = torch.stack([self.packed & 0xF, self.packed >> 4], dim=-1).view(self.out_features, -1, self.group_size)
+        weight = ((q.float() - 8) * self.scale).view(self.out_features, -1)[:, :self.in_features]
+        return F.linear(x, weight.to(x.dtype), self.bias)
+
+
+def quantize_model(model, mode: str, group_size: int = 128):
+    """Quantizes the Linear layers of a CPU model: dynamic int8 or weight-only int4."""
+    if mode == "int8":
+        # Weights stored as int8, activations quantized on the fly per batch
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    if mode == "int4":
+        for module in list(model.modules()):
+            for name, child in list(module.named_children()):
+                if isinstance(child, torch.nn.Linear):
+                    setattr(module, name, Int4WeightOnlyLinear(child, group_size))
+        return model
+    raise ValueError(f"Unsupported QUANTIZATION mode: {mode}")
+
+
+def _cpu_supports_bf16() -> bool:
+    """Whether the CPU has native bf16 instructions (AVX512-BF16 or AMX on x86, BF16 on Arm)."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = set(f.read().split())
+    except OSError:
+        return False
+    return bool(flags & {"avx512_bf16", "amx_bf16", "bf16"})
+
+
+def _bucket(length: int, buckets: List[int]) -> int:
+    """Rounds length up to the smallest bucket, or to a multiple of the largest one."""
+    for bucket in buckets:
+        if length <= bucket:
+            return bucket
+    return math.ceil(length / buckets[-1]) * buckets[-1]
+
+
+def compile_model(model):
+    """Compiles the forward pass for generation with a StaticCache.
+
+    Shapes are traced as dynamic, so a handful of graphs covers every batch size and
+    cache length; callers pad prompts and size the cache to length buckets so requests
+    reuse the shapes compiled during warm-up.
+    """
+    model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
+
+def _static_cache(model, batch_size: int, max_cache_len: int, dtype):
+    return StaticCache(
+        config=model.config, max_batch_size=batch_size, max_cache_len=max_cache_len, device=model.device, dtype=dtype
+    )
+
+
+def _cpu_budget() -> int:
+    """CPUs reserved for this process: the Ray actor's num_cpus, or its CPU affinity outside Ray."""
+    num_cpus = None
+    # get_runtime_context() would start a local Ray instance, e.g. in a benchmark importing the app
+    if ray.is_initialized():
+        try:
+            num_cpus = ray.get_runtime_context().get_assigned_resources().get("CPU")
+        except AssertionError:  # The driver rather than an actor
+            pass
+    return max(1, int(num_cpus)) if num_cpus else len(os.sched_getaffinity(0))
+
+
+def _parse_cpulist(text: str) -> List[int]:
+    cpus = []
+    for part in text.strip().split(","):
+        if part:
+            first, _, last = part.partition("-")
+            cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _numa_nodes() -> List[List[int]]:
+    """CPUs this process may run on, grouped by NUMA node."""
+    allowed = os.sched_getaffinity(0)
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"),
+                       key=lambda p: int(os.path.basename(os.path.dirname(p))[4:])):
+        with open(path) as f:
+            cpus = [cpu for cpu in _parse_cpulist(f.read()) if cpu in allowed]
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [sorted(allowed)]
+
+
+class CpuPlacement:
+    """Pins a replica to num_cpus cores that no other replica on the node holds.
+
+    The allowed CPUs are cut into slots of num_cpus, inside one NUMA node when the
+    budget fits in one. A replica claims the first slot whose cores it can lock; the
+    per-core lock files in lock_dir are released when the process exits. In "numa" mode
+    the replica runs on every core of the slot's NUMA node instead, so the kernel can
+    balance its threads while first-touch allocation keeps its memory local.
+    """
+
+    def __init__(self, num_cpus: int, mode: str, lock_dir: str):
+        self.num_cpus = num_cpus
+        self.mode = mode
+        self.lock_dir = lock_dir
+        self.locks = []
+        self.cpus = None
+        self.numa_node = None
+
+    def slots(self) -> List[Tuple[Optional[int], List[int]]]:
+        nodes = _numa_nodes()
+        if self.num_cpus <= max(len(cpus) for cpus in nodes):
+            return [
+                (node, cpus[start:start + self.num_cpus])
+                for node, cpus in enumerate(nodes)
+                for start in range(0, len(cpus) - self.num_cpus + 1, self.num_cpus)
+            ]
+        # Larger than any NUMA node, so slots have to span nodes
+        cpus = [cpu for node_cpus in nodes for cpu in node_cpus]
+        return [(None, cpus[start:start + self.num_cpus]) for start in range(0, len(cpus) - self.num_cpus + 1, self.num_cpus)]
+
+    def _lock(self, cpus: List[int]) -> bool:
+        locks = []
+        for cpu in cpus:
+            lock = FileLock(os.path.join(self.lock_dir, f"cpu-{cpu}.lock"))
+            try:
+                lock.acquire(timeout=0)
+            except Timeout:
+                for held in locks:
+                    held.release()
+                return False
+            locks.append(lock)
+        self.locks = locks
+        return True
+
+    def apply(self) -> Optional[List[int]]:
+        """Claims a free slot and moves every thread of the process onto it; returns None if all are taken."""
+        os.makedirs(self.lock_dir, exist_ok=True)
+        nodes = _numa_nodes()
+        for node, cpus in self.slots():
+            if self._lock(cpus):
+                self.cpus = cpus if self.mode == "cores" or node is None else nodes[node]
+                self.numa_node = node
+                break
+        else:
+            return None
+        # Threads started later inherit the affinity of the thread that starts them
+        for tid in os.listdir("/proc/self/task"):
+            try:
+                os.sched_setaffinity(int(tid), self.cpus)
+            except OSError:
+                pass  # The thread has exited
+        return self.cpus
+
+    def stats(self):
+        return {"mode": self.mode, "num_cpus": self.num_cpus, "cpus": self.cpus, "numa_node": self.numa_node}
+
+
+def _to_legacy_cache(past_key_values):
+    # Work on (key, value) tensors of shape [batch, heads, seq, head_dim] per layer
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def _from_legacy_cache(past_key_values):
+    if DynamicCache is not None:
+        return DynamicCache.from_legacy_cache(tuple(past_key_values))
+    return tuple(past_key_values)
+
+
+def _cache_bytes(past_key_values) -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in past_key_values)
+
+
+class PrefixCache:
+    """LRU cache of prompt KV tensors keyed by token-id prefix and bounded by a byte budget.
+
+    Prefixes are matched in blocks of block_size tokens. A prompt that misses is stored
+    whole; when a later prompt only shares the start of a stored one, that shared part
+    (typically a common system prompt) is stored as its own entry.
+    """
+
+    def __init__(self, max_bytes: int, block_size: int = 16):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.lookup_tokens = 0
+
+    def lookup(self, input_ids: List[int]) -> Tuple[int, Optional[list]]:
+        """Returns the length and (key, value) tensors of the longest cached prefix of input_ids."""
+        # Always leave at least one prompt token to compute the next-token logits
+        limit = len(input_ids) - 1
+        key = tuple(input_ids)
+        with self.lock:
+            self.lookup_tokens += len(input_ids)
+            best_key, best_len = None, 0
+            for entry_key in self.entries:
+                length = 0
+                while (length + self.block_size <= min(limit, len(entry_key))
+                       and entry_key[length:length + self.block_size] == key[length:length + self.block_size]):
+                    length += self.block_size
+                # Prefer the shortest entry on ties so shared preambles win over full prompts
+                if length > best_len or (length == best_len and length and len(entry_key) < len(best_key)):
+                    best_key, best_len = entry_key, length
+            if best_key is None:
+                self.misses += 1
+                return 0, None
+            self.hits += 1
+            self.hit_tokens += best_len
+            self.entries.move_to_end(best_key)
+            past_key_values = [(k[:, :, :best_len], v[:, :, :best_len]) for k, v in self.entries[best_key]]
+        if best_len < len(best_key):
+            self.insert(input_ids[:best_len], past_key_values)
+        return best_len, past_key_values
+
+    def insert(self, input_ids: List[int], past_key_values):
+        """Stores single-sequence KV tensors for input_ids, cropped to a block boundary."""
+        length = len(input_ids) - len(input_ids) % self.block_size
+        key = tuple(input_ids[:length])
+        if length == 0:
+            return
+        # Copy so the entry does not keep a larger batch tensor alive
+        entry = [(k[:, :, :length].clone(), v[:, :, :length].clone()) for k, v in past_key_values]
+        size = _cache_bytes(entry)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = entry
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= _cache_bytes(evicted)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / max(self.hits + self.misses, 1), 4),
+                "token_hit_rate": round(self.hit_tokens / max(self.lookup_tokens, 1), 4)
+            }
+
+
+class ResponseCache:
+    """LRU cache of generated text with a time-to-live, bounded by entry count."""
+
+    def __init__(self, max_entries: int, ttl_s: float):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: str, value: str):
+        self.entries[key] = (time.time() + self.ttl_s, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / max(self.hits + self.misses, 1), 4)
+        }
+
+
+# Shared tier: one named actor that all replicas read through on a local miss
+SharedResponseCache = ray.remote(num_cpus=0)(ResponseCache)
+
+
+def _model_bytes(model) -> int:
+    """Memory held by parameters and buffers, including dynamically quantized int8 weights."""
+    total = sum(t.numel() * t.element_size() for t in itertools.chain(model.parameters(), model.buffers()))
+    for module in model.modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            weight = module.weight()
+            total += weight.numel() * weight.element_size()
+    return total
+
+
+def _estimate_model_bytes(model_dir: str, torch_dtype) -> int:
+    """Estimates loaded weight memory from the checkpoint size and the dtype it is stored in."""
+    size = sum(os.path.getsize(path) for path in _model_files(model_dir) if path.endswith((".safetensors", ".bin", ".pt", ".pth")))
+    try:
+        with open(os.path.join(model_dir, "config.json")) as f:
+            stored_dtype = getattr(torch, json.load(f).get("torch_dtype") or "float32")
+    except (OSError, ValueError, TypeError, AttributeError):
+        stored_dtype = torch_dtype
+    return size * torch.empty(0, dtype=torch_dtype).element_size() // torch.empty(0, dtype=stored_dtype).element_size()
+
+
+def _memory_budget_bytes(device: torch.device) -> int:
+    """Default budget for resident models: 75% of GPU memory, or of the container memory limit on CPU."""
+    if device.type == "cuda":
+        total = torch.cuda.get_device_properties(device.index or 0).total_memory
+    else:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        try:
+            with open("/sys/fs/cgroup/memory.max") as f:
+                limit = f.read().strip()
+            if limit != "max":
+                total = min(total, int(limit))
+        except (OSError, ValueError):
+            pass
+    return int(total * 0.75)
+
+
+def _check_generation_params(max_tokens: int, top_p: float):
+    """Raises ValueError for values that generate() fails on or that would silently truncate the output."""
+    if max_tokens < 1:
+        raise ValueError("max_tokens must be a positive integer")
+    if not 0 < top_p <= 1:
+        raise ValueError("top_p must be greater than 0 and at most 1")
+
+
+class LoadedModel:
+    """A model resident on the replica, with its tokenizer and per-model prefix cache."""
+
+    def __init__(self, name: str, model_path: str, tokenizer, model, startup_timings: Dict[str, float],
+                 prefix_cache: PrefixCache = None):
+        self.name = name
+        self.model_path = model_path
+        self.tokenizer = tokenizer
+        self.model = model
+        self.startup_timings = startup_timings
+        self.prefix_cache = prefix_cache
+        self.nbytes = _model_bytes(model)
+        self.in_use = 0
+        self.pool = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.model is not None
+
+    @contextmanager
+    def use(self):
+        """Marks the model as busy so the pool does not unload it mid-request."""
+        self.in_use += 1
+        try:
+            yield self
+        finally:
+            self.in_use -= 1
+
+    def unload(self):
+        self.model = None
+        self.prefix_cache = None
+
+    def __del__(self):
+        # serve.multiplexed calls __del__ when it drops the model from its own LRU
+        if self.pool is not None:
+            self.pool.discard(self)
+
+
+class ModelPool:
+    """LRU of resident models bounded by a byte budget for their weights.
+
+    Before a model is loaded, least recently used models that no request is using are
+    unloaded until its estimated size fits. Models in use are never unloaded, so the
+    budget can be exceeded until they finish. LoadedModel.__del__ can discard a model
+    from another thread, so the entries and counters are only changed under a mutex.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = asyncio.Lock()
+        # Reentrant because gc.collect() in _remove can run __del__ and discard on the same thread
+        self.mutex = threading.RLock()
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def get_nowait(self, name: str) -> Optional[LoadedModel]:
+        with self.mutex:
+            entry = self.entries.get(name)
+            if entry is not None:
+                self.entries.move_to_end(name)
+                self.hits += 1
+            return entry
+
+    async def get(self, name: str, load, estimated_bytes: int) -> LoadedModel:
+        """Returns the resident model, calling the async load(name) on a miss."""
+        entry = self.get_nowait(name)
+        if entry is not None:
+            return entry
+        # One load at a time, so concurrent misses neither load twice nor overshoot the budget
+        async with self.lock:
+            entry = self.get_nowait(name)
+            if entry is None:
+                self.evict(estimated_bytes)
+                entry = await load(name)
+                self.add(entry)
+            return entry
+
+    def load(self, name: str, load, estimated_bytes: int) -> LoadedModel:
+        """Like get() for callers without an event loop, such as offline batch jobs."""
+        entry = self.get_nowait(name)
+        if entry is None:
+            self.evict(estimated_bytes)
+            entry = load(name)
+            self.add(entry)
+        return entry
+
+    def add(self, entry: LoadedModel):
+        with self.mutex:
+            entry.pool = self
+            self.entries[entry.name] = entry
+            self.total_bytes += entry.nbytes
+            self.loads += 1
+            # The estimate can be off, so make room for the actual size as well
+            self.evict(0, keep=entry.name)
+            if self.total_bytes > self.max_bytes:
+                logger.warning(f"Resident models use {self.total_bytes >> 20} MB, above the {self.max_bytes >> 20} MB budget")
+
+    def evict(self, incoming_bytes: int, keep: str = None):
+        with self.mutex:
+            for name, entry in list(self.entries.items()):
+                if self.total_bytes + incoming_bytes <= self.max_bytes:
+                    break
+                # An earlier removal's gc.collect() may already have discarded it
+                if name != keep and not entry.in_use and self.entries.get(name) is entry:
+                    self._remove(entry)
+
+    def discard(self, entry: LoadedModel):
+        with self.mutex:
+            if self.entries.get(entry.name) is entry and not entry.in_use:
+                self._remove(entry)
+
+    def _remove(self, entry: LoadedModel):
+        del self.entries[entry.name]
+        self.total_bytes -= entry.nbytes
+        self.evictions += 1
+        entry.unload()
+        logger.info(f"Unloaded model {entry.name} ({entry.nbytes >> 20} MB)")
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def stats(self):
+        with self.mutex:
+            entries = list(self.entries.items())
+        return {
+            "resident": {
+                name: {
+                    "model_path": entry.model_path,
+                    "bytes": entry.nbytes,
+                    "in_use": entry.in_use,
+                    "startup_timings": entry.startup_timings,
+                    "prefix_cache": entry.prefix_cache.stats() if entry.prefix_cache else None
+                }
+                for name, entry in entries
+            },
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "loads": self.loads,
+            "evictions": self.evictions
+        }
+
+
+class IncrementalDetokenizer:
+    """Turns a growing list of token ids into text deltas.
+
+    Only a short window of recent tokens is decoded per step, and text is held back
+    while it ends in an incomplete multi-byte character.
+    """
+
+    def __init__(self, tokenizer, prompt_ids: List[int] = None):
+        self.tokenizer = tokenizer
+        # Seed with the prompt tail so leading spaces of the first generated token survive decoding
+        self.token_ids = list(prompt_ids[-5:]) if prompt_ids else []
+        self.prefix_offset = 0
+        self.read_offset = len(self.token_ids)
+
+    def add(self, token_ids: List[int], final: bool = False) -> str:
+        self.token_ids.extend(token_ids)
+        prefix_text = self.tokenizer.decode(self.token_ids[self.prefix_offset:self.read_offset], skip_special_tokens=True)
+        new_text = self.tokenizer.decode(self.token_ids[self.prefix_offset:], skip_special_tokens=True)
+        if len(new_text) <= len(prefix_text) or (new_text.endswith("\ufffd") and not final):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+
+class _TokenStreamer(BaseStreamer):
+    """Forwards token ids from generate() on a worker thread to an asyncio queue."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.prompt_seen = False
+
+    def put(self, value):
+        # generate() passes the prompt first, then one tensor per new token
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, value.view(-1).tolist())
+
+    def end(self):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+
+class _StepTimer(BaseStreamer):
+    """Records when generate() receives the prompt and emits each token, forwarding to an optional streamer."""
+
+    def __init__(self, streamer: BaseStreamer = None):
+        self.streamer = streamer
+        self.step_times = []
+
+    def put(self, value):
+        self.step_times.append(time.perf_counter())
+        if self.streamer is not None:
+            self.streamer.put(value)
+
+    def end(self):
+        if self.streamer is not None:
+            self.streamer.end()
+
+
+class Overloaded(Exception):
+    """Raised when the inference queue is full; retry_after_s estimates when a slot frees up."""
+
+    def __init__(self, retry_after_s: int):
+        super().__init__(f"Inference queue is full, retry after {retry_after_s}s")
+        self.retry_after_s = retry_after_s
+
+
+class InferenceExecutor:
+    """Runs blocking tokenization and generation on a bounded pool of worker threads.
+
+    This keeps the replica's event loop free for health checks and new requests.
+    Requests are admitted while at most max_queued of them wait for a worker; check()
+    raises Overloaded beyond that so callers can reject instead of queueing without limit.
+    """
+
+    def __init__(self, max_workers: int, max_queued: int):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference")
+        self.lock = threading.Lock()
+        # admitted is only changed on the event loop, running also on worker threads
+        self.admitted = 0
+        self.running = 0
+        self.rejected = 0
+        self.request_seconds = deque(maxlen=64)
+
+    def queued(self) -> int:
+        return self.admitted - self.running
+
+    def check(self):
+        if self.queued() >= self.max_queued:
+            self.rejected += 1
+            raise Overloaded(self.retry_after())
+
+    @contextmanager
+    def admit(self, requests: int = 1):
+        self.admitted += requests
+        try:
+            yield
+        finally:
+            self.admitted -= requests
+
+    def track(self, events):
+        """Checks and admits a streamed request now, before its response starts.
+
+        Admitting when the stream is first iterated would let concurrent streams all
+        pass check(). The admission ends when the stream finishes or is never read.
+        """
+        self.check()
+        self.admitted += 1
+
+        async def tracked():
+            try:
+                async for event in events:
+                    yield event
+            finally:
+                release()
+
+        stream = tracked()
+        release = weakref.finalize(stream, self._release)
+        return stream
+
+    def _release(self):
+        self.admitted -= 1
+
+    async def run(self, fn, *args, requests: int = 0):
+        """Calls fn on a worker thread; requests is how many admitted requests the call serves."""
+        return await asyncio.get_running_loop().run_in_executor(self.pool, self._call, fn, args, requests)
+
+    def _call(self, fn, args, requests: int):
+        with self.lock:
+            self.running += requests
+        start_time = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            with self.lock:
+                self.running -= requests
+                if requests:
+                    self.request_seconds.append((time.perf_counter() - start_time) / requests)
+
+    def retry_after(self) -> int:
+        # Time for the workers to drain the queue at the recent per-request compute time
+        seconds_per_request = sum(self.request_seconds) / len(self.request_seconds) if self.request_seconds else 1.0
+        return max(1, math.ceil(seconds_per_request * (self.queued() + 1) / self.max_workers))
+
+    def stats(self):
+        return {
+            "workers": self.max_workers,
+            "max_queued": self.max_queued,
+            "running": self.running,
+            "queued": self.queued(),
+            "rejected": self.rejected
+        }
+
+
+class RandomStateLock:
+    """Shared/exclusive lock around torch's process-wide random state.
+
+    torch.manual_seed and sampling in generate() use global state, so a seeded
+    generation must not interleave with sampling on another worker thread.
+    Unseeded generations share the lock; seeded ones hold it alone.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.shared_holders = 0
+        self.exclusive_held = False
+        self.exclusive_waiting = 0
+
+    @contextmanager
+    def shared(self):
+        with self.condition:
+            # Waiting seeded generations go first so they are not starved
+            self.condition.wait_for(lambda: not self.exclusive_held and not self.exclusive_waiting)
+            self.shared_holders += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.shared_holders -= 1
+                self.condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self.condition:
+            self.exclusive_waiting += 1
+            self.condition.wait_for(lambda: not self.exclusive_held and not self.shared_holders)
+            self.exclusive_waiting -= 1
+            self.exclusive_held = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.exclusive_held = False
+                self.condition.notify_all()
+
+
+class ReplicaUtilization:
+    """Tracks how much of the replica's lifetime had at least one request in flight.
+
+    Used as a context manager around each request; track() does the same for
+    streamed responses, which finish after __call__ has returned.
+    """
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.busy_seconds = 0.0
+        self.busy_since = None
+        self.in_flight = 0
+        self.requests = 0
+
+    def __enter__(self):
+        if self.in_flight == 0:
+            self.busy_since = time.monotonic()
+        self.in_flight += 1
+        self.requests += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.in_flight -= 1
+        if self.in_flight == 0:
+            self.busy_seconds += time.monotonic() - self.busy_since
+            self.busy_since = None
+
+    async def track(self, events):
+        with self:
+            async for event in events:
+                yield event
+
+    def busy_time(self) -> float:
+        if self.busy_since is None:
+            return self.busy_seconds
+        return self.busy_seconds + time.monotonic() - self.busy_since
+
+    def stats(self):
+        now = time.monotonic()
+        busy_seconds = self.busy_time()
+        try:
+            replica = serve.get_replica_context().replica_tag
+        except Exception:
+            replica = None
+        return {
+            "replica": replica,
+            "uptime_seconds": round(now - self.start_time, 3),
+            "busy_seconds": round(busy_seconds, 3),
+            "utilization": round(busy_seconds / max(now - self.start_time, 1e-9), 4),
+            "in_flight": self.in_flight,
+            "requests": self.requests
+        }
+
+
+class GenerationMetrics:
+    """Per-replica generation metrics exported through Ray's metrics API.
+
+    Ray Serve tags every series with the deployment, replica and application, and
+    Prometheus scrapes them from the Ray metrics export port of each node.
+    """
+
+    LATENCY_BOUNDARIES = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+    TOKEN_LATENCY_BOUNDARIES = [0.001, 0.0025, 0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.2, 0.5, 1]
+    BATCH_SIZE_BOUNDARIES = [1, 2, 4, 8, 16, 32, 64]
+
+    def __init__(self):
+        self.queue_wait = metrics.Histogram(
+            "text_generation_queue_wait_seconds",
+            description="Time a request waits before its batch starts generating",
+            boundaries=self.LATENCY_BOUNDARIES
+        )
+        self.tokenization = metrics.Histogram(
+            "text_generation_tokenization_seconds",
+            description="Time spent tokenizing prompts per tokenizer call",
+            boundaries=self.LATENCY_BOUNDARIES
+        )
+        self.prefill = metrics.Histogram(
+            "text_generation_prefill_seconds",
+            description="Time to run the prompt forward pass and produce the first token",
+            boundaries=self.LATENCY_BOUNDARIES
+        )
+        self.decode_token = metrics.Histogram(
+            "text_generation_decode_token_seconds",
+            description="Latency of one decode step, which produces one token per sequence in the batch",
+            boundaries=self.TOKEN_LATENCY_BOUNDARIES
+        )
+        self.generated_tokens = metrics.Counter(
+            "text_generation_generated_tokens",
+            description="Number of generated tokens"
+        )
+        self.batch_size = metrics.Histogram(
+            "text_generation_batch_size",
+            description="Number of sequences generated together",
+            boundaries=self.BATCH_SIZE_BOUNDARIES
+        )
+        self.errors = metrics.Counter(
+            "text_generation_errors",
+            description="Number of failed generation requests",
+            tag_keys=("path",)
+        )
+        self.rejected = metrics.Counter(
+            "text_generation_rejected_requests",
+            description="Number of requests rejected with 429 because the inference queue was full"
+        )
+
+
+class TokenLoad:
+    """Token demand and decode throughput of a replica, reported to the autoscaler.
+
+    Outstanding tokens is the max_tokens budget of requests in flight; throughput is
+    measured per busy second so idle time does not lower the replica's capacity.
+    """
+
+    def __init__(self, utilization: ReplicaUtilization, window_s: float = 60.0):
+        self.utilization = utilization
+        self.window_s = window_s
+        self.outstanding_tokens = 0
+        self.samples = deque()
+
+    def add(self, max_tokens: int):
+        self.outstanding_tokens += max_tokens
+
+    def remove(self, max_tokens: int):
+        self.outstanding_tokens -= max_tokens
+
+    @contextmanager
+    def reserve(self, max_tokens: int):
+        self.add(max_tokens)
+        try:
+            yield
+        finally:
+            self.remove(max_tokens)
+
+    def stats(self, generated_tokens: int) -> Dict[str, float]:
+        now = time.monotonic()
+        busy_seconds = self.utilization.busy_time()
+        self.samples.append((now, generated_tokens, busy_seconds))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window_s:
+            self.samples.popleft()
+        _, first_tokens, first_busy = self.samples[0]
+        busy = busy_seconds - first_busy
+        return {
+            "ongoing_requests": float(self.utilization.in_flight),
+            "outstanding_tokens": float(self.outstanding_tokens),
+            "decode_tokens_per_s": (generated_tokens - first_tokens) / busy if busy > 0 else 0.0
+        }
+
+
+# Token-throughput autoscaling settings, read when the policy module is imported
+AUTOSCALING_TARGET_DRAIN_S = float(os.environ.get('AUTOSCALING_TARGET_DRAIN_S', '10'))
+AUTOSCALING_DEFAULT_TOKENS_PER_S = float(os.environ.get('AUTOSCALING_DEFAULT_TOKENS_PER_S', '50'))
+AUTOSCALING_WARMUP_S = float(os.environ.get('AUTOSCALING_WARMUP_S', '300'))
+# Budget assumed for queued requests before any request was seen in flight (the apps' default max_tokens)
+AUTOSCALING_DEFAULT_TOKENS_PER_REQUEST = 100
+
+
+def token_throughput_autoscaling_policy(ctx) -> Tuple[int, Dict[str, Any]]:
+    """Scales so the outstanding token budget drains within AUTOSCALING_TARGET_DRAIN_S.
+
+    Capacity per replica is the mean decode rate reported by the replicas (or
+    AUTOSCALING_DEFAULT_TOKENS_PER_S before any were measured). Requests still queued
+    in front of the replicas count with the average in-flight budget. Replicas that are
+    still loading the model count as capacity for up to AUTOSCALING_WARMUP_S, so a
+    slow start does not trigger a second scale-up. Falls back to Ray's request-based
+    policy when the replicas report no token metrics.
+    """
+    state = dict(ctx.policy_state)
+    custom_metrics = ctx.aggregated_metrics or {}
+    outstanding = custom_metrics.get("outstanding_tokens")
+    if not outstanding:
+        # Same context-based call as Serve's own; the policy is only attached on Ray Serve
+        # versions that call policies with a context (see _autoscaling_config)
+        return replica_queue_length_autoscaling_policy(ctx)
+
+    now = ctx.current_time or time.time()
+    rates = [rate for rate in custom_metrics.get("decode_tokens_per_s", {}).values() if rate > 0]
+    if rates:
+        state["tokens_per_s"] = sum(rates) / len(rates)
+    tokens_per_s = state.get("tokens_per_s", AUTOSCALING_DEFAULT_TOKENS_PER_S)
+
+    tokens = sum(outstanding.values())
+    ongoing = sum(custom_metrics.get("ongoing_requests", {}).values())
+    if ongoing > 0:
+        state["tokens_per_request"] = tokens / ongoing
+    queued = max(0.0, ctx.total_num_requests - ongoing)
+    tokens += queued * state.get("tokens_per_request", AUTOSCALING_DEFAULT_TOKENS_PER_REQUEST)
+    desired = math.ceil(tokens / (tokens_per_s * AUTOSCALING_TARGET_DRAIN_S))
+    desired = max(ctx.capacity_adjusted_min_replicas, min(ctx.capacity_adjusted_max_replicas, desired))
+
+    current = ctx.target_num_replicas
+    warming_up = ctx.current_num_replicas < current and now - state.get("scaled_up_at", 0) < AUTOSCALING_WARMUP_S
+    if desired > current and not warming_up:
+        state.pop("below_since", None)
+        state.setdefault("above_since", now)
+        if now - state["above_since"] >= ctx.config.upscale_delay_s:
+            state.pop("above_since")
+            state["scaled_up_at"] = now
+            return desired, state
+    elif desired < current and not warming_up:
+        state.pop("above_since", None)
+        state.setdefault("below_since", now)
+        if now - state["below_since"] >= ctx.config.downscale_delay_s:
+            state.pop("below_since")
+            return desired, state
+    else:
+        state.pop("above_since", None)
+        state.pop("below_since", None)
+    return current, state
+
+
+def _autoscaling_config() -> Optional[Dict[str, Any]]:
+    """Autoscaling is enabled by setting AUTOSCALING_MAX_REPLICAS."""
+    if not os.environ.get('AUTOSCALING_MAX_REPLICAS'):
+        return None
+    config = {
+        "min_replicas": int(os.environ.get('AUTOSCALING_MIN_REPLICAS', '1')),
+        "max_replicas": int(os.environ['AUTOSCALING_MAX_REPLICAS']),
+        "target_ongoing_requests": float(os.environ.get('AUTOSCALING_TARGET_ONGOING_REQUESTS', os.environ.get('MAX_BATCH_SIZE', '8'))),
+        "upscale_delay_s": float(os.environ.get('AUTOSCALING_UPSCALE_DELAY_S', '30')),
+        "downscale_delay_s": float(os.environ.get('AUTOSCALING_DOWNSCALE_DELAY_S', '300'))
+    }
+    if os.environ.get('AUTOSCALING_POLICY', 'requests') == 'token_throughput':
+        if "policy" in AutoscalingConfig.__fields__:
+            from ray.serve.config import AutoscalingPolicy
+            config["policy"] = AutoscalingPolicy(policy_function=token_throughput_autoscaling_policy)
+        else:
+            # Ray Serve only runs custom policies from 2.51 on; older versions use ongoing requests
+            logger.warning("AUTOSCALING_POLICY=token_throughput needs a newer Ray Serve, using request-based autoscaling")
+    return config
+
+
+@serve.deployment(
+    # Leave room above MAX_BATCH_SIZE so the next batch fills while one is generating, and above
+    # MAX_QUEUED_REQUESTS so overload is answered with 429 instead of waiting in the Serve router
+    max_ongoing_requests=int(os.environ.get('MAX_ONGOING_REQUESTS', '64')),
+    # Each replica sizes its thread pools (and CPU_AFFINITY slot) to this budget
+    ray_actor_options={"num_cpus": float(os.environ.get('REPLICA_NUM_CPUS', '1'))},
+    autoscaling_config=_autoscaling_config()
+)
 class TextGenerator:
     def __init__(self, model_id: str = None, max_length: int = 100):
         # Get model path from environment or use default
         self.model_id = model_id or os.environ.get('MODEL_ID', '/mnt/models/models/tinyllama')
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        logger.info(f"Loading model from {self.model_id} on device: {self.device}")
+        self.placement = None
+        
+        # Optional weight quantization, selected like MODEL_ID through the environment
+        self.quantization = os.environ.get('QUANTIZATION', 'none').lower()
+        if self.quantization != "none" and self.device.type != "cpu":
+            logger.warning(f"QUANTIZATION={self.quantization} only applies to CPU replicas, ignoring")
+            self.quantization = "none"
+
+        self.torch_dtype = torch.float16 if self.device.type == "cuda" else torch.float32
+        if self.device.type == "cpu":
+            # bf16 halves weight memory and uses AMX/AVX512-BF16 matmuls on CPUs that have them
+            cpu_dtype = os.environ.get('CPU_DTYPE', 'float32').lower()
+            if cpu_dtype == "auto":
+                cpu_dtype = "bfloat16" if _cpu_supports_bf16() else "float32"
+            if cpu_dtype == "bfloat16" and self.quantization == "int8":
+                logger.warning("Dynamic int8 quantization needs float32 weights, ignoring CPU_DTYPE=bfloat16")
+                cpu_dtype = "float32"
+            if cpu_dtype not in ("float32", "bfloat16"):
+                raise ValueError(f"Unsupported CPU_DTYPE: {cpu_dtype}")
+            self.torch_dtype = getattr(torch, cpu_dtype)
+
+            # Optionally size the thread pools to the replica's num_cpus rather than every core of the node, and
+            # optionally pin the replica to cores (or a NUMA node) that other replicas do not use
+            num_cpus = _cpu_budget()
+            self.placement = CpuPlacement(
+                num_cpus,
+                os.environ.get('CPU_AFFINITY', 'none').lower(),
+                os.environ.get('CPU_AFFINITY_LOCK_DIR', '/tmp/ray-cpu-affinity')
+            )
+            if self.placement.mode not in ("none", "cores", "numa"):
+                raise ValueError(f"Unsupported CPU_AFFINITY: {self.placement.mode}")
+            if self.placement.mode != "none" and self.placement.apply() is None:
+                logger.warning(f"No free set of {num_cpus} CPUs on this node, running without CPU_AFFINITY")
+            # Only cap threads when the budget was chosen explicitly: the default reservation of one
+            # CPU would otherwise silently leave a replica with a single thread
+            num_threads = int(os.environ.get('TORCH_NUM_THREADS', '0'))
+            if not num_threads and ('REPLICA_NUM_CPUS' in os.environ or self.placement.mode != "none"):
+                num_threads = min(num_cpus, len(os.sched_getaffinity(0)))
+            if num_threads:
+                torch.set_num_threads(num_threads)
+                try:
+                    torch.set_num_interop_threads(num_threads)
+                except RuntimeError:
+                    pass  # Fixed once inter-op work has run in this process
+            logger.info(f"CPU placement: {self.placement.stats()}, {torch.get_num_threads()} threads")
+
+        # Optional compiled execution: prompts and the static KV cache are padded to length buckets,
+        # and each model is warmed up on them when it loads so requests do not wait for compilation
+        self.compile = os.environ.get('TORCH_COMPILE', 'false').lower() == 'true'
+        if self.compile and (self.device.type != "cpu" or StaticCache is None):
+            logger.warning("TORCH_COMPILE needs a CPU replica and transformers with StaticCache, ignoring")
+            self.compile = False
+        self.compile_buckets = sorted(int(b) for b in os.environ.get('COMPILE_LENGTH_BUCKETS', '64,128,256,512,1024,2048').split(","))
+        self.compile_warmup_max_length = int(os.environ.get('COMPILE_WARMUP_MAX_LENGTH', '512'))
+        self.max_batch_size = int(os.environ.get('MAX_BATCH_SIZE', '8'))
+            
+        self.max_length = max_length
+
+        # Models under MODEL_ROOT listed in MULTIPLEXED_MODELS can be selected per request; they are
+        # loaded on first use and unloaded least-recently-used to stay within MODEL_MEMORY_MAX_MB
+        self.default_model = os.path.basename(self.model_id.rstrip("/"))
+        self.model_root = os.environ.get('MODEL_ROOT', '/mnt/models/models')
+        self.multiplexed_models = [name.strip() for name in os.environ.get('MULTIPLEXED_MODELS', '').split(",") if name.strip()]
+        model_memory_mb = int(os.environ.get('MODEL_MEMORY_MAX_MB', '0'))
+        self.models = ModelPool(model_memory_mb * 1024 * 1024 if model_memory_mb > 0 else _memory_budget_bytes(self.device))
+        self.models.add(self._load_model(self.default_model))
+
+        # Optional cache of complete responses for deterministic requests
+        response_cache_entries = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '0'))
+        response_cache_ttl_s = float(os.environ.get('RESPONSE_CACHE_TTL_S', '300'))
+        self.response_cache = ResponseCache(response_cache_entries, response_cache_ttl_s) if response_cache_entries > 0 else None
+        self.shared_response_cache = None
+        if self.response_cache and os.environ.get('RESPONSE_CACHE_SHARED', 'false').lower() == 'true':
+            self.shared_response_cache = SharedResponseCache.options(
+                name="text-generator-response-cache",
+                lifetime="detached",
+                get_if_exists=True
+            ).remote(response_cache_entries, response_cache_ttl_s)
+
+        # Concurrent requests are grouped into one padded generate call
+        self.generate_batch.set_max_batch_size(self.max_batch_size)
+        self.generate_batch.set_batch_wait_timeout_s(float(os.environ.get('BATCH_WAIT_TIMEOUT_S', '0.05')))
+        self.utilization = ReplicaUtilization()
+        self.token_load = TokenLoad(self.utilization)
+        self.generated_tokens = 0
+        self.metrics = GenerationMetrics()
+
+        # Tokenization and generation run off the event loop with bounded concurrency
+        self.executor = InferenceExecutor(
+            max_workers=int(os.environ.get('INFERENCE_THREADS', '4')),
+            max_queued=int(os.environ.get('MAX_QUEUED_REQUESTS', '32'))
+        )
+        self.random_state = RandomStateLock()
+        logger.info(f"Model loaded successfully on {self.device}")
+
+    def _model_path(self, name: str) -> str:
+        if name == self.default_model:
+            return self.model_id
+        if name in self.multiplexed_models:
+            return os.path.join(self.model_root, name)
+        raise ValueError(f"Unknown model: {name}")
+
+    def _load_model(self, name: str) -> LoadedModel:
+        model_path = self._model_path(name)
+        logger.info(f"Loading model from {model_path} on device: {self.device}")
         
         # Load model and tokenizer from local path (S3-mounted)
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model_id, local_files_only=True)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            self.model_id,
-            torch_dtype=torch.float16 if self.device.type == "cuda" else torch.float32,
-            device_map="auto" if self.device.type == "cuda" else None,
-            local_files_only=True  # Only use local files, no HuggingFace download
+        tokenizer, model, startup_timings = load_model(
+            model_path,
+            torch_dtype=self.torch_dtype,
+            device=self.device,
+            device_map="auto" if self.device.type == "cuda" else None
         )
+        if self.quantization != "none":
+            start_time = time.time()
+            model = quantize_model(
+                model,
+                self.quantization,
+                group_size=int(os.environ.get('QUANTIZATION_GROUP_SIZE', '128'))
+            )
+            startup_timings["quantization"] = round(time.time() - start_time, 3)
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        if self.compile:
+            start_time = time.time()
+            self._warm_up(compile_model(model), tokenizer)
+            startup_timings["compile"] = round(time.time() - start_time, 3)
+        logger.info(f"Model startup timings (seconds): {startup_timings}")
+
+        # Reuse KV tensors of shared prompt prefixes such as a common system prompt; compiled
+        # models generate into a fresh StaticCache, which cannot resume from a cached prefix
+        prefix_cache_mb = int(os.environ.get('PREFIX_CACHE_MAX_MB', '256')) if not self.compile else 0
+        prefix_cache = PrefixCache(
+            prefix_cache_mb * 1024 * 1024,
+            block_size=int(os.environ.get('PREFIX_CACHE_BLOCK_SIZE', '16'))
+        ) if prefix_cache_mb > 0 else None
+        return LoadedModel(name, model_path, tokenizer, model, startup_timings, prefix_cache)
+
+    def _warm_up(self, model, tokenizer):
+        """Generates two tokens at each bucket up to COMPILE_WARMUP_MAX_LENGTH to compile the graphs.
+
+        Batches of one are compiled separately from larger ones, which all share a graph.
+        """
+        # Any token other than the padding one, so the inputs do not look right-padded
+        token_id = tokenizer.bos_token_id if tokenizer.bos_token_id not in (None, tokenizer.pad_token_id) else 0
+        for batch_size in sorted({1, min(2, self.max_batch_size)}):
+            for width in [b for b in self.compile_buckets if b <= self.compile_warmup_max_length]:
+                input_ids = torch.full((batch_size, width), token_id, dtype=torch.long, device=self.device)
+                with torch.no_grad():
+                    model.generate(
+                        input_ids=input_ids,
+                        attention_mask=torch.ones_like(input_ids),
+                        past_key_values=_static_cache(model, batch_size, _bucket(width + 2, self.compile_buckets), self.torch_dtype),
+                        max_new_tokens=2,
+                        min_new_tokens=2,
+                        do_sample=False,
+                        pad_token_id=tokenizer.eos_token_id
+                    )
+
+    async def _resident_model(self, name: str) -> LoadedModel:
+        return await self.models.get(
+            name,
+            lambda model_name: self.executor.run(self._load_model, model_name),
+            _estimate_model_bytes(self._model_path(name), self.torch_dtype)
+        )
+
+    @serve.multiplexed(max_num_models_per_replica=int(os.environ.get('MAX_MODELS_PER_REPLICA', '3')))
+    async def get_model(self, name: str) -> LoadedModel:
+        return await self._resident_model(name)
+
+    async def _select_model(self, name: str) -> LoadedModel:
+        self._model_path(name)
+        if self.multiplexed_models:
+            # Going through serve.multiplexed tells the router which models are resident here
+            model = await self.get_model(name)
+            if model.loaded:
+                return model
+        # Not multiplexed, or unloaded by the pool to stay within the memory budget since
+        return await self._resident_model(name)
+
+    def _generate(self, model: LoadedModel, prompt_ids: List[List[int]], max_new_tokens: int, temperature: float = 0.7, top_p: float = 1.0,
+                  seed: int = None, cached_len: int = 0, past_key_values=None,
+                  streamer: BaseStreamer = None) -> List[List[int]]:
+        """Generates for prompts that share the same cached_len-token prefix and returns the new token ids.
+
+        A temperature of 0 selects greedy decoding.
+        """
+        # Lay out [cached prefix | padding | rest of prompt] so every prompt ends where generation starts
+        width = max(len(ids) for ids in prompt_ids)
+        if self.compile:
+            width = _bucket(width, self.compile_buckets)
+        input_ids, attention_mask = [], []
+        for ids in prompt_ids:
+            padding = width - len(ids)
+            input_ids.append(ids[:cached_len] + [model.tokenizer.pad_token_id] * padding + ids[cached_len:])
+            attention_mask.append([1] * cached_len + [0] * padding + [1] * (len(ids) - cached_len))
+        input_ids = torch.tensor(input_ids, dtype=torch.long, device=self.device)
+        attention_mask = torch.tensor(attention_mask, dtype=torch.long, device=self.device)
+        if past_key_values is not None:
+            past_key_values = _from_legacy_cache([
+                (k.repeat(len(prompt_ids), 1, 1, 1), v.repeat(len(prompt_ids), 1, 1, 1)) for k, v in past_key_values
+            ])
+        elif self.compile:
+            past_key_values = _static_cache(
+                model.model, len(prompt_ids), _bucket(width + max_new_tokens, self.compile_buckets), self.torch_dtype
+            )
+        
+        sampling = {"do_sample": True, "temperature": temperature, "top_p": top_p} if temperature > 0 else {"do_sample": False}
+        
+        self.metrics.batch_size.observe(len(prompt_ids))
+        timer = _StepTimer(streamer)
+        with self._random_state(temperature, seed), torch.no_grad():
+            outputs = model.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                max_new_tokens=max_new_tokens,
+                num_return_sequences=1,
+                pad_token_id=model.tokenizer.eos_token_id,
+                streamer=timer,
+                return_dict_in_generate=True,
+                **sampling
+            )
+        
+        # step_times starts with the prompt, then holds one entry per generated token
+        if len(timer.step_times) > 1:
+            self.metrics.prefill.observe(timer.step_times[1] - timer.step_times[0])
+        for previous, current in zip(timer.step_times[1:], timer.step_times[2:]):
+            self.metrics.decode_token.observe(current - previous)
+        generated = outputs.sequences[:, width:].tolist()
+        eos_token_id = model.tokenizer.eos_token_id
+        num_generated = sum(ids.index(eos_token_id) + 1 if eos_token_id in ids else len(ids) for ids in generated)
+        self.metrics.generated_tokens.inc(num_generated)
+        self.generated_tokens += num_generated
+        
+        prefix_cache = model.prefix_cache
+        if prefix_cache is not None and past_key_values is None:
+            # Store the prompt part of the cache for later requests
+            cache = _to_legacy_cache(outputs.past_key_values)
+            for i, ids in enumerate(prompt_ids):
+                start = width - len(ids)
+                prefix_cache.insert(ids, [(k[i:i + 1, :, start:], v[i:i + 1, :, start:]) for k, v in cache])
+        return generated
+
+    @contextmanager
+    def _random_state(self, temperature: float, seed: Optional[int]):
+        if temperature <= 0:
+            # Greedy decoding does not touch the random state
+            yield
+        elif seed is None:
+            with self.random_state.shared():
+                yield
+        else:
+            # Seed a private copy of the random state so later unseeded requests stay random
+            with self.random_state.exclusive(), torch.random.fork_rng(devices=[] if self.device.type == "cpu" else None):
+                torch.manual_seed(seed)
+                yield
+
+    @serve.batch(max_batch_size=8, batch_wait_timeout_s=0.05)
+    async def generate_batch(self, models: List[LoadedModel], prompts: List[str], max_tokens: List[int],
+                             temperatures: List[float], top_ps: List[float], seeds: List[Optional[int]],
+                             enqueue_times: List[float]) -> List[Dict[str, Any]]:
+        return await self.executor.run(
+            self._generate_batch, models, prompts, max_tokens, temperatures, top_ps, seeds, enqueue_times,
+            requests=len(prompts)
+        )
+
+    def _generate_batch(self, models: List[LoadedModel], prompts: List[str], max_tokens: List[int],
+                        temperatures: List[float], top_ps: List[float], seeds: List[Optional[int]],
+                        enqueue_times: List[float]) -> List[Dict[str, Any]]:
+        """Returns the text, token counts and finish reason of each prompt's completion.
+
+        A prompt whose generate call failed gets the exception instead, so it does not fail
+        the other prompts of the batch.
+        """
+        start_time = time.time()
+        for enqueue_time in enqueue_times:
+            self.metrics.queue_wait.observe(start_time - enqueue_time)
+        # Tokenize the prompts of each model together
+        by_model = {}
+        for i, model in enumerate(models):
+            by_model.setdefault(model, []).append(i)
+        prompt_ids = [None] * len(prompts)
+        for model, indices in by_model.items():
+            for i, ids in zip(indices, model.tokenizer([prompts[i] for i in indices])["input_ids"]):
+                prompt_ids[i] = ids
+        self.metrics.tokenization.observe(time.time() - start_time)
+        
+        # Prompts for the same model resuming from the same cached prefix with the same sampling settings
+        # share one padded generate call; seeded prompts run alone so their output does not depend on the batch
+        groups = {}
+        for i, ids in enumerate(prompt_ids):
+            model = models[i]
+            cached_len, past_key_values = model.prefix_cache.lookup(ids) if model.prefix_cache else (0, None)
+            key = (model, tuple(ids[:cached_len]), temperatures[i], top_ps[i], i if seeds[i] is not None else None)
+            groups.setdefault(key, (past_key_values, []))[1].append(i)
         
-        if self.tokenizer.pad_token is None:
-            self.tokenizer.pad_token = self.tokenizer.eos_token
+        # Generate each group up to its longest requested completion, then split per request
+        completions = [None] * len(prompts)
+        for (model, prefix, temperature, top_p, _), (past_key_values, indices) in groups.items():
+            try:
+                outputs = self._generate(
+                    model,
+                    [prompt_ids[i] for i in indices],
+                    max(max_tokens[i] for i in indices),
+                    temperature=temperature,
+                    top_p=top_p,
+                    seed=seeds[indices[0]],
+                    cached_len=len(prefix),
+                    past_key_values=past_key_values
+                )
+            except Exception as e:
+                logger.error(f"Generation failed for {len(indices)} of {len(prompts)} batched prompts: {str(e)}")
+                for i in indices:
+                    completions[i] = e
+                continue
+            eos_token_id = model.tokenizer.eos_token_id
+            for i, output_ids in zip(indices, outputs):
+                output_ids = output_ids[:max_tokens[i]]
+                finish_reason = "length"
+                if eos_token_id in output_ids:
+                    output_ids = output_ids[:output_ids.index(eos_token_id)]
+                    finish_reason = "stop"
+                completions[i] = {
+                    "text": model.tokenizer.decode(output_ids, skip_special_tokens=True).strip(),
+                    "prompt_tokens": len(prompt_ids[i]),
+                    "completion_tokens": len(output_ids),
+                    "finish_reason": finish_reason
+                }
+        return completions
+
+    def _completion_params(self, body: dict) -> Tuple[List[str], int, dict]:
+        """Parses an OpenAI completion request body, keeping OpenAI's defaults."""
+        if body.get("stream"):
+            raise ValueError("stream is not supported for completions, use /generate with stream instead")
+        if int(body.get("n") or 1) != 1:
+            raise ValueError("Only n=1 is supported")
+        prompt = body.get("prompt", "")
+        prompts = [prompt] if isinstance(prompt, str) else prompt
+        if not prompts or not isinstance(prompts, list) or not all(isinstance(p, str) for p in prompts):
+            raise ValueError("prompt must be a string or a non-empty list of strings")
+        sampling = {
+            "temperature": float(body["temperature"]) if body.get("temperature") is not None else 1.0,
+            "top_p": float(body["top_p"]) if body.get("top_p") is not None else 1.0,
+            "seed": int(body["seed"]) if body.get("seed") is not None else None
+        }
+        max_tokens = int(body.get("max_tokens") or 16)
+        # Raised here, a bad value becomes this body's error instead of failing its whole batch
+        _check_generation_params(max_tokens, sampling["top_p"])
+        return prompts, max_tokens, sampling
+
+    def _complete(self, model: LoadedModel, bodies: List[dict], enqueue_time: float) -> List[dict]:
+        """Answers OpenAI completion request bodies for one model, MAX_BATCH_SIZE prompts per generate call."""
+        rows, num_prompts = [], []
+        for body in bodies:
+            prompts, max_tokens, sampling = self._completion_params(body)
+            rows.extend((prompt, max_tokens, sampling) for prompt in prompts)
+            num_prompts.append(len(prompts))
+        completions = []
+        for start in range(0, len(rows), self.max_batch_size):
+            chunk = rows[start:start + self.max_batch_size]
+            completions.extend(self._generate_batch(
+                [model] * len(chunk),
+                [prompt for prompt, _, _ in chunk],
+                [max_tokens for _, max_tokens, _ in chunk],
+                [sampling["temperature"] for _, _, sampling in chunk],
+                [sampling["top_p"] for _, _, sampling in chunk],
+                [sampling["seed"] for _, _, sampling in chunk],
+                [enqueue_time] * len(chunk)
+            ))
+
+        responses = []
+        for count in num_prompts:
+            choices, completions = completions[:count], completions[count:]
+            failed = next((c for c in choices if isinstance(c, Exception)), None)
+            if failed is not None:
+                responses.append({"error": {"message": str(failed), "type": "server_error"}})
+                continue
+            responses.append({
+                "id": f"cmpl-{uuid.uuid4().hex}",
+                "object": "text_completion",
+                "created": int(time.time()),
+                "model": model.name,
+                "choices": [
+                    {"text": c["text"], "index": i, "logprobs": None, "finish_reason": c["finish_reason"]}
+                    for i, c in enumerate(choices)
+                ],
+                "usage": {
+                    "prompt_tokens": sum(c["prompt_tokens"] for c in choices),
+                    "completion_tokens": sum(c["completion_tokens"] for c in choices),
+                    "total_tokens": sum(c["prompt_tokens"] + c["completion_tokens"] for c in choices)
+                }
+            })
+        return responses
+
+    def complete(self, bodies: List[dict]) -> List[dict]:
+        """Answers OpenAI completion request bodies on the calling thread, outside Ray Serve.
+
+        Used by batch_completions.py to run this deployment's model code in Ray Data actors.
+        A body that cannot be answered gets an OpenAI error object instead.
+        """
+        responses = [None] * len(bodies)
+        by_model = {}
+        for i, body in enumerate(bodies):
+            by_model.setdefault(body.get("model") or self.default_model, []).append(i)
+        for name, indices in by_model.items():
+            try:
+                model = self.models.load(
+                    name, self._load_model, _estimate_model_bytes(self._model_path(name), self.torch_dtype)
+                )
+            except Exception as e:
+                for i in indices:
+                    responses[i] = {"error": {"message": str(e), "type": "invalid_request_error"}}
+                continue
+            for i in indices:
+                # Validate first so the valid bodies are still generated together
+                try:
+                    self._completion_params(bodies[i])
+                except (ValueError, TypeError) as e:
+                    responses[i] = {"error": {"message": str(e), "type": "invalid_request_error"}}
+            valid = [i for i in indices if responses[i] is None]
+            with model.use():
+                completed = self._complete(model, [bodies[i] for i in valid], time.time())
+            for i, response in zip(valid, completed):
+                responses[i] = response
+        return responses
+
+    def _tokenize(self, model: LoadedModel, prompt: str) -> List[int]:
+        return model.tokenizer(prompt)["input_ids"]
+
+    def _generate_streaming(self, model: LoadedModel, prompt_ids: List[int], max_tokens: int, sampling: dict,
+                            streamer: _TokenStreamer, enqueue_time: float):
+        try:
+            self.metrics.queue_wait.observe(time.time() - enqueue_time)
+            cached_len, past_key_values = model.prefix_cache.lookup(prompt_ids) if model.prefix_cache else (0, None)
+            self._generate(
+                model,
+                [prompt_ids],
+                max_tokens,
+                cached_len=cached_len,
+                past_key_values=past_key_values,
+                streamer=streamer,
+                **sampling
+            )
+        finally:
+            # Unblock the reader even if generate() failed before finishing the stream
+            streamer.end()
+
+    async def _stream(self, name: str, prompt: str, max_tokens: int, sampling: dict):
+        start_time = time.time()
+        time_to_first_token = None
+        chunks = []
+        self.token_load.add(max_tokens)
+        try:
+            model = await self._select_model(name)
+            with model.use():
+                streamer = _TokenStreamer(asyncio.get_running_loop())
+                prompt_ids = await self.executor.run(self._tokenize, model, prompt)
+                self.metrics.tokenization.observe(time.time() - start_time)
+                detokenizer = IncrementalDetokenizer(model.tokenizer, prompt_ids)
+                generation = asyncio.ensure_future(self.executor.run(
+                    self._generate_streaming, model, prompt_ids, max_tokens, sampling, streamer, time.time(), requests=1
+                ))
             
-        self.max_length = max_length
-        logger.info(f"Model loaded successfully on {self.device}")
+                # Stream Server-Sent Events as tokens arrive
+                while True:
+                    token_ids = await streamer.queue.get()
+                    if token_ids is None:
+                        break
+                    if time_to_first_token is None:
+                        time_to_first_token = time.time() - start_time
+                    text = detokenizer.add(token_ids)
+                    if text:
+                        chunks.append(text)
+                        yield f"data: {json.dumps({'text': text})}\n\n"
+                await generation
+                text = detokenizer.add([], final=True)
+                if text:
+                    chunks.append(text)
+                    yield f"data: {json.dumps({'text': text})}\n\n"
+            
+                inference_time = time.time() - start_time
+            
+                # Final event carries the same fields as a non-streaming response
+                yield "data: " + json.dumps({
+                    "prompt": prompt,
+                    "generated_text": "".join(chunks).strip(),
+                    "inference_time_seconds": round(inference_time, 3),
+                    "time_to_first_token_seconds": round(time_to_first_token or inference_time, 3),
+                    "device_used": str(self.device),
+                    "gpu_available": torch.cuda.is_available(),
+                    "model_device": str(next(model.model.parameters()).device),
+                    "model_path": model.model_path
+                }) + "\n\n"
+            
+        except Exception as e:
+            logger.error(f"Error during streaming inference: {str(e)}")
+            self.metrics.errors.inc(tags={"path": "stream"})
+            yield "data: " + json.dumps({
+                "error": str(e),
+                "device_used": str(self.device),
+                "gpu_available": torch.cuda.is_available(),
+                "model_path": self.model_id
+            }) + "\n\n"
+        finally:
+            self.token_load.remove(max_tokens)
+        yield "data: [DONE]\n\n"
+
+    def _response_cache_key(self, model_path: str, prompt: str, max_tokens: int, sampling: dict) -> str:
+        key = json.dumps([prompt, max_tokens, sampling["temperature"], sampling["top_p"], sampling["seed"], model_path])
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    async def _get_cached_response(self, key: str) -> Optional[str]:
+        generated_text = self.response_cache.get(key)
+        if generated_text is None and self.shared_response_cache is not None:
+            try:
+                generated_text = await self.shared_response_cache.get.remote(key)
+            except Exception as e:
+                logger.warning(f"Shared response cache lookup failed: {str(e)}")
+            if generated_text is not None:
+                self.response_cache.put(key, generated_text)
+        return generated_text
+
+    def _put_cached_response(self, key: str, generated_text: str):
+        self.response_cache.put(key, generated_text)
+        if self.shared_response_cache is not None:
+            # Fire and forget; the shared tier is best effort
+            self.shared_response_cache.put.remote(key, generated_text)
+
+    def record_autoscaling_stats(self) -> Dict[str, float]:
+        # Custom metrics for token_throughput_autoscaling_policy, polled by Ray Serve
+        return self.token_load.stats(self.generated_tokens)
+
+    def stats(self):
+        default = self.models.entries.get(self.default_model)
+        return {
+            "model_path": self.model_id,
+            "quantization": self.quantization,
+            "dtype": str(self.torch_dtype).replace("torch.", ""),
+            "compiled": self.compile,
+            "num_threads": torch.get_num_threads(),
+            "placement": self.placement.stats() if self.placement else None,
+            "startup_timings": default.startup_timings if default else None,
+            "prefix_cache": default.prefix_cache.stats() if default and default.prefix_cache else None,
+            "models": self.models.stats(),
+            "response_cache": self.response_cache.stats() if self.response_cache else None,
+            "executor": self.executor.stats(),
+            "utilization": self.utilization.stats()
+        }
+
+    async def _completions(self, data: dict):
+        """OpenAI-compatible completions; a list prompt is generated as one batch."""
+        try:
+            prompts, max_tokens, _ = self._completion_params(data)
+        except (ValueError, TypeError) as e:
+            return JSONResponse({"error": {"message": str(e), "type": "invalid_request_error"}}, status_code=400)
+        name = serve.get_multiplexed_model_id() or data.get("model") or self.default_model
+        self.executor.check()
+        with self.utilization, self.token_load.reserve(max_tokens * len(prompts)):
+            with self.executor.admit(len(prompts)):
+                model = await self._select_model(name)
+                with model.use():
+                    responses = await self.executor.run(
+                        self._complete, model, [data], time.time(), requests=len(prompts)
+                    )
+        if "error" in responses[0]:
+            return JSONResponse(responses[0], status_code=500)
+        return responses[0]
 
     async def __call__(self, request):
         try:
+            if request.method == "GET" and request.url.path.rstrip("/").endswith("/stats"):
+                return self.stats()
+            
             data = await request.json()
+            if request.url.path.rstrip("/").endswith("/v1/completions"):
+                return await self._completions(data)
             prompt = data.get("prompt", "Hello, how are you?")
-            max_tokens = int(data.get("max_tokens", self.max_length))
-            
-            start_time = time.time()
+            try:
+                max_tokens = int(data.get("max_tokens", self.max_length))
+                sampling = {
+                    "temperature": float(data.get("temperature", 0.7)),
+                    "top_p": float(data.get("top_p", 1.0)),
+                    "seed": int(data["seed"]) if data.get("seed") is not None else None
+                }
+                _check_generation_params(max_tokens, sampling["top_p"])
+            except (ValueError, TypeError) as e:
+                # Rejected before batching, where a failing request would take its batch down with it
+                return JSONResponse({"error": str(e), "model_path": self.model_id}, status_code=400)
+            # The serve_multiplexed_model_id header also routes to replicas that have the model loaded
+            name = serve.get_multiplexed_model_id() or data.get("model") or self.default_model
+            model_path = self._model_path(name)
             
-            # Tokenize input
-            inputs = self.tokenizer.encode(prompt, return_tensors="pt").to(self.device)
-            
-            # Generate response
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    inputs,
-                    max_length=inputs.shape[1] + max_tokens,
-                    num_return_sequences=1,
-                    temperature=0.7,
-                    do_sample=True,
-                    pad_token_id=self.tokenizer.eos_token_id
+            if data.get("stream", False):
+                return StreamingResponse(
+                    self.utilization.track(self.executor.track(self._stream(name, prompt, max_tokens, sampling))),
+                    media_type="text/event-stream"
                 )
             
-            # Decode response
-            response_text = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            # Extract only the generated part (after the input tokens)
-            input_length = inputs.shape[1]
-            generated_tokens = outputs[0][input_length:]
-            generated_text = self.tokenizer.decode(generated_tokens, skip_special_tokens=True).strip()
+            start_time = time.time()
+            
+            # Only greedy or seeded requests are reproducible enough to answer from cache
+            cache_key = None
+            if self.response_cache and (sampling["temperature"] == 0 or sampling["seed"] is not None):
+                cache_key = self._response_cache_key(model_path, prompt, max_tokens, sampling)
+            model_device = None
+            with self.utilization, self.token_load.reserve(max_tokens):
+                generated_text = await self._get_cached_response(cache_key) if cache_key else None
+                
+                if generated_text is None:
+                    self.executor.check()
+                    with self.executor.admit():
+                        model = await self._select_model(name)
+                        with model.use():
+                            model_device = str(next(model.model.parameters()).device)
+                            completion = await self.generate_batch(
+                                model, prompt, max_tokens, sampling["temperature"], sampling["top_p"], sampling["seed"],
+                                time.time()
+                            )
+                            if isinstance(completion, Exception):
+                                raise completion
+                            generated_text = completion["text"]
+                    if cache_key:
+                        self._put_cached_response(cache_key, generated_text)
             
             inference_time = time.time() - start_time
             
@@ -68,12 +1732,20 @@ class TextGenerator:
                 "inference_time_seconds": round(inference_time, 3),
                 "device_used": str(self.device),
                 "gpu_available": torch.cuda.is_available(),
-                "model_device": str(next(self.model.parameters()).device),
-                "model_path": self.model_id
+                "model_device": model_device or str(self.device),
+                "model_path": model_path
             }
             
+        except Overloaded as e:
+            self.metrics.rejected.inc()
+            return JSONResponse(
+                {"error": str(e), "model_path": self.model_id},
+                status_code=429,
+                headers={"Retry-After": str(e.retry_after_s)}
+            )
         except Exception as e:
             logger.error(f"Error during inference: {str(e)}")
+            self.metrics.errors.inc(tags={"path": "generate"})
             return {
                 "error": str(e),
                 "device_used": str(self.device),
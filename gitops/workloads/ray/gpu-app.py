@@ -1,15 +1,939 @@
 import os
 import time
+import asyncio
+import json
 import logging
+import math
+import queue
+import shutil
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+from filelock import FileLock
 from ray import serve
+from ray.serve import metrics
+from ray.serve.autoscaling_policy import replica_queue_length_autoscaling_policy
+from ray.serve.config import AutoscalingConfig
+from starlette.responses import JSONResponse, StreamingResponse
 from transformers import AutoTokenizer, AutoModelForCausalLM
 import torch
+import torch.nn.functional as F
+
+try:
+    from transformers import DynamicCache
+except ImportError:  # transformers < 4.36 only understands tuple caches
+    DynamicCache = None
 
 logger = logging.getLogger(__name__)
 
+
+def _model_files(model_dir: str) -> List[str]:
+    files = sorted(f for f in os.listdir(model_dir) if os.path.isfile(os.path.join(model_dir, f)))
+    # Skip duplicate weights in other formats when safetensors shards are present
+    if any(f.endswith(".safetensors") for f in files):
+        files = [f for f in files if not f.endswith((".bin", ".pth", ".pt", ".h5", ".msgpack", ".onnx"))]
+    return [os.path.join(model_dir, f) for f in files]
+
+
+def _transfer(paths: List[str], threads: int, target_dir: str = None, chunk_size: int = 64 << 20) -> int:
+    """Reads files as parallel byte ranges, also writing them to target_dir when given."""
+    jobs = []
+    for path in paths:
+        size = os.path.getsize(path)
+        if target_dir:
+            with open(os.path.join(target_dir, os.path.basename(path)), "wb") as f:
+                f.truncate(size)
+        jobs.extend((path, offset, min(chunk_size, size - offset)) for offset in range(0, size, chunk_size))
+
+    def _run(job):
+        path, offset, length = job
+        src = os.open(path, os.O_RDONLY)
+        dst = os.open(os.path.join(target_dir, os.path.basename(path)), os.O_WRONLY) if target_dir else None
+        try:
+            done = 0
+            while done < length:
+                data = os.pread(src, min(16 << 20, length - done), offset + done)
+                if not data:
+                    break
+                if dst is not None:
+                    os.pwrite(dst, data, offset + done)
+                done += len(data)
+            return done
+        finally:
+            os.close(src)
+            if dst is not None:
+                os.close(dst)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return sum(pool.map(_run, jobs))
+
+
+def stage_model(model_dir: str, stage_root: str, threads: int) -> str:
+    """Copies model files to node-local disk once; later replicas on the node reuse the copy."""
+    target = os.path.join(stage_root, model_dir.strip("/").replace("/", "--"))
+    os.makedirs(stage_root, exist_ok=True)
+    with FileLock(target + ".lock"):
+        if not os.path.exists(os.path.join(target, ".staged")):
+            partial = target + ".partial"
+            shutil.rmtree(partial, ignore_errors=True)
+            shutil.rmtree(target, ignore_errors=True)
+            os.makedirs(partial)
+            _transfer(_model_files(model_dir), threads, target_dir=partial)
+            open(os.path.join(partial, ".staged"), "w").close()
+            os.rename(partial, target)
+    return target
+
+
+def load_model(model_id: str, torch_dtype, device: torch.device, device_map=None):
+    """Loads tokenizer and model from the S3 mount and returns them with per-phase timings.
+
+    from_pretrained memory-maps the safetensors shards and reads the weights it needs.
+    With MODEL_STAGE_DIR set, files are first copied to node-local disk in parallel
+    ranges, so replicas on the same node share one copy and its page cache, and the
+    staged shards are read into the page cache before loading. The S3 mount itself is
+    not prefetched: Mountpoint reads bypass the page cache, so they would be read twice.
+    """
+    threads = int(os.environ.get('MODEL_LOAD_THREADS', '8'))
+    timings = {}
+    model_dir = model_id
+
+    start = time.time()
+    stage_root = os.environ.get('MODEL_STAGE_DIR', '')
+    if stage_root:
+        model_dir = stage_model(model_id, stage_root, threads)
+        timings["stage"] = round(time.time() - start, 3)
+
+    start = time.time()
+    if stage_root and os.environ.get('MODEL_PREFETCH', 'true').lower() == 'true':
+        shards = [path for path in _model_files(model_dir) if path.endswith(".safetensors")]
+        _transfer(shards, threads)
+        timings["prefetch"] = round(time.time() - start, 3)
+
+    start = time.time()
+    tokenizer = AutoTokenizer.from_pretrained(model_dir, local_files_only=True)
+    timings["tokenizer"] = round(time.time() - start, 3)
+
+    # Weights are memory-mapped and assigned directly instead of initialising random weights first
+    start = time.time()
+    model = AutoModelForCausalLM.from_pretrained(
+        model_dir,
+        torch_dtype=torch_dtype,
+        device_map=device_map,
+        low_cpu_mem_usage=True,
+        local_files_only=True  # Only use local files, no HuggingFace download
+    )
+    timings["weights"] = round(time.time() - start, 3)
+
+    # With a device_map, accelerate already placed the weights while loading
+    start = time.time()
+    if device_map is None:
+        model = model.to(device)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    timings["placement"] = round(time.time() - start, 3)
+
+    return tokenizer, model, timings
+
+
+def _to_legacy_cache(past_key_values):
+    # Work on (key, value) tensors of shape [batch, heads, seq, head_dim] per layer
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def _from_legacy_cache(past_key_values):
+    if DynamicCache is not None:
+        return DynamicCache.from_legacy_cache(tuple(past_key_values))
+    return tuple(past_key_values)
+
+
+def _concat_left_padded(past_key_values, new_past_key_values, length: int):
+    """Left-pads two legacy caches to length and stacks them along the batch dimension."""
+    merged = []
+    for (old_k, old_v), (new_k, new_v) in zip(past_key_values, new_past_key_values):
+        merged.append((
+            torch.cat([F.pad(old_k, (0, 0, length - old_k.shape[2], 0)), F.pad(new_k, (0, 0, length - new_k.shape[2], 0))]),
+            torch.cat([F.pad(old_v, (0, 0, length - old_v.shape[2], 0)), F.pad(new_v, (0, 0, length - new_v.shape[2], 0))])
+        ))
+    return merged
+
+
+def _select_columns(past_key_values, index):
+    """Gathers per-row sequence positions (index is [batch, length]) from a legacy cache."""
+    selected = []
+    for k, v in past_key_values:
+        expanded = index[:, None, :, None].expand(-1, k.shape[1], -1, k.shape[3])
+        selected.append((k.gather(2, expanded), v.gather(2, expanded)))
+    return selected
+
+
+def _cache_bytes(past_key_values) -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in past_key_values)
+
+
+class PrefixCache:
+    """LRU cache of prompt KV tensors keyed by token-id prefix and bounded by a byte budget.
+
+    Prefixes are matched in blocks of block_size tokens. A prompt that misses is stored
+    whole; when a later prompt only shares the start of a stored one, that shared part
+    (typically a common system prompt) is stored as its own entry.
+    """
+
+    def __init__(self, max_bytes: int, block_size: int = 16):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.lookup_tokens = 0
+
+    def lookup(self, input_ids: List[int]) -> Tuple[int, Optional[list]]:
+        """Returns the length and (key, value) tensors of the longest cached prefix of input_ids."""
+        # Always leave at least one prompt token to compute the next-token logits
+        limit = len(input_ids) - 1
+        key = tuple(input_ids)
+        with self.lock:
+            self.lookup_tokens += len(input_ids)
+            best_key, best_len = None, 0
+            for entry_key in self.entries:
+                length = 0
+                while (length + self.block_size <= min(limit, len(entry_key))
+                       and entry_key[length:length + self.block_size] == key[length:length + self.block_size]):
+                    length += self.block_size
+                # Prefer the shortest entry on ties so shared preambles win over full prompts
+                if length > best_len or (length == best_len and length and len(entry_key) < len(best_key)):
+                    best_key, best_len = entry_key, length
+            if best_key is None:
+                self.misses += 1
+                return 0, None
+            self.hits += 1
+            self.hit_tokens += best_len
+            self.entries.move_to_end(best_key)
+            past_key_values = [(k[:, :, :best_len], v[:, :, :best_len]) for k, v in self.entries[best_key]]
+        if best_len < len(best_key):
+            self.insert(input_ids[:best_len], past_key_values)
+        return best_len, past_key_values
+
+    def insert(self, input_ids: List[int], past_key_values):
+        """Stores single-sequence KV tensors for input_ids, cropped to a block boundary."""
+        length = len(input_ids) - len(input_ids) % self.block_size
+        key = tuple(input_ids[:length])
+        if length == 0:
+            return
+        # Copy so the entry does not keep a larger batch tensor alive
+        entry = [(k[:, :, :length].clone(), v[:, :, :length].clone()) for k, v in past_key_values]
+        size = _cache_bytes(entry)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = entry
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= _cache_bytes(evicted)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / max(self.hits + self.misses, 1), 4),
+                "token_hit_rate": round(self.hit_tokens / max(self.lookup_tokens, 1), 4)
+            }
+
+
+class IncrementalDetokenizer:
+    """Turns a growing list of token ids into text deltas.
+
+    Only a short window of recent tokens is decoded per step, and text is held back
+    while it ends in an incomplete multi-byte character.
+    """
+
+    def __init__(self, tokenizer, prompt_ids: List[int] = None):
+        self.tokenizer = tokenizer
+        # Seed with the prompt tail so leading spaces of the first generated token survive decoding
+        self.token_ids = list(prompt_ids[-5:]) if prompt_ids else []
+        self.prefix_offset = 0
+        self.read_offset = len(self.token_ids)
+
+    def add(self, token_ids: List[int], final: bool = False) -> str:
+        self.token_ids.extend(token_ids)
+        prefix_text = self.tokenizer.decode(self.token_ids[self.prefix_offset:self.read_offset], skip_special_tokens=True)
+        new_text = self.tokenizer.decode(self.token_ids[self.prefix_offset:], skip_special_tokens=True)
+        if len(new_text) <= len(prefix_text) or (new_text.endswith("\ufffd") and not final):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+
+class _Sequence:
+    """A request tracked by the engine from admission until it is retired."""
+
+    def __init__(self, input_ids: List[int], max_new_tokens: int, loop, future, stream: asyncio.Queue = None):
+        self.input_ids = input_ids
+        self.max_new_tokens = max_new_tokens
+        self.output_ids = []
+        self.loop = loop
+        self.future = future
+        self.stream = stream
+        self.enqueue_time = time.time()
+
+    def emit(self, token: int):
+        if self.stream is not None:
+            self.loop.call_soon_threadsafe(self.stream.put_nowait, token)
+
+    def finish(self, result=None, error=None):
+        def _resolve():
+            if self.future.done():
+                return
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result(result)
+            if self.stream is not None:
+                self.stream.put_nowait(None)
+        self.loop.call_soon_threadsafe(_resolve)
+
+
+class GenerationMetrics:
+    """Per-replica generation metrics exported through Ray's metrics API.
+
+    Ray Serve tags every series with the deployment, replica and application, and
+    Prometheus scrapes them from the Ray metrics export port of each node.
+    """
+
+    LATENCY_BOUNDARIES = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+    TOKEN_LATENCY_BOUNDARIES = [0.001, 0.0025, 0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.2, 0.5, 1]
+    BATCH_SIZE_BOUNDARIES = [1, 2, 4, 8, 16, 32, 64]
+
+    def __init__(self):
+        self.queue_wait = metrics.Histogram(
+            "text_generation_queue_wait_seconds",
+            description="Time a request waits before its batch starts generating",
+            boundaries=self.LATENCY_BOUNDARIES
+        )
+        self.tokenization = metrics.Histogram(
+            "text_generation_tokenization_seconds",
+            description="Time spent tokenizing prompts per tokenizer call",
+            boundaries=self.LATENCY_BOUNDARIES
+        )
+        self.prefill = metrics.Histogram(
+            "text_generation_prefill_seconds",
+            description="Time to run the prompt forward pass and produce the first token",
+            boundaries=self.LATENCY_BOUNDARIES
+        )
+        self.decode_token = metrics.Histogram(
+            "text_generation_decode_token_seconds",
+            description="Decode time per generated token of a sequence; a speculative step is divided by the tokens it accepted",
+            boundaries=self.TOKEN_LATENCY_BOUNDARIES
+        )
+        self.generated_tokens = metrics.Counter(
+            "text_generation_generated_tokens",
+            description="Number of generated tokens"
+        )
+        self.batch_size = metrics.Histogram(
+            "text_generation_batch_size",
+            description="Number of sequences generated together",
+            boundaries=self.BATCH_SIZE_BOUNDARIES
+        )
+        self.errors = metrics.Counter(
+            "text_generation_errors",
+            description="Number of failed generation requests",
+            tag_keys=("path",)
+        )
+        self.speculative_proposed = metrics.Counter(
+            "text_generation_speculative_proposed_tokens",
+            description="Draft tokens proposed for verification by the main model"
+        )
+        self.speculative_accepted = metrics.Counter(
+            "text_generation_speculative_accepted_tokens",
+            description="Draft tokens accepted by the main model"
+        )
+
+
+class ContinuousBatchingEngine:
+    """Iteration-level scheduler that decodes all running sequences one token per step.
+
+    New requests are prefilled and merged into the running batch between decode
+    steps, and finished ones are dropped, so short prompts never wait behind long
+    generations. The running KV cache is left-padded to a common length and the
+    attention mask hides the padding.
+
+    With a draft model, each step is speculative: the draft proposes
+    num_speculative_tokens tokens per sequence, the main model scores them all in
+    one forward pass, and rejection sampling keeps the accepted prefix plus one
+    corrected token, so outputs follow the main model's distribution. The draft
+    keeps its own cache with the same column layout; rejected positions stay in
+    both caches as masked holes until they are compacted away.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int = 16, temperature: float = 0.7, top_p: float = 0.9,
+                 prefix_cache: PrefixCache = None, metrics: GenerationMetrics = None,
+                 draft_model=None, num_speculative_tokens: int = 4):
+        self.model = model
+        self.device = model.device
+        self.eos_token_id = tokenizer.eos_token_id
+        self.pad_token_id = tokenizer.pad_token_id
+        self.max_batch_size = max_batch_size
+        self.temperature = temperature
+        self.top_p = top_p
+        self.prefix_cache = prefix_cache
+        self.metrics = metrics or GenerationMetrics()
+        self.generated_tokens = 0
+        self.draft_model = draft_model
+        self.num_speculative_tokens = num_speculative_tokens
+        self.speculative_steps = 0
+        self.speculative_proposed = 0
+        self.speculative_accepted = 0
+
+        self.waiting = queue.Queue()
+        self.running = []
+        self.past_key_values = None
+        self.draft_past_key_values = None
+        self.attention_mask = None
+        self.next_tokens = None
+
+        self._thread = threading.Thread(target=self._run, name="continuous-batching", daemon=True)
+        self._thread.start()
+
+    async def generate(self, input_ids: List[int], max_new_tokens: int) -> List[int]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.waiting.put(_Sequence(input_ids, max_new_tokens, loop, future))
+        return await future
+
+    async def stream(self, input_ids: List[int], max_new_tokens: int):
+        """Yields token ids as soon as each decode step produces them."""
+        loop = asyncio.get_running_loop()
+        seq = _Sequence(input_ids, max_new_tokens, loop, loop.create_future(), stream=asyncio.Queue())
+        self.waiting.put(seq)
+        try:
+            while True:
+                token = await seq.stream.get()
+                if token is None:
+                    break
+                yield token
+            # Surface engine errors to the caller
+            await seq.future
+        finally:
+            # A disconnected client cancels the future so the engine retires the sequence
+            seq.future.cancel()
+
+    def _run(self):
+        while True:
+            admitted = self._take_waiting()
+            try:
+                with torch.no_grad():
+                    if admitted:
+                        start_time = time.perf_counter()
+                        self._prefill(admitted)
+                        self.metrics.prefill.observe(time.perf_counter() - start_time)
+                    if self.running:
+                        num_sequences = len(self.running)
+                        self.metrics.batch_size.observe(num_sequences)
+                        start_time, start_tokens = time.perf_counter(), self.generated_tokens
+                        if self.draft_model is not None:
+                            self._speculative_step()
+                        else:
+                            self._decode_step()
+                        # A speculative step emits up to SPECULATIVE_TOKENS + 1 tokens per sequence
+                        tokens_per_sequence = (self.generated_tokens - start_tokens) / num_sequences
+                        if tokens_per_sequence:
+                            self.metrics.decode_token.observe((time.perf_counter() - start_time) / tokens_per_sequence)
+            except Exception as e:
+                logger.error(f"Error in batching engine: {str(e)}")
+                for seq in self.running + admitted:
+                    seq.finish(error=e)
+                self._reset()
+
+    def _take_waiting(self) -> List[_Sequence]:
+        admitted = []
+        if not self.running:
+            # Idle: block until the next request arrives
+            admitted.append(self.waiting.get())
+        while len(self.running) + len(admitted) < self.max_batch_size:
+            try:
+                admitted.append(self.waiting.get_nowait())
+            except queue.Empty:
+                break
+        now = time.time()
+        for seq in admitted:
+            self.metrics.queue_wait.observe(now - seq.enqueue_time)
+        return admitted
+
+    def _reset(self):
+        self.running = []
+        self.past_key_values = None
+        self.draft_past_key_values = None
+        self.attention_mask = None
+        self.next_tokens = None
+
+    def _prefill(self, seqs: List[_Sequence]):
+        fresh = []
+        for seq in seqs:
+            cached_len, past_key_values = self.prefix_cache.lookup(seq.input_ids) if self.prefix_cache else (0, None)
+            if past_key_values is None:
+                fresh.append(seq)
+                continue
+            # Resume from the cached prefix and only compute the remaining prompt tokens
+            self._forward_prefill(
+                [seq],
+                torch.tensor([seq.input_ids[cached_len:]], dtype=torch.long, device=self.device),
+                torch.ones((1, len(seq.input_ids)), dtype=torch.long, device=self.device),
+                torch.arange(cached_len, len(seq.input_ids), device=self.device)[None],
+                past_key_values
+            )
+        if not fresh:
+            return
+
+        # Left-pad the new prompts so their last tokens line up
+        width = max(len(seq.input_ids) for seq in fresh)
+        input_ids = torch.full((len(fresh), width), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(fresh), width), dtype=torch.long)
+        for i, seq in enumerate(fresh):
+            input_ids[i, width - len(seq.input_ids):] = torch.tensor(seq.input_ids, dtype=torch.long)
+            attention_mask[i, width - len(seq.input_ids):] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        self._forward_prefill(fresh, input_ids, attention_mask, position_ids)
+
+    def _forward_prefill(self, seqs: List[_Sequence], input_ids, attention_mask, position_ids, past_key_values=None):
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=_from_legacy_cache(past_key_values) if past_key_values is not None else None,
+            use_cache=True
+        )
+        past_key_values = _to_legacy_cache(outputs.past_key_values)
+        if self.prefix_cache is not None and input_ids.shape[1] == attention_mask.shape[1]:
+            # Full prompts were computed, store them for later requests
+            width = attention_mask.shape[1]
+            for i, seq in enumerate(seqs):
+                start = width - len(seq.input_ids)
+                self.prefix_cache.insert(seq.input_ids, [(k[i:i + 1, :, start:], v[i:i + 1, :, start:]) for k, v in past_key_values])
+        draft_past_key_values = self._draft_prefill(seqs, attention_mask) if self.draft_model is not None else None
+        self._merge(seqs, past_key_values, attention_mask, draft_past_key_values)
+        self._append_tokens(self._sample(outputs.logits[:, -1, :]), offset=len(self.running) - len(seqs))
+
+    def _draft_prefill(self, seqs: List[_Sequence], attention_mask):
+        """Computes the draft cache for whole prompts, laid out like the main model's columns."""
+        width = attention_mask.shape[1]
+        input_ids = torch.full((len(seqs), width), self.pad_token_id, dtype=torch.long)
+        for i, seq in enumerate(seqs):
+            input_ids[i, width - len(seq.input_ids):] = torch.tensor(seq.input_ids, dtype=torch.long)
+        outputs = self.draft_model(
+            input_ids=input_ids.to(self.device),
+            attention_mask=attention_mask,
+            position_ids=(attention_mask.cumsum(-1) - 1).clamp(min=0),
+            use_cache=True
+        )
+        return _to_legacy_cache(outputs.past_key_values)
+
+    def _merge(self, seqs: List[_Sequence], past_key_values, attention_mask, draft_past_key_values=None):
+        if not self.running:
+            self.running = list(seqs)
+            self.past_key_values = list(past_key_values)
+            self.draft_past_key_values = list(draft_past_key_values) if draft_past_key_values is not None else None
+            self.attention_mask = attention_mask
+            return
+
+        # Pad the shorter of the running and new caches on the left to a common length
+        running_len = self.attention_mask.shape[1]
+        new_len = attention_mask.shape[1]
+        length = max(running_len, new_len)
+        self.past_key_values = _concat_left_padded(self.past_key_values, past_key_values, length)
+        if draft_past_key_values is not None:
+            self.draft_past_key_values = _concat_left_padded(self.draft_past_key_values, draft_past_key_values, length)
+        self.attention_mask = torch.cat([
+            F.pad(self.attention_mask, (length - running_len, 0)),
+            F.pad(attention_mask, (length - new_len, 0))
+        ])
+        self.running.extend(seqs)
+
+    def _decode_step(self):
+        self.attention_mask = torch.cat([
+            self.attention_mask,
+            self.attention_mask.new_ones((self.attention_mask.shape[0], 1))
+        ], dim=1)
+        position_ids = self.attention_mask.sum(-1, keepdim=True) - 1
+
+        outputs = self.model(
+            input_ids=self.next_tokens[:, None],
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+            past_key_values=_from_legacy_cache(self.past_key_values),
+            use_cache=True
+        )
+        self.past_key_values = list(_to_legacy_cache(outputs.past_key_values))
+        self._append_tokens(self._sample(outputs.logits[:, -1, :]))
+
+    def _speculative_step(self):
+        k = self.num_speculative_tokens
+        batch_size = len(self.running)
+        ones = self.attention_mask.new_ones((batch_size, 1))
+
+        # Draft k tokens one at a time, then feed the last one too so both caches gain k + 1 columns
+        draft_mask = self.attention_mask
+        draft_past_key_values = self.draft_past_key_values
+        tokens = self.next_tokens
+        draft_tokens, draft_probs = [], []
+        for step in range(k + 1):
+            draft_mask = torch.cat([draft_mask, ones], dim=1)
+            outputs = self.draft_model(
+                input_ids=tokens[:, None],
+                attention_mask=draft_mask,
+                position_ids=draft_mask.sum(-1, keepdim=True) - 1,
+                past_key_values=_from_legacy_cache(draft_past_key_values),
+                use_cache=True
+            )
+            draft_past_key_values = list(_to_legacy_cache(outputs.past_key_values))
+            if step < k:
+                probs = self._probs(outputs.logits[:, -1, :])
+                tokens = torch.multinomial(probs, 1).squeeze(-1)
+                draft_tokens.append(tokens)
+                draft_probs.append(probs)
+        draft_tokens = torch.stack(draft_tokens, dim=1)
+        draft_probs = torch.stack(draft_probs, dim=1)
+
+        # Score the pending token and all drafts in one pass of the main model
+        position_ids = (draft_mask.cumsum(-1) - 1)[:, -(k + 1):]
+        outputs = self.model(
+            input_ids=torch.cat([self.next_tokens[:, None], draft_tokens], dim=1),
+            attention_mask=draft_mask,
+            position_ids=position_ids,
+            past_key_values=_from_legacy_cache(self.past_key_values),
+            use_cache=True
+        )
+        probs = self._probs(outputs.logits)
+
+        # Accept draft i with probability min(1, p(x) / q(x)) until the first rejection
+        p = probs[:, :k].gather(-1, draft_tokens[..., None]).squeeze(-1)
+        q = draft_probs.gather(-1, draft_tokens[..., None]).squeeze(-1)
+        accepted = (torch.rand_like(p) < p / q).long().cumprod(dim=1).sum(dim=1)
+
+        # Resample the rejected position from max(0, p - q), or take a bonus token from p after k accepts
+        rows = torch.arange(batch_size, device=self.device)
+        residual = probs[rows, accepted] - F.pad(draft_probs, (0, 0, 0, 1))[rows, accepted]
+        residual = residual.clamp(min=0)
+        norm = residual.sum(-1, keepdim=True)
+        residual = torch.where(norm > 0, residual / norm.clamp(min=1e-12), probs[rows, accepted])
+        self.next_tokens = torch.multinomial(residual, 1).squeeze(-1)
+
+        # Rejected columns become holes hidden by the attention mask
+        self.attention_mask = torch.cat([
+            self.attention_mask,
+            (torch.arange(k + 1, device=self.device)[None] <= accepted[:, None]).long()
+        ], dim=1)
+        self.past_key_values = list(_to_legacy_cache(outputs.past_key_values))
+        self.draft_past_key_values = draft_past_key_values
+
+        num_accepted = int(accepted.sum())
+        self.speculative_steps += 1
+        self.speculative_proposed += batch_size * k
+        self.speculative_accepted += num_accepted
+        self.metrics.speculative_proposed.inc(batch_size * k)
+        if num_accepted:
+            self.metrics.speculative_accepted.inc(num_accepted)
+
+        new_tokens = [
+            draft[:n] + [token]
+            for draft, n, token in zip(draft_tokens.tolist(), accepted.tolist(), self.next_tokens.tolist())
+        ]
+        self._append_sequences(new_tokens)
+        if self.running and self.attention_mask.shape[1] > 2 * int(self.attention_mask.sum(-1).max()):
+            self._compact()
+
+    def speculative_stats(self):
+        proposed = self.speculative_proposed
+        return {
+            "draft_model": getattr(self.draft_model, "name_or_path", None),
+            "num_speculative_tokens": self.num_speculative_tokens,
+            "steps": self.speculative_steps,
+            "proposed_tokens": proposed,
+            "accepted_tokens": self.speculative_accepted,
+            "acceptance_rate": round(self.speculative_accepted / proposed, 4) if proposed else 0.0
+        }
+
+    def _compact(self):
+        """Moves every row's unmasked cache columns to the right, dropping holes and padding."""
+        lengths = self.attention_mask.sum(-1)
+        width = int(lengths.max())
+        # Sorting the mask (stable) keeps valid columns in order at the end of each row
+        order = self.attention_mask.argsort(dim=1, stable=True)[:, -width:]
+        self.past_key_values = _select_columns(self.past_key_values, order)
+        self.draft_past_key_values = _select_columns(self.draft_past_key_values, order)
+        self.attention_mask = (torch.arange(width, device=self.device)[None] >= (width - lengths)[:, None]).long()
+
+    def _probs(self, logits):
+        # Temperature plus nucleus (top-p) filtering, matching the previous generate() settings
+        probs = torch.softmax(logits.float() / self.temperature, dim=-1)
+        sorted_probs, sorted_ids = probs.sort(dim=-1, descending=True)
+        sorted_probs[(sorted_probs.cumsum(dim=-1) - sorted_probs) > self.top_p] = 0
+        probs = torch.zeros_like(probs).scatter_(-1, sorted_ids, sorted_probs)
+        return probs / probs.sum(dim=-1, keepdim=True)
+
+    def _sample(self, logits):
+        return torch.multinomial(self._probs(logits), 1).squeeze(-1)
+
+    def _append_tokens(self, tokens, offset: int = 0):
+        # Rows before offset belong to sequences that were already running and skip this step
+        if self.next_tokens is None or offset == 0:
+            self.next_tokens = tokens
+        else:
+            self.next_tokens = torch.cat([self.next_tokens[:offset], tokens])
+        self.metrics.generated_tokens.inc(len(tokens))
+        self.generated_tokens += len(tokens)
+
+        finished = []
+        for i, token in enumerate(tokens.tolist(), start=offset):
+            seq = self.running[i]
+            seq.output_ids.append(token)
+            seq.emit(token)
+            if token == self.eos_token_id or len(seq.output_ids) >= seq.max_new_tokens or seq.future.cancelled():
+                finished.append(i)
+        if finished:
+            self._retire(finished)
+
+    def _append_sequences(self, new_tokens: List[List[int]]):
+        """Appends several tokens per running sequence, stopping each at EOS or its token budget."""
+        finished = []
+        for i, (seq, tokens) in enumerate(zip(self.running, new_tokens)):
+            for token in tokens:
+                seq.output_ids.append(token)
+                seq.emit(token)
+                self.generated_tokens += 1
+                self.metrics.generated_tokens.inc()
+                if token == self.eos_token_id or len(seq.output_ids) >= seq.max_new_tokens or seq.future.cancelled():
+                    finished.append(i)
+                    break
+        if finished:
+            self._retire(finished)
+
+    def _retire(self, finished: List[int]):
+        for i in finished:
+            self.running[i].finish(result=self.running[i].output_ids)
+        keep = [i for i in range(len(self.running)) if i not in set(finished)]
+        if not keep:
+            self._reset()
+            return
+
+        index = torch.tensor(keep, device=self.device)
+        self.running = [self.running[i] for i in keep]
+        self.next_tokens = self.next_tokens.index_select(0, index)
+        self.attention_mask = self.attention_mask.index_select(0, index)
+        # Drop leading columns that are padding for every remaining sequence
+        start = int((self.attention_mask.sum(0) > 0).nonzero()[0])
+        self.attention_mask = self.attention_mask[:, start:]
+        self.past_key_values = [
+            (k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+            for k, v in self.past_key_values
+        ]
+        if self.draft_past_key_values is not None:
+            self.draft_past_key_values = [
+                (k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+                for k, v in self.draft_past_key_values
+            ]
+
+
+class ReplicaUtilization:
+    """Tracks how much of the replica's lifetime had at least one request in flight.
+
+    Used as a context manager around each request; track() does the same for
+    streamed responses, which finish after __call__ has returned.
+    """
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.busy_seconds = 0.0
+        self.busy_since = None
+        self.in_flight = 0
+        self.requests = 0
+
+    def __enter__(self):
+        if self.in_flight == 0:
+            self.busy_since = time.monotonic()
+        self.in_flight += 1
+        self.requests += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.in_flight -= 1
+        if self.in_flight == 0:
+            self.busy_seconds += time.monotonic() - self.busy_since
+            self.busy_since = None
+
+    async def track(self, events):
+        with self:
+            async for event in events:
+                yield event
+
+    def busy_time(self) -> float:
+        if self.busy_since is None:
+            return self.busy_seconds
+        return self.busy_seconds + time.monotonic() - self.busy_since
+
+    def stats(self):
+        now = time.monotonic()
+        busy_seconds = self.busy_time()
+        try:
+            replica = serve.get_replica_context().replica_tag
+        except Exception:
+            replica = None
+        return {
+            "replica": replica,
+            "uptime_seconds": round(now - self.start_time, 3),
+            "busy_seconds": round(busy_seconds, 3),
+            "utilization": round(busy_seconds / max(now - self.start_time, 1e-9), 4),
+            "in_flight": self.in_flight,
+            "requests": self.requests
+        }
+
+
+class TokenLoad:
+    """Token demand and decode throughput of a replica, reported to the autoscaler.
+
+    Outstanding tokens is the max_tokens budget of requests in flight; throughput is
+    measured per busy second so idle time does not lower the replica's capacity.
+    """
+
+    def __init__(self, utilization: ReplicaUtilization, window_s: float = 60.0):
+        self.utilization = utilization
+        self.window_s = window_s
+        self.outstanding_tokens = 0
+        self.samples = deque()
+
+    def add(self, max_tokens: int):
+        self.outstanding_tokens += max_tokens
+
+    def remove(self, max_tokens: int):
+        self.outstanding_tokens -= max_tokens
+
+    @contextmanager
+    def reserve(self, max_tokens: int):
+        self.add(max_tokens)
+        try:
+            yield
+        finally:
+            self.remove(max_tokens)
+
+    def stats(self, generated_tokens: int) -> Dict[str, float]:
+        now = time.monotonic()
+        busy_seconds = self.utilization.busy_time()
+        self.samples.append((now, generated_tokens, busy_seconds))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window_s:
+            self.samples.popleft()
+        _, first_tokens, first_busy = self.samples[0]
+        busy = busy_seconds - first_busy
+        return {
+            "ongoing_requests": float(self.utilization.in_flight),
+            "outstanding_tokens": float(self.outstanding_tokens),
+            "decode_tokens_per_s": (generated_tokens - first_tokens) / busy if busy > 0 else 0.0
+        }
+
+
+# Token-throughput autoscaling settings, read when the policy module is imported
+AUTOSCALING_TARGET_DRAIN_S = float(os.environ.get('AUTOSCALING_TARGET_DRAIN_S', '10'))
+AUTOSCALING_DEFAULT_TOKENS_PER_S = float(os.environ.get('AUTOSCALING_DEFAULT_TOKENS_PER_S', '400'))
+AUTOSCALING_WARMUP_S = float(os.environ.get('AUTOSCALING_WARMUP_S', '300'))
+# Budget assumed for queued requests before any request was seen in flight (the apps' default max_tokens)
+AUTOSCALING_DEFAULT_TOKENS_PER_REQUEST = 100
+
+
+def token_throughput_autoscaling_policy(ctx) -> Tuple[int, Dict[str, Any]]:
+    """Scales so the outstanding token budget drains within AUTOSCALING_TARGET_DRAIN_S.
+
+    Capacity per replica is the mean decode rate reported by the replicas (or
+    AUTOSCALING_DEFAULT_TOKENS_PER_S before any were measured). Requests still queued
+    in front of the replicas count with the average in-flight budget. Replicas that are
+    still loading the model count as capacity for up to AUTOSCALING_WARMUP_S, so a
+    slow start does not trigger a second scale-up. Falls back to Ray's request-based
+    policy when the replicas report no token metrics.
+    """
+    state = dict(ctx.policy_state)
+    custom_metrics = ctx.aggregated_metrics or {}
+    outstanding = custom_metrics.get("outstanding_tokens")
+    if not outstanding:
+        # Same context-based call as Serve's own; the policy is only attached on Ray Serve
+        # versions that call policies with a context (see _autoscaling_config)
+        return replica_queue_length_autoscaling_policy(ctx)
+
+    now = ctx.current_time or time.time()
+    rates = [rate for rate in custom_metrics.get("decode_tokens_per_s", {}).values() if rate > 0]
+    if rates:
+        state["tokens_per_s"] = sum(rates) / len(rates)
+    tokens_per_s = state.get("tokens_per_s", AUTOSCALING_DEFAULT_TOKENS_PER_S)
+
+    tokens = sum(outstanding.values())
+    ongoing = sum(custom_metrics.get("ongoing_requests", {}).values())
+    if ongoing > 0:
+        state["tokens_per_request"] = tokens / ongoing
+    queued = max(0.0, ctx.total_num_requests - ongoing)
+    tokens += queued * state.get("tokens_per_request", AUTOSCALING_DEFAULT_TOKENS_PER_REQUEST)
+    desired = math.ceil(tokens / (tokens_per_s * AUTOSCALING_TARGET_DRAIN_S))
+    desired = max(ctx.capacity_adjusted_min_replicas, min(ctx.capacity_adjusted_max_replicas, desired))
+
+    current = ctx.target_num_replicas
+    warming_up = ctx.current_num_replicas < current and now - state.get("scaled_up_at", 0) < AUTOSCALING_WARMUP_S
+    if desired > current and not warming_up:
+        state.pop("below_since", None)
+        state.setdefault("above_since", now)
+        if now - state["above_since"] >= ctx.config.upscale_delay_s:
+            state.pop("above_since")
+            state["scaled_up_at"] = now
+            return desired, state
+    elif desired < current and not warming_up:
+        state.pop("above_since", None)
+        state.setdefault("below_since", now)
+        if now - state["below_since"] >= ctx.config.downscale_delay_s:
+            state.pop("below_since")
+            return desired, state
+    else:
+        state.pop("above_since", None)
+        state.pop("below_since", None)
+    return current, state
+
+
+def _autoscaling_config() -> Optional[Dict[str, Any]]:
+    """Autoscaling is enabled by setting AUTOSCALING_MAX_REPLICAS."""
+    if not os.environ.get('AUTOSCALING_MAX_REPLICAS'):
+        return None
+    config = {
+        "min_replicas": int(os.environ.get('AUTOSCALING_MIN_REPLICAS', '1')),
+        "max_replicas": int(os.environ['AUTOSCALING_MAX_REPLICAS']),
+        "target_ongoing_requests": float(os.environ.get('AUTOSCALING_TARGET_ONGOING_REQUESTS', os.environ.get('MAX_BATCH_SIZE', '16'))),
+        "upscale_delay_s": float(os.environ.get('AUTOSCALING_UPSCALE_DELAY_S', '30')),
+        "downscale_delay_s": float(os.environ.get('AUTOSCALING_DOWNSCALE_DELAY_S', '300'))
+    }
+    if os.environ.get('AUTOSCALING_POLICY', 'requests') == 'token_throughput':
+        if "policy" in AutoscalingConfig.__fields__:
+            from ray.serve.config import AutoscalingPolicy
+            config["policy"] = AutoscalingPolicy(policy_function=token_throughput_autoscaling_policy)
+        else:
+            # Ray Serve only runs custom policies from 2.51 on; older versions use ongoing requests
+            logger.warning("AUTOSCALING_POLICY=token_throughput needs a newer Ray Serve, using request-based autoscaling")
+    return config
+
+
 @serve.deployment(
     name="gpu-deployment",
-    ray_actor_options={"num_gpus": 1}
+    ray_actor_options={"num_gpus": 1},
+    max_ongoing_requests=int(os.environ.get('MAX_ONGOING_REQUESTS', '32')),
+    autoscaling_config=_autoscaling_config()
 )
 class TransformersDeployment:
     def __init__(self):
@@ -20,42 +944,160 @@ class TransformersDeployment:
         logger.info(f"Loading model from {self.model_id} on device: {self.device}")
         print(f"Loading model from: {model_id}")
         
-        self.tokenizer = AutoTokenizer.from_pretrained(model_id, local_files_only=True)
-        self.model = AutoModelForCausalLM.from_pretrained(
+        self.tokenizer, self.model, self.startup_timings = load_model(
             model_id,
             torch_dtype=torch.float16,
-            device_map="auto",
-            local_files_only=True
+            device=self.device,
+            device_map="auto"
         )
+        logger.info(f"Model startup timings (seconds): {self.startup_timings}")
         
         if self.tokenizer.pad_token is None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
         
+        # Reuse KV tensors of shared prompt prefixes such as a common system prompt
+        prefix_cache_mb = int(os.environ.get('PREFIX_CACHE_MAX_MB', '1024'))
+        self.prefix_cache = PrefixCache(
+            prefix_cache_mb * 1024 * 1024,
+            block_size=int(os.environ.get('PREFIX_CACHE_BLOCK_SIZE', '16'))
+        ) if prefix_cache_mb > 0 else None
+
+        # A small draft model sharing the tokenizer proposes tokens for speculative decoding
+        self.draft_model_id = os.environ.get('DRAFT_MODEL_ID', '')
+        self.draft_model = None
+        if self.draft_model_id:
+            self.draft_model = self._load_draft_model(self.draft_model_id)
+
+        # Decode step by step, admitting and retiring sequences at every token
+        self.metrics = GenerationMetrics()
+        self.engine = ContinuousBatchingEngine(
+            self.model,
+            self.tokenizer,
+            max_batch_size=int(os.environ.get('MAX_BATCH_SIZE', '16')),
+            prefix_cache=self.prefix_cache,
+            metrics=self.metrics,
+            draft_model=self.draft_model,
+            num_speculative_tokens=int(os.environ.get('SPECULATIVE_TOKENS', '4'))
+        )
+        self.utilization = ReplicaUtilization()
+        self.token_load = TokenLoad(self.utilization)
+        
         logger.info(f"Model loaded successfully on {self.device}")
         print(f"Model loaded successfully: {model_id}")
 
+    def _load_draft_model(self, draft_model_id: str):
+        logger.info(f"Loading draft model from {draft_model_id}")
+        draft_tokenizer, draft_model, timings = load_model(
+            draft_model_id,
+            torch_dtype=torch.float16,
+            device=self.device,
+            device_map="auto"
+        )
+        logger.info(f"Draft model startup timings (seconds): {timings}")
+        if draft_model.config.vocab_size != self.model.config.vocab_size:
+            logger.warning(
+                f"Draft model vocabulary ({draft_model.config.vocab_size}) does not match the model "
+                f"({self.model.config.vocab_size}), speculative decoding is disabled"
+            )
+            return None
+        if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+            # Token ids line up but mean different things, so most drafts will be rejected
+            logger.warning("Draft model tokenizer differs from the model tokenizer, expect a low acceptance rate")
+        draft_model.eval()
+        return draft_model
+
+    async def _stream(self, prompt: str, max_tokens: int):
+        start_time = time.time()
+        time_to_first_token = None
+        chunks = []
+        self.token_load.add(max_tokens)
+        try:
+            input_ids = self.tokenizer(prompt)["input_ids"]
+            self.metrics.tokenization.observe(time.time() - start_time)
+            detokenizer = IncrementalDetokenizer(self.tokenizer, input_ids)
+            
+            # Stream Server-Sent Events as the engine produces tokens
+            async for token in self.engine.stream(input_ids, max_tokens):
+                if time_to_first_token is None:
+                    time_to_first_token = time.time() - start_time
+                text = detokenizer.add([token])
+                if text:
+                    chunks.append(text)
+                    yield f"data: {json.dumps({'text': text})}\n\n"
+            text = detokenizer.add([], final=True)
+            if text:
+                chunks.append(text)
+                yield f"data: {json.dumps({'text': text})}\n\n"
+            
+            inference_time = time.time() - start_time
+            
+            # Final event carries the same fields as a non-streaming response
+            yield "data: " + json.dumps({
+                "prompt": prompt,
+                "generated_text": "".join(chunks).strip(),
+                "inference_time_seconds": round(inference_time, 3),
+                "time_to_first_token_seconds": round(time_to_first_token or inference_time, 3),
+                "device_used": str(self.device),
+                "gpu_available": torch.cuda.is_available(),
+                "model_device": str(next(self.model.parameters()).device),
+                "model_path": self.model_id
+            }) + "\n\n"
+            
+        except Exception as e:
+            logger.error(f"Error during streaming inference: {str(e)}")
+            self.metrics.errors.inc(tags={"path": "stream"})
+            yield "data: " + json.dumps({
+                "error": str(e),
+                "device_used": str(self.device),
+                "gpu_available": torch.cuda.is_available(),
+                "model_path": self.model_id
+            }) + "\n\n"
+        finally:
+            self.token_load.remove(max_tokens)
+        yield "data: [DONE]\n\n"
+
+    def record_autoscaling_stats(self) -> Dict[str, float]:
+        # Custom metrics for token_throughput_autoscaling_policy, polled by Ray Serve
+        return self.token_load.stats(self.engine.generated_tokens)
+
+    def stats(self):
+        return {
+            "model_path": self.model_id,
+            "startup_timings": self.startup_timings,
+            "prefix_cache": self.prefix_cache.stats() if self.prefix_cache else None,
+            "speculative": self.engine.speculative_stats() if self.draft_model is not None else None,
+            "utilization": self.utilization.stats()
+        }
+
     async def __call__(self, request):
         try:
+            if request.method == "GET" and request.url.path.rstrip("/").endswith("/stats"):
+                return self.stats()
+            
             data = await request.json()
             prompt = data.get("prompt", "Hello")
-            max_tokens = int(data.get("max_tokens", 100))
+            try:
+                max_tokens = int(data.get("max_tokens", 100))
+                if max_tokens < 1:
+                    raise ValueError
+            except (ValueError, TypeError):
+                # The engine always generates at least one token and the token load would go negative
+                return JSONResponse({"error": "max_tokens must be a positive integer", "model_path": self.model_id},
+                                    status_code=400)
             
-            start_time = time.time()
-            
-            inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
-            
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=max_tokens,
-                    temperature=0.7,
-                    top_p=0.9,
-                    do_sample=True,
-                    pad_token_id=self.tokenizer.eos_token_id
+            if data.get("stream", False):
+                return StreamingResponse(
+                    self.utilization.track(self._stream(prompt, max_tokens)),
+                    media_type="text/event-stream"
                 )
             
-            response_text = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            generated_text = response_text[len(prompt):].strip()
+            start_time = time.time()
+            
+            input_ids = self.tokenizer(prompt)["input_ids"]
+            self.metrics.tokenization.observe(time.time() - start_time)
+            with self.utilization, self.token_load.reserve(max_tokens):
+                output_ids = await self.engine.generate(input_ids, max_tokens)
+            generated_text = self.tokenizer.decode(output_ids, skip_special_tokens=True).strip()
             
             inference_time = time.time() - start_time
             
@@ -71,6 +1113,7 @@ class TransformersDeployment:
             
         except Exception as e:
             logger.error(f"Error during inference: {str(e)}")
+            self.metrics.errors.inc(tags={"path": "generate"})
             return {
                 "error": str(e),
                 "device_used": str(self.device),
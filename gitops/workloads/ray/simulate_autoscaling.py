@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Replay a traffic trace against a simulated text-generation deployment to compare
+autoscaling policies.
+
+The deployment is mocked: every replica decodes one token per running sequence per
+step, steps get slower as the batch grows, and new replicas take --startup-s to load
+the model. Each control-loop tick the policy under test gets the same context Ray
+Serve builds (ongoing/queued requests averaged over the look-back period, plus the
+token metrics from record_autoscaling_stats), and its decision is applied with
+Serve's min/max bounds.
+
+Two policies are compared:
+  - requests: Ray Serve's default policy, scaling on ongoing requests
+  - token_throughput: token_throughput_autoscaling_policy from the app
+
+The trace is a JSONL file of {"time_s": ..., "max_tokens": ...} lines. Without
+--trace a synthetic one is generated whose long-completion phase keeps the request
+rate constant while the token demand rises tenfold.
+
+Usage:
+  python simulate_autoscaling.py
+  python simulate_autoscaling.py --app gpu --step-s 0.03 --max-batch-size 16 --trace trace.jsonl
+  python simulate_autoscaling.py --check
+
+Both policies are called the way Ray Serve 2.49+ calls them, with one AutoscalingContext,
+so the script needs Ray 2.49 or newer locally even when the cluster runs an older Ray.
+"""
+
+import collections
+import importlib.util
+import inspect
+import json
+import math
+import os
+import random
+import statistics
+import sys
+from types import SimpleNamespace
+
+import ray
+from ray.serve.autoscaling_policy import replica_queue_length_autoscaling_policy
+from ray.serve.config import AutoscalingConfig
+
+APPS = {"cpu": "cpu-app.py", "gpu": "gpu-app.py"}
+
+# Ray Serve evaluates autoscaling decisions every CONTROL_LOOP_INTERVAL_S (0.1s)
+TICK_S = 0.1
+
+
+def _load_app(app):
+    # The apps are shipped as app.py inside the serve zip, so import them by path
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), APPS[app])
+    spec = importlib.util.spec_from_file_location(f"{app}_app", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_trace(seed=0):
+    """Short completions, then long completions at the same rate, a burst, and a quiet tail."""
+    rng = random.Random(seed)
+    phases = [
+        (0, 120, 1.0, (16, 64)),
+        (120, 300, 1.0, (256, 1024)),
+        (300, 420, 3.0, (16, 64)),
+        (420, 900, 0.2, (16, 64)),
+    ]
+    trace = []
+    for start, end, rate, (low, high) in phases:
+        t = start + rng.expovariate(rate)
+        while t < end:
+            trace.append({"time_s": round(t, 3), "max_tokens": rng.randint(low, high)})
+            t += rng.expovariate(rate)
+    return trace
+
+
+def load_trace(path):
+    with open(path) as f:
+        return sorted((json.loads(line) for line in f if line.strip()), key=lambda r: r["time_s"])
+
+
+class Replica:
+    def __init__(self, replica_id, ready_at):
+        self.replica_id = replica_id
+        self.ready_at = ready_at
+        self.draining = False
+        self.ongoing = []
+        self.generated_tokens = 0.0
+        self.busy_seconds = 0.0
+
+    def stats(self):
+        return {
+            "ongoing_requests": float(len(self.ongoing)),
+            "outstanding_tokens": float(sum(r["max_tokens"] for r in self.ongoing)),
+            "decode_tokens_per_s": self.generated_tokens / self.busy_seconds if self.busy_seconds else 0.0
+        }
+
+
+class Simulation:
+    def __init__(self, trace, policy, config, args):
+        self.trace = collections.deque(trace)
+        self.policy = policy
+        self.config = config
+        self.args = args
+        self.now = 0.0
+        self.queue = collections.deque()
+        self.replicas = [Replica(i, 0.0) for i in range(config.min_replicas)]
+        self.next_id = config.min_replicas
+        self.target = config.min_replicas
+        self.policy_state = {}
+        self.window = collections.deque()
+        self.completed = []
+        self.replica_seconds = 0.0
+        self.scale_events = []
+
+    def running(self):
+        return [r for r in self.replicas if r.ready_at <= self.now and not r.draining]
+
+    def step_time(self, batch_size):
+        return self.args.step_s * (1 + self.args.batch_penalty * (batch_size - 1))
+
+    def decode(self, replica):
+        active = replica.ongoing[:self.args.max_batch_size]
+        if not active:
+            return
+        tokens = TICK_S / self.step_time(len(active))
+        replica.busy_seconds += TICK_S
+        for request in active:
+            request["remaining"] -= tokens
+            replica.generated_tokens += tokens
+        for request in [r for r in active if r["remaining"] <= 0]:
+            replica.ongoing.remove(request)
+            request["finished"] = self.now
+            self.completed.append(request)
+
+    def context(self):
+        running = self.running()
+        ongoing = sum(len(r.ongoing) for r in self.replicas)
+        sample = {"total": ongoing + len(self.queue), "replicas": {r.replica_id: r.stats() for r in running}}
+        self.window.append((self.now, sample))
+        while self.now - self.window[0][0] > self.config.look_back_period_s:
+            self.window.popleft()
+
+        # Like Serve, average every metric over the look-back period
+        aggregated = collections.defaultdict(dict)
+        for replica in running:
+            values = collections.defaultdict(list)
+            for _, s in self.window:
+                for name, value in s["replicas"].get(replica.replica_id, {}).items():
+                    values[name].append(value)
+            for name, series in values.items():
+                aggregated[name][replica.replica_id] = statistics.mean(series)
+        return SimpleNamespace(
+            deployment_id=None,
+            deployment_name="simulated",
+            app_name=None,
+            current_num_replicas=len(running),
+            target_num_replicas=self.target,
+            running_replicas=[r.replica_id for r in running],
+            total_num_requests=statistics.mean(s["total"] for _, s in self.window),
+            queued_requests=len(self.queue),
+            requests_per_replica={r.replica_id: len(r.ongoing) for r in running},
+            aggregated_metrics=dict(aggregated),
+            raw_metrics=None,
+            capacity_adjusted_min_replicas=self.config.min_replicas,
+            capacity_adjusted_max_replicas=self.config.max_replicas,
+            policy_state=dict(self.policy_state),
+            last_scale_up_time=None,
+            last_scale_down_time=None,
+            current_time=self.now,
+            config=self.config
+        )
+
+    def autoscale(self):
+        decision, self.policy_state = self.policy(self.context())
+        decision = max(self.config.min_replicas, min(self.config.max_replicas, decision))
+        if decision == self.target:
+            return
+        self.scale_events.append((round(self.now, 1), decision))
+        live = [r for r in self.replicas if not r.draining]
+        if decision > len(live):
+            for _ in range(decision - len(live)):
+                self.replicas.append(Replica(self.next_id, self.now + self.args.startup_s))
+                self.next_id += 1
+        else:
+            # Stop starting replicas first, then drain the least loaded ones
+            for replica in sorted(live, key=lambda r: (r.ready_at <= self.now, len(r.ongoing)))[:len(live) - decision]:
+                replica.draining = True
+        self.target = decision
+
+    def run(self, duration):
+        while self.now < duration or self.queue or any(r.ongoing for r in self.replicas):
+            while self.trace and self.trace[0]["time_s"] <= self.now:
+                request = dict(self.trace.popleft())
+                request["remaining"] = request["max_tokens"]
+                self.queue.append(request)
+
+            # Route queued requests to the least loaded replica with a free slot
+            for replica in sorted(self.running(), key=lambda r: len(r.ongoing)):
+                while self.queue and len(replica.ongoing) < self.args.max_ongoing_requests:
+                    request = self.queue.popleft()
+                    request["started"] = self.now
+                    replica.ongoing.append(request)
+
+            for replica in self.replicas:
+                if replica.ready_at <= self.now:
+                    self.decode(replica)
+            self.replicas = [r for r in self.replicas if not (r.draining and not r.ongoing)]
+            self.replica_seconds += len(self.replicas) * TICK_S
+            self.autoscale()
+            self.now += TICK_S
+            if self.now > duration * 4:
+                break
+        return self.report(duration)
+
+    def report(self, duration):
+        latencies = sorted(r["finished"] - r["time_s"] for r in self.completed)
+        waits = sorted(r["started"] - r["time_s"] for r in self.completed)
+
+        def pct(values, q):
+            return round(values[min(len(values) - 1, int(q * len(values)))], 2) if values else None
+        return {
+            "requests": len(self.completed),
+            "latency_seconds": {"p50": pct(latencies, 0.5), "p95": pct(latencies, 0.95), "p99": pct(latencies, 0.99)},
+            "queue_wait_seconds": {"p50": pct(waits, 0.5), "p95": pct(waits, 0.95), "p99": pct(waits, 0.99)},
+            "replica_seconds": round(self.replica_seconds, 1),
+            "max_replicas": max([self.config.min_replicas] + [n for _, n in self.scale_events]),
+            "final_replicas": self.target,
+            "scale_events": self.scale_events
+        }
+
+
+def _check_policy_api():
+    # Before 2.49 Ray Serve's policies took the request counts and config as separate arguments
+    if list(inspect.signature(replica_queue_length_autoscaling_policy).parameters) != ["ctx"]:
+        sys.exit(f"simulate_autoscaling.py needs the context-based autoscaling policies of Ray 2.49 or newer, "
+                 f"but Ray {ray.__version__} is installed; install a newer Ray locally, e.g. pip install 'ray[serve]>=2.49'")
+
+
+def main(args):
+    _check_policy_api()
+    app = _load_app(args.app)
+    trace = load_trace(args.trace) if args.trace else synthetic_trace(args.seed)
+    duration = math.ceil(max(r["time_s"] for r in trace)) + 1
+    config = AutoscalingConfig(
+        min_replicas=args.min_replicas,
+        max_replicas=args.max_replicas,
+        target_ongoing_requests=args.max_batch_size,
+        upscale_delay_s=args.upscale_delay_s,
+        downscale_delay_s=args.downscale_delay_s
+    )
+    policies = {
+        "requests": replica_queue_length_autoscaling_policy,
+        "token_throughput": app.token_throughput_autoscaling_policy
+    }
+
+    results = {}
+    for name, policy in policies.items():
+        print(f"Replaying {len(trace)} requests with the {name} policy...", file=sys.stderr)
+        results[name] = Simulation(trace, policy, config, args).run(duration)
+    print(json.dumps({"app": args.app, "requests": len(trace), "duration_s": duration, "policies": results}, indent=2))
+
+    if args.check:
+        failures = []
+        token, requests = results["token_throughput"], results["requests"]
+        if token["requests"] != len(trace):
+            failures.append(f"token_throughput completed {token['requests']} of {len(trace)} requests")
+        if token["latency_seconds"]["p95"] > requests["latency_seconds"]["p95"]:
+            failures.append("token_throughput p95 latency is worse than request-based scaling")
+        if token["final_replicas"] != args.min_replicas:
+            failures.append(f"token_throughput did not scale back to {args.min_replicas} replicas")
+        for failure in failures:
+            print(f"FAIL: {failure}", file=sys.stderr)
+        sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare autoscaling policies on a replayed traffic trace")
+    parser.add_argument("--app", choices=sorted(APPS), default="cpu", help="App whose policy is simulated")
+    parser.add_argument("--trace", help="JSONL trace with time_s and max_tokens per request")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic trace")
+    parser.add_argument("--min-replicas", type=int, default=1)
+    parser.add_argument("--max-replicas", type=int, default=8)
+    parser.add_argument("--upscale-delay-s", type=float, default=30)
+    parser.add_argument("--downscale-delay-s", type=float, default=300)
+    parser.add_argument("--startup-s", type=float, default=120, help="Time for a new replica to load the model")
+    parser.add_argument("--step-s", type=float, default=0.02, help="Decode step time with one running sequence")
+    parser.add_argument("--batch-penalty", type=float, default=0.15, help="Relative step slowdown per extra sequence")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-ongoing-requests", type=int, default=16)
+    parser.add_argument("--check", action="store_true",
+                        help="Exit non-zero unless token_throughput beats request-based p95 latency and scales back down")
+    main(parser.parse_args())
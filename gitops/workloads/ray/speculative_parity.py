@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Check that speculative decoding in the GPU engine (gpu-app.py) generates the same
+outputs as plain decoding, and report how many draft tokens are accepted.
+
+Two checks run against ContinuousBatchingEngine with and without a draft model:
+  - greedy: with a near-zero temperature every prompt must produce identical tokens
+  - distribution: with sampling, the per-position token frequencies of --samples
+    speculative generations must be as close to plain decoding as two plain runs
+    with different seeds are to each other (total variation distance). Sampling
+    from the draft alone is reported as the distance a broken verifier would show.
+
+By default a tiny random-weight Llama is generated, its output logits sharpened so
+the distributions are not near-uniform, and the draft is a copy with perturbed
+weights, so the check runs offline on CPU. Pass --model and --draft-model
+to measure acceptance for a real pair, e.g. Mistral 7B with a TinyLlama draft (the
+two must share a tokenizer for drafts to be accepted).
+
+Usage:
+  python speculative_parity.py
+  python speculative_parity.py --model /mnt/models/models/mistral-7b --draft-model /mnt/models/models/tinyllama
+"""
+
+import asyncio
+import collections
+import copy
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from benchmark_serve import create_tiny_model
+
+DEFAULT_PROMPTS = [
+    "Hello, how are you?",
+    "What is Kubernetes?",
+    "Explain the difference between a process and a thread.",
+    "Write a haiku about autumn leaves.",
+]
+
+
+def _load_gpu_app():
+    # gpu-app.py is shipped as app.py inside the serve zip, so import it by path
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gpu-app.py")
+    spec = importlib.util.spec_from_file_location("gpu_app", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _load(model_id, device):
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+    model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=dtype, local_files_only=True).to(device)
+    return model.eval()
+
+
+def run_engine(app, model, tokenizer, prompts, max_new_tokens, temperature, top_p, seed, draft_model=None, k=4,
+               max_batch_size=16):
+    """Generates max_new_tokens for every prompt, ignoring EOS so all outputs have the same length."""
+    torch.manual_seed(seed)
+    engine = app.ContinuousBatchingEngine(
+        model, tokenizer, max_batch_size=max_batch_size, temperature=temperature, top_p=top_p,
+        draft_model=draft_model, num_speculative_tokens=k
+    )
+    engine.eos_token_id = None
+
+    async def generate():
+        return await asyncio.gather(*[
+            engine.generate(tokenizer(prompt)["input_ids"], max_new_tokens) for prompt in prompts
+        ])
+    start = time.time()
+    outputs = asyncio.run(generate())
+    elapsed = time.time() - start
+    return outputs, {
+        "tokens_per_second": round(sum(len(o) for o in outputs) / elapsed, 1),
+        "speculative": engine.speculative_stats() if draft_model is not None else None
+    }
+
+
+def positional_tvd(samples_a, samples_b):
+    """Mean total variation distance between the per-position token frequencies of two sample sets."""
+    distances = []
+    for position in range(len(samples_a[0])):
+        a = collections.Counter(s[position] for s in samples_a)
+        b = collections.Counter(s[position] for s in samples_b)
+        distances.append(sum(abs(a[t] / len(samples_a) - b[t] / len(samples_b)) for t in set(a) | set(b)) / 2)
+    return sum(distances) / len(distances)
+
+
+def main(args):
+    app = _load_gpu_app()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    with tempfile.TemporaryDirectory() as tmp:
+        model_id = args.model
+        if not model_id:
+            model_id = os.path.join(tmp, "tiny")
+            create_tiny_model(model_id)
+        tokenizer = AutoTokenizer.from_pretrained(model_id, local_files_only=True)
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        model = _load(model_id, device)
+        if not args.model:
+            with torch.no_grad():
+                model.lm_head.weight.mul_(args.logit_scale)
+        if args.draft_model:
+            draft_model = _load(args.draft_model, device)
+        else:
+            draft_model = copy.deepcopy(model)
+            torch.manual_seed(args.seed)
+            with torch.no_grad():
+                for param in draft_model.parameters():
+                    param.add_(torch.randn_like(param) * args.draft_noise * param.std().nan_to_num())
+
+    failures = []
+    report = {"model": args.model or "tiny-random", "draft_model": args.draft_model or "perturbed copy",
+              "num_speculative_tokens": args.num_speculative_tokens}
+    common = dict(max_new_tokens=args.max_tokens, top_p=args.top_p, max_batch_size=args.max_batch_size)
+
+    print("Checking greedy parity...", file=sys.stderr)
+    plain, plain_stats = run_engine(app, model, tokenizer, DEFAULT_PROMPTS, temperature=1e-6, seed=args.seed, **common)
+    spec, spec_stats = run_engine(app, model, tokenizer, DEFAULT_PROMPTS, temperature=1e-6, seed=args.seed,
+                                  draft_model=draft_model, k=args.num_speculative_tokens, **common)
+    matches = sum(a == b for a, b in zip(plain, spec))
+    report["greedy"] = {
+        "exact_match_rate": round(matches / len(plain), 4),
+        "plain_tokens_per_second": plain_stats["tokens_per_second"],
+        "speculative_tokens_per_second": spec_stats["tokens_per_second"],
+        "speculative": spec_stats["speculative"]
+    }
+    if matches != len(plain):
+        failures.append(f"greedy outputs differ for {len(plain) - matches} of {len(plain)} prompts")
+
+    print(f"Checking the sampling distribution with {args.samples} samples...", file=sys.stderr)
+    prompts = [DEFAULT_PROMPTS[0]] * args.samples
+    common["temperature"] = args.temperature
+    plain, _ = run_engine(app, model, tokenizer, prompts, seed=args.seed, **common)
+    reference, _ = run_engine(app, model, tokenizer, prompts, seed=args.seed + 1, **common)
+    spec, spec_stats = run_engine(app, model, tokenizer, prompts, seed=args.seed + 2, draft_model=draft_model,
+                                  k=args.num_speculative_tokens, **common)
+    draft_only, _ = run_engine(app, draft_model, tokenizer, prompts, seed=args.seed + 3, **common)
+    baseline, distance = positional_tvd(plain, reference), positional_tvd(plain, spec)
+    report["distribution"] = {
+        "temperature": args.temperature,
+        "plain_vs_plain_tvd": round(baseline, 4),
+        "plain_vs_speculative_tvd": round(distance, 4),
+        "plain_vs_draft_tvd": round(positional_tvd(plain, draft_only), 4),
+        "speculative": spec_stats["speculative"]
+    }
+    if distance > baseline * args.tolerance:
+        failures.append(f"speculative samples drift from plain decoding (TVD {distance:.4f} vs {baseline:.4f})")
+
+    print(json.dumps(report, indent=2))
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check speculative decoding against plain decoding")
+    parser.add_argument("--model", help="Main model directory (default: a generated tiny random model)")
+    parser.add_argument("--draft-model", help="Draft model directory (default: a perturbed copy of the model)")
+    parser.add_argument("--draft-noise", type=float, default=0.5, help="Relative weight noise of the default draft")
+    parser.add_argument("--logit-scale", type=float, default=8.0, help="Output logit scale of the default tiny model")
+    parser.add_argument("--num-speculative-tokens", type=int, default=4)
+    parser.add_argument("--max-tokens", type=int, default=16)
+    parser.add_argument("--samples", type=int, default=1000, help="Generations per run for the distribution check")
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top-p", type=float, default=0.9)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="Allowed ratio of the speculative TVD to the plain-vs-plain TVD")
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
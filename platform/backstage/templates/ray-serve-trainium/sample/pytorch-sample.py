@@ -1,46 +1,87 @@
+import argparse
+import json
+import math
 import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from itertools import islice
 from typing import Dict
 
+import numpy as np
+import pyarrow.fs
 import torch
+import torch.distributed as dist
 from filelock import FileLock
 from torch import nn
-from torch.utils.data import DataLoader
-from torchvision import datasets, transforms
-from torchvision.transforms import Normalize, ToTensor
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+from torchvision import datasets
 from tqdm import tqdm
 
 import ray.train
-from ray.train import ScalingConfig
+from ray import tune
+from ray.train import Checkpoint, CheckpointConfig, DataConfig, FailureConfig, RunConfig, ScalingConfig
+from ray.autoscaler.sdk import request_resources
+from ray.train.base_trainer import TrainingFailedError
 from ray.train.torch import TorchTrainer
+from ray.train.torch.xla import TorchXLAConfig
+from ray.tune.schedulers import ASHAScheduler
 import ray
 
 
-def get_dataloaders(batch_size):
-    # Transform to normalize the input images
-    transform = transforms.Compose([ToTensor(), Normalize((0.5,), (0.5,))])
+def _exists(path):
+    filesystem, path = pyarrow.fs.FileSystem.from_uri(path if "://" in path else os.path.abspath(path))
+    return filesystem.get_file_info(path).type != pyarrow.fs.FileType.NotFound
 
-    with FileLock(os.path.expanduser("~/data.lock")):
-        # Download training data from open datasets
-        training_data = datasets.FashionMNIST(
-            root="~/data",
-            train=True,
-            download=True,
-            transform=transform,
-        )
-
-        # Download test data from open datasets
-        test_data = datasets.FashionMNIST(
-            root="~/data",
-            train=False,
-            download=True,
-            transform=transform,
-        )
 
-    # Create data loaders
-    train_dataloader = DataLoader(training_data, batch_size=batch_size, shuffle=True)
-    test_dataloader = DataLoader(test_data, batch_size=batch_size)
-
-    return train_dataloader, test_dataloader
+def _download(train):
+    with FileLock(os.path.expanduser("~/data.lock")):
+        # Download data from open datasets; torchvision keeps the decoded images as one uint8 tensor
+        data = datasets.FashionMNIST(root="~/data", train=train, download=True)
+    return ray.data.from_items([
+        {"image": image, "label": label} for image, label in zip(data.data.numpy(), data.targets.numpy())
+    ])
+
+
+def normalize(batch: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    # Same as ToTensor() and Normalize((0.5,), (0.5,)), applied to a whole batch at once
+    return {"image": (batch["image"].astype(np.float32) / 255 - 0.5) / 0.5, "label": batch["label"]}
+
+
+def get_datasets(data_path=None):
+    """Returns the FashionMNIST train and test splits as Ray Datasets of normalized tensors.
+
+    The images are downloaded and normalized once, by the driver's job. With data_path
+    (S3 or a shared mount) the normalized tensors are written there as Parquet on the
+    first run and read from there afterwards. Either way they are then held in the object
+    store, which workers on a node share through memory mapping, so every epoch slices
+    the same tensors zero-copy instead of decoding and normalizing them again. Ray Train
+    streams each worker its shard instead of every worker keeping its own copy.
+    """
+    splits = {}
+    for name, train in [("train", True), ("test", False)]:
+        if not data_path:
+            dataset = _download(train).map_batches(normalize)
+        else:
+            path = f"{data_path.rstrip('/')}/{name}"
+            if not _exists(path):
+                _download(train).map_batches(normalize).write_parquet(path)
+            dataset = ray.data.read_parquet(path)
+        splits[name] = dataset.materialize()
+    # Deal the blocks to workers in a shuffled order, the same one every time so a resumed
+    # epoch gets the same shards; batches are shuffled further on each worker every epoch
+    splits["train"] = splits["train"].randomize_block_order(seed=0)
+    return splits["train"], splits["test"]
+
+
+def _dataset_config():
+    """Splits the datasets across workers in order, so every attempt gets the same shards."""
+    options = DataConfig.default_ingest_options()
+    # Without this, blocks go to whichever worker is closest to them
+    options.preserve_order = True
+    return DataConfig(execution_options=options)
 
 
 # Model Definition
@@ -65,90 +106,851 @@ class NeuralNetwork(nn.Module):
         return logits
 
 
+def _to_cpu(state):
+    """Copies every tensor of a (nested) state dict into CPU memory."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: _to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_to_cpu(value) for value in state)
+    return state
+
+
+class CheckpointWriter:
+    """Writes checkpoints to a local directory from a background thread.
+
+    save() only copies the training state to CPU memory; serializing it to disk happens on
+    a thread while training or evaluation goes on. result() waits for that write
+    and returns the Checkpoint to pass to ray.train.report, which uploads it to the run's
+    storage.
+    """
+
+    def __init__(self):
+        self.thread, self.directory = None, None
+
+    def save(self, state):
+        self.discard()
+        self.directory = tempfile.mkdtemp(prefix="fashion-mnist-checkpoint-")
+        self.thread = threading.Thread(
+            target=torch.save, args=(_to_cpu(state), os.path.join(self.directory, "checkpoint.pt")), daemon=True
+        )
+        self.thread.start()
+
+    def result(self):
+        if self.thread is None:
+            return None
+        self.thread.join()
+        self.thread = None
+        return Checkpoint.from_directory(self.directory)
+
+    def discard(self):
+        # Drops a write that a newer checkpoint supersedes before it was reported
+        self.result()
+        self.cleanup()
+
+    def cleanup(self):
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+def load_checkpoint(checkpoint):
+    with checkpoint.as_directory() as directory:
+        return torch.load(os.path.join(directory, "checkpoint.pt"), weights_only=True)
+
+
+def _sum_across_workers(tensor):
+    """Sums a tensor in place over all workers and returns it."""
+    if dist.is_available() and dist.is_initialized():
+        dist.all_reduce(tensor)
+    return tensor
+
+
+class StepTimer:
+    """Times the phases of every training step on one worker.
+
+    Phases are wall-clock times, with the GPU synchronized at their boundaries so its work
+    is counted where it runs. allreduce is timed from DDP handing a gradient bucket to the
+    process group until it is reduced; it overlaps backward, which only includes the wait
+    for the last bucket. Every phase is also kept as a Chrome trace event (pid is the
+    worker rank), and labelled for the torch profiler. When disabled, nothing is timed.
+    """
+
+    PHASES = ("data_wait", "forward", "backward", "optimizer", "allreduce")
+
+    def __init__(self, enabled, device, rank):
+        self.enabled, self.device, self.rank = enabled, device, rank
+        self.reset()
+
+    def reset(self):
+        self.totals = dict.fromkeys(self.PHASES, 0.0)
+        self.steps = 0
+        self.events = []
+
+    def _sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def _record(self, name, start, end, thread=0):
+        self.totals[name] += end - start
+        self.events.append({"name": name, "ph": "X", "pid": self.rank, "tid": thread,
+                            "ts": start * 1e6, "dur": (end - start) * 1e6})
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        with torch.profiler.record_function(name):
+            self._sync()
+            start = time.perf_counter()
+            yield
+            self._sync()
+            self._record(name, start, time.perf_counter())
+
+    def iterate(self, batches):
+        """Yields the batches, timing the wait for each as data_wait."""
+        if not self.enabled:
+            yield from batches
+            return
+        batches = iter(batches)
+        while True:
+            with self.phase("data_wait"):
+                batch = next(batches, None)
+            if batch is None:
+                return
+            self.steps += 1
+            yield batch
+
+    def allreduce_hook(self, process_group, bucket):
+        # DDP's default all-reduce, timed until the reduced bucket is ready
+        start = time.perf_counter()
+
+        def done(future):
+            self._record("allreduce", start, time.perf_counter(), thread=1)
+            return future.value()
+
+        return default_hooks.allreduce_hook(process_group, bucket).then(done)
+
+    def metrics(self, num_samples, seconds):
+        """Mean milliseconds per step of every phase, averaged over the workers, and each worker's samples/s."""
+        local = torch.tensor([self.totals[name] for name in self.PHASES] + [self.steps, num_samples / seconds])
+        if dist.is_available() and dist.is_initialized():
+            gathered = [torch.zeros_like(local) for _ in range(dist.get_world_size())]
+            dist.all_gather(gathered, local)
+        else:
+            gathered = [local]
+        per_worker = torch.stack(gathered)
+        steps = per_worker[:, len(self.PHASES)].clamp(min=1)
+        metrics = {
+            f"{name}_ms": (per_worker[:, i] / steps).mean().item() * 1000 for i, name in enumerate(self.PHASES)
+        }
+        metrics["worker_samples_per_second"] = per_worker[:, -1].tolist()
+        return metrics
+
+    def dump(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
 def train_func_per_worker(config: Dict):
     lr = config["lr"]
     epochs = config["epochs"]
     batch_size = config["batch_size_per_worker"]
-
-    # Get dataloaders inside the worker training function
-    train_dataloader, test_dataloader = get_dataloaders(batch_size=batch_size)
-
-    # [1] Prepare Dataloader for distributed training
-    # Shard the datasets among workers and move batches to the correct device
-    # =======================================================================
-    train_dataloader = ray.train.torch.prepare_data_loader(train_dataloader)
-    test_dataloader = ray.train.torch.prepare_data_loader(test_dataloader)
+    # Gradients of this many batches are summed before each optimizer step (and all-reduce)
+    accumulation_steps = config.get("grad_accumulation_steps", 1)
+    world_size = ray.train.get_context().get_world_size()
+
+    # On Neuron every worker drives one NeuronCore through XLA. Operations are recorded
+    # lazily and compiled into a graph at every mark_step(); compiled graphs are looked up
+    # by shape in the Neuron compile cache, so later runs and workers skip compilation
+    if config.get("backend") == "neuron":
+        import torch_xla.core.xla_model as xm
+
+        os.environ.setdefault("NEURON_COMPILE_CACHE_URL", config["neuron_cache_dir"])
+        device = xm.xla_device()
+        mark_step = xm.mark_step
+    else:
+        device = ray.train.torch.get_device()
+        mark_step = lambda: None
+
+    # [1] Get this worker's shard of the datasets passed to the TorchTrainer
+    # Batches are prefetched in the background, pinned and moved to the correct device
+    # ================================================================================
+    train_shard = ray.train.get_dataset_shard("train")
+    test_shard = ray.train.get_dataset_shard("test")
+    batch_options = {
+        "batch_size": batch_size,
+        "prefetch_batches": config.get("prefetch_batches", 4),
+        "pin_memory": device.type == "cuda",
+    }
+    # Every new batch shape is a new XLA graph to compile, so a partial last training
+    # batch is dropped; evaluation keeps it to count every test sample
+    drop_last = device.type == "xla"
+
+    # Mixed precision: bf16 autocast runs on CPU, GPU and Neuron, fp16 needs a GPU and loss scaling
+    precision = config.get("precision", "fp32")
+    autocast_dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(precision)
+    scaler = torch.amp.GradScaler(device.type, enabled=precision == "fp16")
+
+    # Checkpoints are taken between optimizer steps, never inside an accumulation window;
+    # without checkpoint_every_batches they are only taken after every epoch
+    checkpoint_every = math.ceil(config.get("checkpoint_every_batches", 500) / accumulation_steps) * accumulation_steps
+    # A periodic checkpoint is written in the background while training goes on for this many
+    # batches, and only then reported, with the metrics it was taken at
+    report_delay = max(0, min(config.get("checkpoint_report_delay_batches", 20), checkpoint_every - 1))
+
+    # Resume from the latest checkpoint after a worker failure or when a run is restored.
+    # Each worker's shard and shuffle order are fixed by the worker count and the shuffle
+    # seed, which the checkpoint keeps, so skipping the batches already trained continues
+    # the epoch with exactly the samples it had left. With another worker count (elastic
+    # training) the shards differ and the skipped batches only match in number
+    checkpoint = ray.train.get_checkpoint()
+    state = load_checkpoint(checkpoint) if checkpoint else None
+    start_epoch, skip_batches, optimizer_steps = 0, 0, 0
+    shuffle_seed = config.get("shuffle_seed", 0)
+    if state:
+        start_epoch = state["epoch"]
+        skip_batches = state["samples"] // (batch_size * world_size) // accumulation_steps * accumulation_steps
+        shuffle_seed = state.get("shuffle_seed", shuffle_seed)
+        optimizer_steps = state.get("optimizer_steps", 0)
+    rank = ray.train.get_context().get_world_rank()
+    is_writer = rank == 0
+    writer = CheckpointWriter()
+
+    # With check_resume every epoch also counts the samples it trains on, over all workers,
+    # and sums their squared pixels. A sample trained twice or left out after resuming
+    # changes the sums, which check_resume() compares with a run that was not interrupted
+    check_resume = config.get("check_resume", False)
+    resumed_seen = state.get("seen") if state and is_writer else None
+
+    # With profile, every report breaks the epoch's training steps down into phases and the
+    # steps are written to profile_dir on each worker's node as Chrome traces; profile_steps
+    # also records that many steps of the first epoch with the torch profiler. XLA runs a
+    # step only at mark_step(), so its phases cannot be told apart and are not timed
+    timer = StepTimer(config.get("profile", False) and device.type != "xla", device, rank)
+    profile_dir = config.get("profile_dir", "/tmp/ray-train-profile")
 
     model = NeuralNetwork()
+    if state:
+        model.load_state_dict(state["model"])
+    if device.type == "xla":
+        model.to(device)
 
     # [2] Prepare and wrap your model with DistributedDataParallel
-    # Move the model to the correct GPU/CPU device
+    # Move the model to the correct GPU/CPU device; gradients are all-reduced in
+    # buckets of bucket_cap_mb, written in place into the bucket buffers
     # ============================================================
-    model = ray.train.torch.prepare_model(model)
+    model = ray.train.torch.prepare_model(model, move_to_device=device.type != "xla", parallel_strategy_kwargs={
+        "bucket_cap_mb": config.get("bucket_cap_mb", 25),
+        "gradient_as_bucket_view": True,
+    })
+    if timer.enabled and hasattr(model, "register_comm_hook"):
+        model.register_comm_hook(None, timer.allreduce_hook)
 
     loss_fn = nn.CrossEntropyLoss()
-    optimizer = torch.optim.SGD(model.parameters(), lr=lr, momentum=0.9)
+    optimizer = torch.optim.SGD(model.parameters(), lr=lr, momentum=config.get("momentum", 0.9))
+    if state:
+        optimizer.load_state_dict(state["optimizer"])
+        # A disabled scaler saves an empty state, e.g. when the run was not in fp16 before
+        if state.get("scaler") and scaler.is_enabled():
+            scaler.load_state_dict(state["scaler"])
+        # The learning rate follows this attempt's config, which may rescale it to a new worker count
+        for group in optimizer.param_groups:
+            group["lr"] = lr
+
+    def save_checkpoint(epoch, batches, seen=None):
+        # The replicas are identical after every optimizer step, so the first worker saves for all
+        if is_writer:
+            model_state = model.module.state_dict() if hasattr(model, "module") else model.state_dict()
+            writer.save({"epoch": epoch, "samples": batches * batch_size * world_size, "shuffle_seed": shuffle_seed,
+                         "optimizer_steps": optimizer_steps, "seen": seen, "model": model_state,
+                         "optimizer": optimizer.state_dict(), "scaler": scaler.state_dict()})
+
+    def report(metrics):
+        # Every worker reports, only the first one with the checkpoint saved for these metrics
+        checkpoint = writer.result()
+        ray.train.report(metrics=metrics, checkpoint=checkpoint)
+        writer.cleanup()
 
     # Model training loop
-    for epoch in range(epochs):
-        if ray.train.get_context().get_world_size() > 1:
-            # Required for the distributed sampler to shuffle properly across epochs.
-            train_dataloader.sampler.set_epoch(epoch)
+    for epoch in range(start_epoch, epochs):
+        train_batches = train_shard.iter_torch_batches(
+            local_shuffle_buffer_size=config.get("shuffle_buffer_size", 10000),
+            local_shuffle_seed=hash((shuffle_seed, epoch, rank)) % 2**32, drop_last=drop_last, **batch_options
+        )
+        skip = skip_batches if epoch == start_epoch else 0
+
+        profiler = None
+        if config.get("profile_steps") and epoch == start_epoch:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if device.type == "cuda":
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            os.makedirs(profile_dir, exist_ok=True)
+            trace_path = os.path.join(profile_dir, f"torch-epoch{epoch}-rank{rank}.json")
+            profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=1, warmup=1, active=config["profile_steps"], repeat=1),
+                on_trace_ready=lambda p: p.export_chrome_trace(trace_path),
+            )
+            profiler.start()
 
         model.train()
-        for X, y in tqdm(train_dataloader, desc=f"Train Epoch {epoch}"):
-            pred = model(X)
-            loss = loss_fn(pred, y)
-
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
+        # A partial accumulation window left over from the previous epoch is dropped
+        optimizer.zero_grad()
+        timer.reset()
+        start, num_samples = time.perf_counter(), 0
+        # The batch after which the pending periodic checkpoint is reported, and its metrics
+        pending = None
+        # Samples and their squared pixel sum; the first worker carries on from the checkpoint's
+        seen = torch.zeros(2, dtype=torch.float64, device=device)
+        if epoch == start_epoch and resumed_seen:
+            seen += torch.tensor(resumed_seen, dtype=torch.float64, device=device)
+        batches = timer.iterate(islice(train_batches, skip, None))
+        for step, batch in enumerate(tqdm(batches, desc=f"Train Epoch {epoch}"), skip):
+            X, y = batch["image"].to(device), batch["label"].to(device)
+            # Only the last batch of each window all-reduces its gradients across workers
+            last = (step + 1) % accumulation_steps == 0
+            with nullcontext() if last or not hasattr(model, "no_sync") else model.no_sync():
+                with timer.phase("forward"), torch.autocast(device.type, dtype=autocast_dtype,
+                                                            enabled=autocast_dtype is not None):
+                    pred = model(X)
+                    loss = loss_fn(pred, y) / accumulation_steps
+                with timer.phase("backward"):
+                    scaler.scale(loss).backward()
+
+            if last:
+                with timer.phase("optimizer"):
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad()
+                optimizer_steps += 1
+            num_samples += y.shape[0]
+            if check_resume:
+                seen += torch.stack([torch.tensor(y.shape[0], dtype=torch.float64, device=device),
+                                     X.double().pow(2).sum()])
+            mark_step()
+            if profiler:
+                profiler.step()
+
+            if checkpoint_every and (step + 1) % checkpoint_every == 0:
+                save_checkpoint(epoch, step + 1, _sum_across_workers(seen.clone()).tolist() if check_resume else None)
+                pending = (step + 1 + report_delay, {"epoch": epoch, "batches": step + 1})
+            if pending and step + 1 >= pending[0]:
+                report(pending[1])
+                pending = None
+            if step + 1 == config.get("fail_at_batch") and is_writer and checkpoint is None:
+                print(f"Simulating a worker failure at batch {step + 1}")
+                os._exit(1)
+        train_seconds = time.perf_counter() - start
+        if profiler:
+            profiler.stop()
+        if timer.enabled:
+            timer.dump(os.path.join(profile_dir, f"steps-epoch{epoch}-rank{rank}.json"))
+
+        if pending:
+            report(pending[1])
+        # Written during evaluation and reported with its results
+        save_checkpoint(epoch + 1, 0)
+
+        # Sums of loss, correct predictions and samples stay on the device, so evaluation
+        # never waits for the host; they are summed across workers once, at the end
         model.eval()
-        test_loss, num_correct, num_total = 0, 0, 0
+        totals = torch.zeros(3, device=device)
         with torch.no_grad():
-            for X, y in tqdm(test_dataloader, desc=f"Test Epoch {epoch}"):
-                pred = model(X)
-                loss = loss_fn(pred, y)
-
-                test_loss += loss.item()
-                num_total += y.shape[0]
-                num_correct += (pred.argmax(1) == y).sum().item()
-
-        test_loss /= len(test_dataloader)
+            for batch in test_shard.iter_torch_batches(**batch_options):
+                X, y = batch["image"].to(device), batch["label"].to(device)
+                with torch.autocast(device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+                    pred = model(X)
+                    loss = loss_fn(pred, y)
+
+                totals += torch.stack([loss.float() * y.shape[0], (pred.argmax(1) == y).sum().float(),
+                                       torch.tensor(y.shape[0], dtype=torch.float, device=device)])
+                mark_step()
+        test_loss_sum, num_correct, num_total = _sum_across_workers(totals).tolist()
+
+        # Loss and accuracy over the test set, the same on every worker. Ray Train splits it
+        # into equal shards, which drops up to num_workers - 1 rows when the worker count does
+        # not divide its size; num_total counts the rows actually evaluated
+        test_loss = test_loss_sum / num_total
         accuracy = num_correct / num_total
 
         # [3] Report metrics to Ray Train
         # ===============================
-        ray.train.report(metrics={"loss": test_loss, "accuracy": accuracy})
-
-
-def train_fashion_mnist(num_workers=5, use_gpu=False):
+        report({
+            "epoch": epoch,
+            "loss": test_loss,
+            "accuracy": accuracy,
+            # Workers get equal shards, so this worker's rate times the worker count
+            "train_samples_per_second": num_samples / train_seconds * world_size,
+            "optimizer_steps": optimizer_steps,
+            **({"resumed": checkpoint is not None,
+                **dict(zip(("train_samples", "train_fingerprint"), _sum_across_workers(seen).tolist()))}
+               if check_resume else {}),
+            **(timer.metrics(num_samples, train_seconds) if timer.enabled else {}),
+        })
+
+
+def train_fashion_mnist(num_workers=5, use_gpu=False, data_path=None, batch_size_per_worker=None,
+                        grad_accumulation_steps=1, precision="fp32", bucket_cap_mb=25, epochs=1,
+                        run_name=None, storage_path=None, resume=False, checkpoint_every_batches=500, max_failures=3,
+                        fail_at_batch=None, check_resume=False, profile=False, profile_steps=0, profile_dir="/tmp/ray-train-profile",
+                        backend="cpu", neuron_cache_dir="/tmp/neuron-compile-cache", neuron_parallel_compile=False):
+    if backend == "neuron" and precision == "fp16":
+        raise ValueError("fp16 needs loss scaling, which Neuron does not support; use bf16")
     global_batch_size = 32
+    train_dataset, test_dataset = get_datasets(data_path)
+
+    # A NeuronCore needs whole batches to keep busy, so on Neuron the default is a batch
+    # of global_batch_size per worker instead of a share of it
+    if not batch_size_per_worker:
+        batch_size_per_worker = global_batch_size if backend == "neuron" else global_batch_size // num_workers
 
     train_config = {
         "lr": 1e-3,
-        "epochs": 1, # artifically set low to finish quickly
-        "batch_size_per_worker": global_batch_size // num_workers,
+        "epochs": epochs, # artifically set low to finish quickly
+        "batch_size_per_worker": batch_size_per_worker,
+        "grad_accumulation_steps": grad_accumulation_steps,
+        "precision": precision,
+        "bucket_cap_mb": bucket_cap_mb,
+        "checkpoint_every_batches": checkpoint_every_batches,
+        "fail_at_batch": fail_at_batch,
+        "check_resume": check_resume,
+        "profile": profile,
+        "profile_steps": profile_steps,
+        "profile_dir": profile_dir,
+        "backend": backend,
+        "neuron_cache_dir": neuron_cache_dir,
+        # Neuron copies batches to the device itself, so more are prepared ahead of it
+        "prefetch_batches": 8 if backend == "neuron" else 4,
     }
 
-    # Configure computation resources
-    scaling_config = ScalingConfig(num_workers=num_workers, use_gpu=use_gpu)
-
-    # Initialize a Ray TorchTrainer
-    trainer = TorchTrainer(
-        train_loop_per_worker=train_func_per_worker,
-        train_loop_config=train_config,
-        scaling_config=scaling_config,
+    # Configure computation resources: one NeuronCore per worker with the XLA process
+    # group on Neuron. With neuron_parallel_compile the run only extracts the graphs of the
+    # training loop (its results are meaningless) and compiles them in parallel into the
+    # compile cache at the end, so the next run starts without compiling
+    torch_config = None
+    if backend == "neuron":
+        scaling_config = ScalingConfig(num_workers=num_workers, resources_per_worker={"neuron_cores": 1})
+        torch_config = TorchXLAConfig(neuron_parallel_compile=neuron_parallel_compile)
+    else:
+        scaling_config = ScalingConfig(num_workers=num_workers, use_gpu=use_gpu)
+
+    # Keep the two latest checkpoints and restart the workers from the latest one when a
+    # worker fails. Workers on other nodes need storage_path to be S3 or a shared mount
+    run_config = RunConfig(
+        name=run_name,
+        storage_path=storage_path,
+        checkpoint_config=CheckpointConfig(num_to_keep=2),
+        failure_config=FailureConfig(max_failures=max_failures),
     )
 
+    # Initialize a Ray TorchTrainer, or with resume continue the named run from its latest
+    # checkpoint. A run that already finished can be restored too, so this is never implicit
+    run_path = os.path.join(storage_path or os.path.expanduser("~/ray_results"), run_name or "")
+    if resume and run_name and TorchTrainer.can_restore(run_path):
+        print(f"Resuming {run_path}")
+        trainer = TorchTrainer.restore(
+            run_path,
+            train_loop_per_worker=train_func_per_worker,
+            train_loop_config=train_config,
+            datasets={"train": train_dataset, "test": test_dataset},
+        )
+    else:
+        trainer = TorchTrainer(
+            train_loop_per_worker=train_func_per_worker,
+            train_loop_config=train_config,
+            torch_config=torch_config,
+            scaling_config=scaling_config,
+            run_config=run_config,
+            datasets={"train": train_dataset, "test": test_dataset},
+            dataset_config=_dataset_config(),
+        )
+
     # [4] Start distributed training
     # Run `train_func_per_worker` on all workers
     # =============================================
     result = trainer.fit()
     print(f"Training result: {result}")
+    return result
+
+
+def select_backend(backend):
+    """Resolves "auto" to neuron when the cluster has NeuronCores and to cpu otherwise."""
+    if backend == "auto":
+        return "neuron" if ray.cluster_resources().get("neuron_cores") else "cpu"
+    return backend
+
+
+def compare_backends(num_workers, data_path, batch_size_per_worker=32, epochs=1, neuron_cache_dir="/tmp/neuron-compile-cache"):
+    """Trains the same configuration on CPU workers and on NeuronCores and compares throughput.
+
+    Both runs use num_workers workers with batch_size_per_worker each, so they process the
+    same global batches. The Neuron run is left out on clusters without NeuronCores. The
+    first Neuron run includes compiling its graphs; run with --precompile, or run twice,
+    to compare warm runs.
+    """
+    backends = ["cpu"] + (["neuron"] if select_backend("auto") == "neuron" else [])
+    rows = []
+    for backend in backends:
+        result = train_fashion_mnist(num_workers, data_path=data_path, batch_size_per_worker=batch_size_per_worker,
+                                     epochs=epochs, backend=backend, neuron_cache_dir=neuron_cache_dir)
+        rows.append((backend, result.metrics["train_samples_per_second"], result.metrics["accuracy"]))
+    if len(backends) == 1:
+        print("No NeuronCores in the cluster, only the CPU workers were benchmarked")
+    print(f"{'backend':<10} {'samples/s':>10} {'speedup':>8} {'accuracy':>9}")
+    for backend, throughput, accuracy in rows:
+        print(f"{backend:<10} {throughput:>10.1f} {throughput / rows[0][1]:>7.2f}x {accuracy:>9.3f}")
+
+
+def _available_workers(resources_per_worker):
+    """Returns how many more workers of this size the cluster's free resources hold."""
+    available = ray.available_resources()
+    return min(int(available.get(name, 0) // amount) for name, amount in resources_per_worker.items() if amount)
+
+
+class ElasticCheckpoints(tune.Callback):
+    """Remembers the latest checkpoint of a run, including one that ends with an error."""
+
+    def __init__(self):
+        self.latest = None
+
+    def on_checkpoint(self, iteration, trials, trial, checkpoint, **info):
+        self.latest = checkpoint
+
+
+def elastic_train_fashion_mnist(min_workers=1, max_workers=10, use_gpu=False, data_path=None,
+                                batch_size_per_worker=None, epochs=1, cpus_per_worker=1, gpus_per_worker=1,
+                                run_name="fashion-mnist", storage_path=None, checkpoint_every_batches=500,
+                                max_failures=3, rescale_interval_s=300):
+    """Trains with as many workers between min_workers and max_workers as the cluster fits.
+
+    Each attempt runs a TorchTrainer sized to the free resources. Ray Train splits the
+    datasets into that many shards and the learning rate is scaled with the global batch
+    size, relative to the usual 1e-3 for a global batch of 32. When a worker is lost, for
+    instance with its spot node, the attempt ends and the next one starts from the latest
+    checkpoint with the workers that fit now, waiting until at least min_workers do.
+    Attempts with fewer than max_workers also end at the first checkpoint reported
+    rescale_interval_s after they started once more workers fit, so new nodes get used.
+    The autoscaler is asked for max_workers workers for the whole run.
+    """
+    train_dataset, test_dataset = get_datasets(data_path)
+    batch_size_per_worker = batch_size_per_worker or max(32 // max_workers, 1)
+    resources_per_worker = {"CPU": cpus_per_worker, **({"GPU": gpus_per_worker} if use_gpu else {})}
+    request_resources(bundles=[resources_per_worker] * max_workers)
+
+    checkpoints = ElasticCheckpoints()
+    failures, attempt = 0, 0
+    try:
+        while True:
+            num_workers = min(_available_workers(resources_per_worker), max_workers)
+            if num_workers < min_workers:
+                print(f"Waiting for room for {min_workers} workers, {num_workers} fit")
+                time.sleep(10)
+                continue
+
+            started = time.time()
+
+            def rescale(trial_id, result):
+                # Stop at a report that carries a checkpoint, so the next attempt resumes from it; the
+                # batches trained since it was taken (its report is delayed by a few) are redone
+                return (num_workers < max_workers and result.get("checkpoint_dir_name") is not None
+                        and time.time() - started > rescale_interval_s and _available_workers(resources_per_worker) > 0)
+
+            lr = 1e-3 * batch_size_per_worker * num_workers / 32
+            print(f"Attempt {attempt}: {num_workers} workers, global batch {batch_size_per_worker * num_workers}, lr {lr:.2e}")
+            trainer = TorchTrainer(
+                train_loop_per_worker=train_func_per_worker,
+                train_loop_config={
+                    "lr": lr,
+                    "epochs": epochs,
+                    "batch_size_per_worker": batch_size_per_worker,
+                    "checkpoint_every_batches": checkpoint_every_batches,
+                },
+                scaling_config=ScalingConfig(num_workers=num_workers, use_gpu=use_gpu,
+                                             resources_per_worker=resources_per_worker, trainer_resources={"CPU": 0}),
+                # A lost worker ends the attempt instead of waiting for its node to come back
+                run_config=RunConfig(
+                    name=f"{run_name}-{attempt}",
+                    storage_path=storage_path,
+                    checkpoint_config=CheckpointConfig(num_to_keep=2),
+                    failure_config=FailureConfig(max_failures=0),
+                    stop=rescale,
+                    callbacks=[checkpoints],
+                ),
+                datasets={"train": train_dataset, "test": test_dataset},
+                dataset_config=_dataset_config(),
+                resume_from_checkpoint=checkpoints.latest,
+            )
+            attempt += 1
+            try:
+                result = trainer.fit()
+            except TrainingFailedError as e:
+                failures += 1
+                if failures > max_failures:
+                    raise
+                print(f"Attempt failed ({failures}/{max_failures}), resuming from {checkpoints.latest}: {e}")
+                continue
+
+            # Only the report after the last epoch has an accuracy for it
+            if result.metrics.get("epoch") == epochs - 1 and "accuracy" in result.metrics:
+                print(f"Training result: {result}")
+                return result
+            print(f"Rescaling from {num_workers} workers")
+    finally:
+        request_resources(bundles=[])
+
+
+def compare_throughput(num_workers, use_gpu, data_path, batch_size_per_worker=None):
+    """Trains one epoch per configuration and prints the training throughput of each."""
+    configs = {
+        "fp32": {},
+        "fp32, 8 accumulated batches": {"grad_accumulation_steps": 8},
+        "bf16, 8 accumulated batches": {"grad_accumulation_steps": 8, "precision": "bf16"},
+        "bf16, 8 accumulated batches, 1MB buckets": {"grad_accumulation_steps": 8, "precision": "bf16", "bucket_cap_mb": 1},
+    }
+    rows = []
+    for name, options in configs.items():
+        result = train_fashion_mnist(num_workers, use_gpu, data_path, batch_size_per_worker, **options)
+        rows.append((name, result.metrics["train_samples_per_second"], result.metrics["accuracy"]))
+    print(f"{'configuration':<42} {'samples/s':>10} {'speedup':>8} {'accuracy':>9}")
+    for name, throughput, accuracy in rows:
+        print(f"{name:<42} {throughput:>10.1f} {throughput / rows[0][1]:>7.2f}x {accuracy:>9.3f}")
+
+
+def check_resume(fail_at_batch, epochs=1, **options):
+    """Checks that a run resumed after a worker failure trains like one that was not interrupted.
+
+    Trains twice with the same options, killing a worker at fail_at_batch the second time
+    so the run resumes from its checkpoint before that batch. Every epoch of the two runs
+    must train on the same samples, compared by their count and pixel sums, and the runs
+    must end after the same number of optimizer steps. Their losses differ, since each
+    run starts from its own random weights.
+    """
+    counts = ["epoch", "train_samples", "optimizer_steps"]
+    runs = []
+    for fail in (None, fail_at_batch):
+        result = train_fashion_mnist(epochs=epochs, fail_at_batch=fail, check_resume=True, **options)
+        # Only the report after each epoch has its totals
+        epoch_reports = result.metrics_dataframe.dropna(subset=["accuracy"]).reset_index(drop=True)
+        runs.append(epoch_reports)
+        print(epoch_reports[counts + ["train_fingerprint", "resumed"]].to_string(index=False))
+    uninterrupted, interrupted = runs
+    if not interrupted["resumed"].any():
+        raise SystemExit(f"No worker failed at batch {fail_at_batch}; pick a batch within the first epoch")
+    same_samples = (len(uninterrupted) == len(interrupted) == epochs
+                    and uninterrupted[counts].equals(interrupted[counts])
+                    and np.allclose(uninterrupted["train_fingerprint"], interrupted["train_fingerprint"], rtol=1e-9, atol=0))
+    if not same_samples:
+        raise SystemExit("The resumed run did not train on the same samples as the uninterrupted one")
+    print(f"Resuming after batch {fail_at_batch} trained on the same samples and took the same optimizer steps")
+
+
+def tune_fashion_mnist(num_samples=16, num_workers=2, use_gpu=False, data_path=None, max_epochs=4,
+                       cpus_per_worker=1, gpus_per_worker=1, run_name=None, storage_path=None, resume=False):
+    """Searches lr, momentum and batch size with Ray Tune, stopping poor trials early.
+
+    Every trial is a TorchTrainer with num_workers workers. Trials run side by side as far
+    as the cluster has room, with each worker reserving cpus_per_worker CPUs (and
+    gpus_per_worker GPUs); fractions pack several workers onto one CPU or GPU. The datasets
+    are materialized in the object store once, by the driver, and every trial reads them
+    from there. ASHA evaluates trials after every epoch and stops the ones whose accuracy
+    falls behind, so only the promising ones train for all max_epochs. With resume, the
+    named sweep continues where it stopped instead of starting over.
+    """
+    train_dataset, test_dataset = get_datasets(data_path)
+
+    trainer = TorchTrainer(
+        train_loop_per_worker=train_func_per_worker,
+        train_loop_config={"epochs": max_epochs},
+        scaling_config=ScalingConfig(
+            num_workers=num_workers,
+            use_gpu=use_gpu,
+            resources_per_worker={"CPU": cpus_per_worker, **({"GPU": gpus_per_worker} if use_gpu else {})},
+            # The trial's coordinator only waits for its workers, so it does not hold a CPU
+            trainer_resources={"CPU": 0},
+        ),
+        datasets={"train": train_dataset, "test": test_dataset},
+        dataset_config=_dataset_config(),
+    )
+    param_space = {
+        "train_loop_config": {
+            "lr": tune.loguniform(1e-4, 1e-1),
+            "momentum": tune.uniform(0.5, 0.99),
+            "batch_size_per_worker": tune.choice([8, 16, 32, 64]),
+            "epochs": max_epochs,
+            # Every report is an epoch with an accuracy for the scheduler to compare
+            "checkpoint_every_batches": 0,
+        }
+    }
+
+    # A finished sweep can be restored too, which would only return its old results
+    run_path = os.path.join(storage_path or os.path.expanduser("~/ray_results"), run_name or "")
+    if resume and run_name and tune.Tuner.can_restore(run_path):
+        print(f"Resuming {run_path}")
+        tuner = tune.Tuner.restore(run_path, trainable=trainer, param_space=param_space)
+    else:
+        tuner = tune.Tuner(
+            trainer,
+            param_space=param_space,
+            tune_config=tune.TuneConfig(
+                metric="accuracy",
+                mode="max",
+                num_samples=num_samples,
+                scheduler=ASHAScheduler(time_attr="training_iteration", max_t=max_epochs, grace_period=1),
+            ),
+            run_config=RunConfig(
+                name=run_name,
+                storage_path=storage_path,
+                checkpoint_config=CheckpointConfig(num_to_keep=1),
+            ),
+        )
+
+    results = tuner.fit()
+    best = results.get_best_result()
+    print(f"Best config: {best.config['train_loop_config']}")
+    print(f"Best accuracy: {best.metrics['accuracy']:.3f} after {best.metrics['training_iteration']} epochs")
+    return results
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train a FashionMNIST classifier with Ray Train")
+    parser.add_argument("--num-workers", type=int, default=10)
+    parser.add_argument("--use-gpu", action="store_true")
+    parser.add_argument("--backend", choices=["auto", "neuron", "cpu"], default="auto",
+                        help="Train on NeuronCores or CPU workers; auto uses NeuronCores when the cluster has them")
+    parser.add_argument("--neuron-cache-dir", default="/tmp/neuron-compile-cache",
+                        help="Neuron compile cache on each worker's node, or an S3 URI shared by all of them")
+    parser.add_argument("--precompile", action="store_true",
+                        help="On Neuron, compile the training graphs in parallel into the cache before training")
+    parser.add_argument("--compare-backends", action="store_true",
+                        help="Train on CPU workers and on NeuronCores with the same batches and compare throughput")
+    parser.add_argument("--data-path", help="S3 URI or shared directory for the preprocessed Parquet dataset")
+    parser.add_argument("--batch-size-per-worker", type=int, help="Default: a global batch of 32 split across workers")
+    parser.add_argument("--grad-accumulation-steps", type=int, default=1,
+                        help="Batches per optimizer step; the effective batch is this times the global batch")
+    parser.add_argument("--precision", choices=["fp32", "bf16", "fp16"], default="fp32",
+                        help="Autocast dtype; fp16 requires --use-gpu")
+    parser.add_argument("--bucket-cap-mb", type=float, default=25, help="Size of the gradient all-reduce buckets")
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--run-name", default="fashion-mnist", help="Name of the run's directory under --storage-path")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue the run named --run-name (with --tune, its sweep) from its latest checkpoint "
+                             "instead of starting a new one")
+    parser.add_argument("--storage-path", help="S3 URI or shared directory for checkpoints (default: ~/ray_results)")
+    parser.add_argument("--checkpoint-every-batches", type=int, default=500,
+                        help="Batches per worker between checkpoints; one is also saved after every epoch")
+    parser.add_argument("--max-failures", type=int, default=3, help="Worker failures to recover from")
+    parser.add_argument("--simulate-failure-at-batch", type=int,
+                        help="Kill a worker once at this batch to check that training resumes from the last checkpoint; "
+                             "a checkpoint is reported 20 batches after it is taken, and the kill repeats until one is")
+    parser.add_argument("--check-resume", action="store_true",
+                        help="Train twice, the second time killing a worker at --simulate-failure-at-batch (default: "
+                             "2 checkpoint intervals), and check that the resumed run trains on the same samples")
+    parser.add_argument("--profile", action="store_true",
+                        help="Report per-step data wait, forward, backward, optimizer and all-reduce times")
+    parser.add_argument("--profile-steps", type=int, default=0,
+                        help="With --profile, also trace this many steps with the torch profiler")
+    parser.add_argument("--profile-dir", default="/tmp/ray-train-profile",
+                        help="Directory on each worker's node for the Chrome trace files")
+    parser.add_argument("--compare-throughput", action="store_true",
+                        help="Train one epoch with each precision and accumulation setting and compare throughput")
+    parser.add_argument("--tune", action="store_true",
+                        help="Search lr, momentum and batch size over --num-samples trials of up to --epochs epochs")
+    parser.add_argument("--num-samples", type=int, default=16, help="Number of trials with --tune")
+    parser.add_argument("--min-workers", type=int,
+                        help="Train elastically with --min-workers to --num-workers workers, as many as fit")
+    parser.add_argument("--rescale-interval-s", type=float, default=300,
+                        help="Minimum time before an elastic attempt restarts to add workers")
+    parser.add_argument("--cpus-per-worker", type=float, default=1,
+                        help="CPUs reserved per worker with --tune or --min-workers; fractions pack more workers onto a node")
+    parser.add_argument("--gpus-per-worker", type=float, default=1,
+                        help="GPUs reserved per worker with --use-gpu and --tune or --min-workers; fractions share a GPU")
+    args = parser.parse_args()
+
     ray.init("auto")
-    train_fashion_mnist(num_workers=10, use_gpu=False)
\ No newline at end of file
+    backend = select_backend(args.backend)
+    if args.compare_backends:
+        compare_backends(args.num_workers, args.data_path, args.batch_size_per_worker or 32, args.epochs,
+                         args.neuron_cache_dir)
+    elif args.compare_throughput:
+        compare_throughput(args.num_workers, args.use_gpu, args.data_path, args.batch_size_per_worker)
+    elif args.check_resume:
+        check_resume(
+            args.simulate_failure_at_batch or args.checkpoint_every_batches * 2,
+            epochs=args.epochs,
+            num_workers=args.num_workers,
+            use_gpu=args.use_gpu,
+            data_path=args.data_path,
+            batch_size_per_worker=args.batch_size_per_worker,
+            grad_accumulation_steps=args.grad_accumulation_steps,
+            precision=args.precision,
+            storage_path=args.storage_path,
+            checkpoint_every_batches=args.checkpoint_every_batches,
+            backend=backend,
+            neuron_cache_dir=args.neuron_cache_dir,
+        )
+    elif args.tune:
+        tune_fashion_mnist(
+            num_samples=args.num_samples,
+            num_workers=args.num_workers,
+            use_gpu=args.use_gpu,
+            data_path=args.data_path,
+            max_epochs=args.epochs,
+            cpus_per_worker=args.cpus_per_worker,
+            gpus_per_worker=args.gpus_per_worker,
+            run_name=f"{args.run_name}-tune",
+            storage_path=args.storage_path,
+            resume=args.resume,
+        )
+    elif args.min_workers:
+        elastic_train_fashion_mnist(
+            min_workers=args.min_workers,
+            max_workers=args.num_workers,
+            use_gpu=args.use_gpu,
+            data_path=args.data_path,
+            batch_size_per_worker=args.batch_size_per_worker,
+            epochs=args.epochs,
+            cpus_per_worker=args.cpus_per_worker,
+            gpus_per_worker=args.gpus_per_worker,
+            run_name=args.run_name,
+            storage_path=args.storage_path,
+            checkpoint_every_batches=args.checkpoint_every_batches,
+            max_failures=args.max_failures,
+            rescale_interval_s=args.rescale_interval_s,
+        )
+    else:
+        if args.precompile and backend == "neuron":
+            train_fashion_mnist(
+                num_workers=args.num_workers,
+                data_path=args.data_path,
+                batch_size_per_worker=args.batch_size_per_worker,
+                grad_accumulation_steps=args.grad_accumulation_steps,
+                precision=args.precision,
+                backend=backend,
+                neuron_cache_dir=args.neuron_cache_dir,
+                neuron_parallel_compile=True,
+            )
+        train_fashion_mnist(
+            num_workers=args.num_workers,
+            use_gpu=args.use_gpu,
+            data_path=args.data_path,
+            batch_size_per_worker=args.batch_size_per_worker,
+            grad_accumulation_steps=args.grad_accumulation_steps,
+            precision=args.precision,
+            bucket_cap_mb=args.bucket_cap_mb,
+            epochs=args.epochs,
+            run_name=args.run_name,
+            storage_path=args.storage_path,
+            resume=args.resume,
+            checkpoint_every_batches=args.checkpoint_every_batches,
+            max_failures=args.max_failures,
+            fail_at_batch=args.simulate_failure_at_batch,
+            profile=args.profile,
+            profile_steps=args.profile_steps if args.profile else 0,
+            profile_dir=args.profile_dir,
+            backend=backend,
+            neuron_cache_dir=args.neuron_cache_dir,
+        )
\ No newline at end of file